@@ -12,7 +12,8 @@ runai submit \
   --volume /nfs/home/wds20/datasets/MIMIC-CXR-JPG_v2.0.0/physionet.org/files/mimic-cxr-jpg/2.0.0/:/sourcedata/ \
   --volume /nfs/home/wds20/projects/generative_mimic/:/project/ \
   --command -- bash /project/src/bash/start_script.sh \
-      python3 /project/src/python/preprocessing/organise.py
+      python3 /project/src/python/preprocessing/organise.py \
+      --num_workers=4
 
 
 # Zip file
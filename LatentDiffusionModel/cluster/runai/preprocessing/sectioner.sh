@@ -13,4 +13,5 @@ runai submit \
   --command -- python3 /project/src/python/preprocessing/create_section_files.py \
       --reports_path="/data/rawdata/files" \
       --output_path="/project/outputs/reports/" \
-      --no_split
+      --no_split \
+      --num_workers=4
@@ -0,0 +1,149 @@
+""" Dataset code shared by the training and testing scripts.
+
+The scripts of src/training and src/testing import their own util.py, so this module lives in its own directory and is
+added to sys.path by both util.py files.
+"""
+import hashlib
+import json
+import os
+from collections.abc import Sequence
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from monai import transforms
+from monai.config import KeysCollection, PathLike
+from monai.transforms.transform import MapTransform, Transform
+
+
+def get_buckets(max_pixels: int = 512 * 512, multiple: int = 64, max_aspect_ratio: float = 2.0) -> List[Tuple[int, int]]:
+    """Resolution buckets (height, width), multiples of `multiple`, with about max_pixels pixels each."""
+    buckets = []
+    for height in range(multiple, int(np.sqrt(max_pixels * max_aspect_ratio)) + 1, multiple):
+        width = max_pixels // height // multiple * multiple
+        if width > 0 and 1 / max_aspect_ratio <= height / width <= max_aspect_ratio:
+            buckets.append((height, width))
+    return buckets
+
+
+def assign_buckets(heights: np.ndarray, widths: np.ndarray, buckets: List[Tuple[int, int]]) -> np.ndarray:
+    """Index of the bucket with the closest aspect ratio of each image."""
+    log_ratios = np.log(np.asarray(heights, dtype=np.float64) / np.asarray(widths, dtype=np.float64))
+    bucket_log_ratios = np.log([h / w for h, w in buckets])
+    return np.abs(log_ratios[:, None] - bucket_log_ratios[None, :]).argmin(axis=1)
+
+
+class ManifestDatalist(Sequence):
+    """Data dicts of one split of the manifest created by preprocessing/create_manifest.py.
+
+    Only the rows of the split are read from the parquet file, and the dicts are created on access, so building the
+    datalist does not depend on the number of images. Each dict contains the file hash of the image, which makes it
+    part of the PersistentDataset cache key. If buckets are given, each image is assigned to the bucket with the
+    closest aspect ratio and the dicts contain its (height, width).
+    """
+
+    def __init__(self, dataset_path: str, split: str, buckets: Optional[List[Tuple[int, int]]] = None) -> None:
+        df = pd.read_parquet(
+            os.path.join(dataset_path, "manifest.parquet"),
+            columns=["image", "report", "hash"] + (["height", "width"] if buckets is not None else []),
+            filters=[("split", "==", split)],
+        )
+        self.images = (str(dataset_path) + os.sep + df["image"]).to_numpy()
+        self.reports = df["report"].to_numpy()
+        self.hashes = df["hash"].to_numpy()
+
+        self.buckets = buckets
+        self.bucket_ids = None
+        if buckets is not None:
+            self.bucket_ids = assign_buckets(df["height"].to_numpy(), df["width"].to_numpy(), buckets)
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        item = {"image": self.images[index], "report": [self.reports[index]], "hash": self.hashes[index]}
+        if self.bucket_ids is not None:
+            item["bucket"] = list(self.buckets[self.bucket_ids[index]])
+        return item
+
+    def cache_key(self) -> str:
+        """Hash identifying the images of the split, to be used as key of downstream caches."""
+        digest = hashlib.blake2b(digest_size=16)
+        for image, file_hash in zip(self.images, self.hashes):
+            digest.update(f"{os.path.basename(image)}:{file_hash}\n".encode())
+        return digest.hexdigest()
+
+
+class LoadArrayShard(Transform):
+    """Transformation to load an image from the array shards created by create_carm_dataset.py.
+
+    The image is looked up in the index by its file name and returned as a (1, H, W) float32 array, already in the
+    display orientation. The shards are memory-mapped once per process, so only the bytes of the image are read.
+    """
+
+    def __init__(self, index_dir: PathLike) -> None:
+        self.index_dir = Path(index_dir)
+        self._index = None
+        self._shards = {}
+
+    def __call__(self, filename: PathLike):
+        if self._index is None:
+            with open(self.index_dir / "index.json") as f:
+                self._index = json.load(f)
+
+        entry = self._index[Path(filename).name]
+        if entry["shard"] not in self._shards:
+            self._shards[entry["shard"]] = np.memmap(self.index_dir / entry["shard"], dtype=np.uint8, mode="r")
+
+        dtype = np.dtype(entry["dtype"])
+        n_bytes = int(np.prod(entry["shape"])) * dtype.itemsize
+        data = self._shards[entry["shard"]][entry["offset"] : entry["offset"] + n_bytes]
+        return data.view(dtype).reshape(entry["shape"])[None].astype(np.float32)
+
+
+class LoadArrayShardd(MapTransform):
+    def __init__(
+        self,
+        keys: KeysCollection,
+        allow_missing_keys: bool = False,
+        *args,
+        **kwargs,
+    ) -> None:
+        super().__init__(keys, allow_missing_keys)
+        self._loader = LoadArrayShard(*args, **kwargs)
+
+    def __call__(self, data):
+        d = dict(data)
+        for key in self.key_iterator(d):
+            data = self._loader(d[key])
+            d[key] = data
+
+        return d
+
+
+def get_load_transforms(dataset_path: str) -> list:
+    """Transforms loading the images as (1, H, W) arrays in the display orientation.
+
+    If the dataset was converted to array shards by create_carm_dataset.py, the images are read from the memory-mapped
+    shards, which are stored already oriented. Otherwise they are decoded from the image files and the flipped image
+    read is fixed.
+    """
+    index_dir = os.path.join(dataset_path, "arrays")
+    if os.path.exists(os.path.join(index_dir, "index.json")):
+        return [LoadArrayShardd(keys=["image"], index_dir=index_dir)]
+
+    return [
+        transforms.LoadImaged(keys=["image"]),
+        transforms.EnsureChannelFirstd(keys=["image"]),
+        transforms.Lambdad(
+            keys=["image"],
+            func=lambda x: x[0, :, :][
+                None,
+            ],
+        ),
+        transforms.Rotate90d(keys=["image"], k=-1, spatial_axes=(0, 1)),  # Fix flipped image read
+        transforms.Flipd(keys=["image"], spatial_axis=1),  # Fix flipped image read
+    ]
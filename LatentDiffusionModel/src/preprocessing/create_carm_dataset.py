@@ -5,6 +5,11 @@ Create a dataset from C-arm images. There are two part of images:
 
 In this script, we format a dataset to train a xray image generation model by LDM or related.
 
+The images are also converted to uncompressed 2-D arrays in the display orientation (the rotate/flip fix of the loaders
+already applied) and packed into shards under SAVE_PATH/arrays, with an index.json giving the shard, byte offset,
+shape and dtype of each image. The loaders memory-map the shards (see LoadArrayShardd), so reading an image does not
+need to gunzip a NIfTI volume or decode a PNG.
+
 The test information should be:
 This is an X-ray image taken by a C-arm, covering num vertebrae, namely L1, L2, L3 and L4.
 This is an X-ray image taken by a C-arm. It includes num vertebrae, but the specific names of the vertebrae are unclear.
@@ -15,9 +20,15 @@ import os,json
 from tqdm import tqdm
 from glob import glob
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
 
 SAVE_PATH = "/datastore2/yangjie/XrayGenerationDataset"
 XRAY_PATH = "/home/jirui/yangjie/remote_a100_share/repos/MaestroAlgoXrayImageDetection/00.datasets"
+SHARD_SIZE = 256
+ALIGNMENT = 64
 
 def name_string(vertebrae:list):
     v_dict = {
@@ -74,6 +85,63 @@ def format_xrayimage_without_name(root:str, dataset:dict={}):
     return dataset
 
 
+def load_oriented_image(image_path:str):
+    """Load the first channel of an image as a 2-D array in the orientation given by the loaders after their
+    Rotate90d(k=-1) + Flipd(spatial_axis=1) fix, i.e. (height, width)."""
+    if image_path.endswith(('.nii', '.nii.gz')):
+        import nibabel as nib
+
+        data = np.asanyarray(nib.load(image_path).dataobj)
+        # NIfTI arrays are (x, y, ...): keep the first element of the non-spatial dims and transpose
+        data = data[(slice(None), slice(None)) + (0,) * (data.ndim - 2)].T
+    else:
+        data = np.asarray(Image.open(image_path))
+        if data.ndim == 3:
+            data = data[..., 0]
+    return np.ascontiguousarray(data)
+
+
+def write_array_shard(image_paths:list, shard_path:str):
+    """Write the images one after the other in a raw binary shard, each one starting at a multiple of ALIGNMENT."""
+    index = {}
+    offset = 0
+    with open(shard_path + '.tmp', 'wb') as f:
+        for image_path in image_paths:
+            data = load_oriented_image(image_path)
+            padding = -offset % ALIGNMENT
+            f.write(b'\0' * padding)
+            offset += padding
+            f.write(data.tobytes())
+            index[os.path.basename(image_path)] = {
+                'shard': os.path.basename(shard_path),
+                'offset': offset,
+                'shape': list(data.shape),
+                'dtype': data.dtype.str,
+            }
+            offset += data.nbytes
+    os.replace(shard_path + '.tmp', shard_path)
+    return index
+
+
+def convert_images_to_arrays(image_paths:list, save_path:str, num_workers:int=os.cpu_count()):
+    arrays_dir = os.path.join(save_path, 'arrays')
+    os.makedirs(arrays_dir, exist_ok=True)
+    image_paths = sorted(image_paths)
+    shards = [image_paths[i:i + SHARD_SIZE] for i in range(0, len(image_paths), SHARD_SIZE)]
+
+    index = {}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(write_array_shard, shard, os.path.join(arrays_dir, f'shard_{i:05d}.bin'))
+            for i, shard in enumerate(shards)
+        ]
+        for future in tqdm(futures, desc='Convert images to arrays'):
+            index.update(future.result())
+
+    with open(os.path.join(arrays_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+
 if __name__ == "__main__":
     dataset = {}
     dataset = format_xrayimage_with_name(XRAY_PATH+'/Xray_loc/MergeLoc', dataset)
@@ -94,4 +162,9 @@ if __name__ == "__main__":
         i += 1
     
     with open(SAVE_PATH+'/annotation.json','w') as f:
-        json.dump(save_data, f, indent=4)
\ No newline at end of file
+        json.dump(save_data, f, indent=4)
+
+    convert_images_to_arrays(
+        [SAVE_PATH+'/images/'+v['image_path'][0] for v in dataset.values()],
+        SAVE_PATH,
+    )
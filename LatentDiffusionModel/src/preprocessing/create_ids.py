@@ -23,20 +23,19 @@ def main(args):
     metadata_df = metadata_df[metadata_df["ViewPosition"] == "PA"]
 
     # create data list of paths to the images and radiological reports
-    data_list = []
-    for index, row in metadata_df.iterrows():
-        data_list.append(
-            {
-                "subject_id": str(int(row["subject_id"])),
-                "study_id": str(int(row["study_id"])),
-                "image": f"/data/rawdata/files/p{str(int(row['subject_id']))[:2]}/p{str(int(row['subject_id']))}/"
-                f"s{int(row['study_id'])}/{row['dicom_id']}.jpg",
-                "report": f"/data/derivatives/report_sentences/s{int(row['study_id'])}.json",
-            }
-        )
-
-    # transform data list to dataframe and shuffle it using a random seed
-    data_df = pd.DataFrame(data_list)
+    subject_id = metadata_df["subject_id"].astype(int).astype(str)
+    study_id = metadata_df["study_id"].astype(int).astype(str)
+    data_df = pd.DataFrame(
+        {
+            "subject_id": subject_id,
+            "study_id": study_id,
+            "image": "/data/rawdata/files/p" + subject_id.str[:2] + "/p" + subject_id + "/s" + study_id + "/"
+            + metadata_df["dicom_id"] + ".jpg",
+            "report": "/data/derivatives/report_sentences/s" + study_id + ".json",
+        }
+    ).reset_index(drop=True)
+
+    # shuffle the data list using a random seed
     data_df = data_df.sample(frac=1, random_state=42).reset_index(drop=True)
 
     # split in train, validation and test data lists. The total number of PA images in data_df is 96161.
@@ -50,6 +49,12 @@ def main(args):
     val_data_list.to_csv(output_dir / "validation.tsv", index=False, sep="\t")
     test_data_list.to_csv(output_dir / "test.tsv", index=False, sep="\t")
 
+    # save the same data lists as a single columnar manifest
+    split = pd.Series("test", index=data_df.index)
+    split.iloc[:90000] = "train"
+    split.iloc[90000:91161] = "val"
+    data_df.assign(split=split).to_parquet(output_dir / "manifest.parquet", index=False)
+
 
 if __name__ == "__main__":
     args = parse_args()
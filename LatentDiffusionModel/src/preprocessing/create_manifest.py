@@ -0,0 +1,87 @@
+""" Script to create the columnar manifest (manifest.parquet) of a dataset from its annotation.json.
+
+The manifest has one row per image with the columns:
+ - image: path of the image relative to the dataset directory.
+ - report: text of the report.
+ - split: train, val or test.
+ - height, width: size of the image as displayed (i.e. after the orientation fix applied by the loaders).
+ - hash: blake2b digest of the image file.
+
+The data loaders read it (see get_iu_datalist in training/util.py) instead of parsing annotation.json, and the file
+hash of each image is part of the data dicts so the PersistentDataset caches are invalidated if an image changes.
+"""
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+from PIL import Image
+from tqdm import tqdm
+
+MANIFEST_NAME = "manifest.parquet"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--dataset_path", default="datasets/XrayGenerationDataset", help="Location of dataset.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Number of worker processes.")
+
+    args = parser.parse_args()
+    return args
+
+
+def get_file_stats(image_path: str) -> tuple:
+    """Return the displayed (height, width) of an image, reading only its header, and the hash of the file."""
+    if image_path.endswith((".nii", ".nii.gz")):
+        import nibabel as nib
+
+        # NIfTI arrays are (x, y, ...), the displayed image is its transpose
+        shape = nib.load(image_path).shape
+        height, width = shape[1], shape[0]
+    else:
+        with Image.open(image_path) as image:
+            width, height = image.size
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(image_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    return height, width, digest.hexdigest()
+
+
+def add_file_stats(df: pd.DataFrame, dataset_path: Path, num_workers: int) -> pd.DataFrame:
+    image_paths = [str(dataset_path / image) for image in df["image"]]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        stats = list(
+            tqdm(executor.map(get_file_stats, image_paths, chunksize=64), total=len(image_paths), desc="File stats")
+        )
+
+    stats_df = pd.DataFrame(stats, columns=["height", "width", "hash"], index=df.index)
+    return pd.concat([df, stats_df], axis=1)
+
+
+def main(args):
+    dataset_path = Path(args.dataset_path)
+    with open(dataset_path / "annotation.json", "r") as f:
+        data = json.load(f)
+
+    df = pd.concat(
+        [pd.DataFrame(samples).assign(split=split) for split, samples in data.items() if len(samples) > 0],
+        ignore_index=True,
+    )
+    df["image"] = "images/" + df["image_path"].str[0]
+    df = df[["image", "report", "split"]]
+
+    df = add_file_stats(df, dataset_path, args.num_workers)
+    df.to_parquet(dataset_path / MANIFEST_NAME, index=False)
+    print(df.groupby("split").size())
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -3,6 +3,7 @@ import argparse
 import csv
 import os
 import re
+from multiprocessing import Pool
 from pathlib import Path
 
 from tqdm import tqdm
@@ -276,6 +277,183 @@ def list_rindex(analised_list, s):
     return len(analised_list) - analised_list[-1::-1].index(s) - 1
 
 
+def section_patient(patient_path, custom_section_names, custom_indices):
+    """Section all the free-text reports of a patient.
+
+    Returns a list with one (patient_study, study_sectioned) tuple per report, where study_sectioned is None for the
+    reports handled by the custom rules.
+    """
+    # get the filename for all their free-text reports
+    studies = os.listdir(patient_path)
+    studies = sorted([s for s in studies if s.endswith(".txt") and s.startswith("s")])
+
+    results = []
+    for s in studies:
+        # load in the free-text report
+        with open(patient_path / s, "r") as fp:
+            text = "".join(fp.readlines())
+
+        # get study string name without the txt extension
+        s_stem = s[0:-4]
+
+        # custom rules for some poorly formatted reports
+        if s_stem in custom_indices:
+            idx = custom_indices[s_stem]
+            results.append(([s_stem, text[idx[0] : idx[1]]], None))
+            continue
+
+        # split text into sections
+        sections, section_names, section_idx = section_text(text)
+
+        # check to see if this has mis-named sections
+        # e.g. sometimes the impression is in the comparison section
+        if s_stem in custom_section_names:
+            sn = custom_section_names[s_stem]
+            idx = list_rindex(section_names, sn)
+            results.append(([s_stem, sections[idx].strip()], None))
+            continue
+
+        # grab the *last* section with the given title
+        # prioritizes impression > findings, etc.
+
+        # "last_paragraph" is text up to the end of the report
+        # many reports are simple, and have a single section
+        # header followed by a few paragraphs
+        # these paragraphs are grouped into section "last_paragraph"
+
+        # note also comparison seems unusual but if no other sections
+        # exist the radiologist has usually written the report
+        # in the comparison section
+        idx = -1
+        for sn in ("impression", "findings", "last_paragraph", "comparison"):
+            if sn in section_names:
+                idx = list_rindex(section_names, sn)
+                break
+
+        if idx == -1:
+            # we didn't find any sections we can use :(
+            patient_study = [s_stem, ""]
+            print(f"no impression/findings: {patient_path / s}")
+        else:
+            # store the text of the conclusion section
+            patient_study = [s_stem, sections[idx].strip()]
+
+        study_sectioned = [s_stem]
+        for sn in ("impression", "findings", "last_paragraph", "comparison"):
+            if sn in section_names:
+                idx = list_rindex(section_names, sn)
+                study_sectioned.append(sections[idx].strip())
+            else:
+                study_sectioned.append(None)
+        results.append((patient_study, study_sectioned))
+
+    return results
+
+
+_custom_rules = None
+
+
+def _init_worker():
+    global _custom_rules
+    # not all reports can be automatically sectioned
+    # we load in some dictionaries which have manually determined sections
+    _custom_rules = custom_mimic_cxr_rules()
+
+
+def _section_patient_worker(patient_path):
+    return section_patient(patient_path, *_custom_rules)
+
+
+class ChunkedWriter:
+    """Stream rows to CSV or Parquet files.
+
+    If chunk_size is None all rows are written to `{prefix}.{ext}`, otherwise a new file `{prefix}_{n:02d}.{ext}` is
+    started every chunk_size rows. Files are only created once the first row arrives. The header is only written to
+    CSV files, Parquet files use `columns` (or the header) as column names. Parquet rows are buffered and written as
+    row groups of at most `buffer_size` rows, so memory stays bounded.
+    """
+
+    def __init__(
+        self,
+        output_path,
+        prefix,
+        header=None,
+        columns=None,
+        chunk_size=None,
+        output_format="csv",
+        buffer_size=10000,
+    ):
+        self.output_path = output_path
+        self.prefix = prefix
+        self.header = header
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.output_format = output_format
+        self.buffer_size = buffer_size if chunk_size is None else min(buffer_size, chunk_size)
+
+        self._n_rows = 0
+        self._fp = None
+        self._csvwriter = None
+        self._parquet_writer = None
+        self._buffer = []
+
+    def _filename(self):
+        if self.chunk_size is None:
+            return self.output_path / f"{self.prefix}.{self.output_format}"
+        return self.output_path / f"{self.prefix}_{self._n_rows // self.chunk_size:02d}.{self.output_format}"
+
+    def _open(self):
+        if self.output_format == "csv":
+            self._fp = open(self._filename(), "w")
+            self._csvwriter = csv.writer(self._fp)
+            if self.header is not None:
+                self._csvwriter.writerow(self.header)
+        else:
+            self._fp = self._filename()
+
+    def _flush_buffer(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        columns = self.columns if self.columns is not None else self.header
+        # explicit schema: a section missing from all the rows of a buffer would be inferred as null otherwise, and not
+        # match the schema of the file
+        schema = pa.schema([(c, pa.string()) for c in columns])
+        table = pa.table({c: [row[i] for row in self._buffer] for i, c in enumerate(columns)}, schema=schema)
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self._fp, schema)
+        self._parquet_writer.write_table(table)
+        self._buffer = []
+
+    def _close(self):
+        if self.output_format == "csv":
+            self._fp.close()
+        else:
+            if len(self._buffer) > 0:
+                self._flush_buffer()
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        self._fp = None
+
+    def write(self, row):
+        if self._fp is not None and self.chunk_size is not None and self._n_rows % self.chunk_size == 0:
+            self._close()
+        if self._fp is None:
+            self._open()
+
+        if self.output_format == "csv":
+            self._csvwriter.writerow(row)
+        else:
+            self._buffer.append(row)
+            if len(self._buffer) >= self.buffer_size:
+                self._flush_buffer()
+        self._n_rows += 1
+
+    def close(self):
+        if self._fp is not None:
+            self._close()
+
+
 def main(args):
     reports_path = Path(args.reports_path)
     output_path = Path(args.output_path)
@@ -283,123 +461,63 @@ def main(args):
     if not output_path.exists():
         output_path.mkdir()
 
-    # not all reports can be automatically sectioned
-    # we load in some dictionaries which have manually determined sections
-    custom_section_names, custom_indices = custom_mimic_cxr_rules()
-
     # get all higher up folders (p00, p01, etc)
     p_grp_folders = os.listdir(reports_path)
     p_grp_folders = [p for p in p_grp_folders if p.startswith("p") and len(p) == 3]
     p_grp_folders.sort()
 
-    # patient_studies will hold the text for use in NLP labeling
-    patient_studies = []
-
-    # study_sections will have an element for each study
-    # this element will be a list, each element having text for a specific section
-    study_sections = []
+    # get patient folders, usually around ~6k per group folder
+    patient_paths = []
     for p_grp in p_grp_folders:
-        # get patient folders, usually around ~6k per group folder
         cxr_path = reports_path / p_grp
         p_folders = os.listdir(cxr_path)
         p_folders = [p for p in p_folders if p.startswith("p")]
         p_folders.sort()
+        patient_paths.extend([cxr_path / p for p in p_folders])
 
-        # For each patient in this grouping folder
-        print(p_grp)
-        for p in tqdm(p_folders):
-            patient_path = cxr_path / p
-
-            # get the filename for all their free-text reports
-            studies = os.listdir(patient_path)
-            studies = [s for s in studies if s.endswith(".txt") and s.startswith("s")]
-
-            for s in studies:
-                # load in the free-text report
-                with open(patient_path / s, "r") as fp:
-                    text = "".join(fp.readlines())
-
-                # get study string name without the txt extension
-                s_stem = s[0:-4]
-
-                # custom rules for some poorly formatted reports
-                if s_stem in custom_indices:
-                    idx = custom_indices[s_stem]
-                    patient_studies.append([s_stem, text[idx[0] : idx[1]]])
-                    continue
-
-                # split text into sections
-                sections, section_names, section_idx = section_text(text)
-
-                # check to see if this has mis-named sections
-                # e.g. sometimes the impression is in the comparison section
-                if s_stem in custom_section_names:
-                    sn = custom_section_names[s_stem]
-                    idx = list_rindex(section_names, sn)
-                    patient_studies.append([s_stem, sections[idx].strip()])
-                    continue
-
-                # grab the *last* section with the given title
-                # prioritizes impression > findings, etc.
-
-                # "last_paragraph" is text up to the end of the report
-                # many reports are simple, and have a single section
-                # header followed by a few paragraphs
-                # these paragraphs are grouped into section "last_paragraph"
-
-                # note also comparison seems unusual but if no other sections
-                # exist the radiologist has usually written the report
-                # in the comparison section
-                idx = -1
-                for sn in ("impression", "findings", "last_paragraph", "comparison"):
-                    if sn in section_names:
-                        idx = list_rindex(section_names, sn)
-                        break
-
-                if idx == -1:
-                    # we didn't find any sections we can use :(
-                    patient_studies.append([s_stem, ""])
-                    print(f"no impression/findings: {patient_path / s}")
-                else:
-                    # store the text of the conclusion section
-                    patient_studies.append([s_stem, sections[idx].strip()])
-
-                study_sectioned = [s_stem]
-                for sn in ("impression", "findings", "last_paragraph", "comparison"):
-                    if sn in section_names:
-                        idx = list_rindex(section_names, sn)
-                        study_sectioned.append(sections[idx].strip())
-                    else:
-                        study_sectioned.append(None)
-                study_sections.append(study_sectioned)
-    # write distinct files to facilitate modular processing
-    if len(patient_studies) > 0:
-        # write out a single CSV with the sections
-        with open(output_path / "mimic_cxr_sectioned.csv", "w") as fp:
-            csvwriter = csv.writer(fp)
-            # write header
-            csvwriter.writerow(["study", "impression", "findings", "last_paragraph", "comparison"])
-            for row in study_sections:
-                csvwriter.writerow(row)
-
-        if args.no_split:
-            # write all the reports out to a single file
-            with open(output_path / f"mimic_cxr_sections.csv", "w") as fp:
-                csvwriter = csv.writer(fp)
-                for row in patient_studies:
-                    csvwriter.writerow(row)
-        else:
-            # write ~22 files with ~10k reports each
-            n = 0
-            jmp = 10000
+    # study_sections will have an element for each study
+    # this element will be a list, each element having text for a specific section
+    sectioned_writer = ChunkedWriter(
+        output_path,
+        "mimic_cxr_sectioned",
+        header=["study", "impression", "findings", "last_paragraph", "comparison"],
+        output_format=args.output_format,
+    )
 
-            while n < len(patient_studies):
-                n_fn = n // jmp
-                with open(output_path / f"mimic_cxr_{n_fn:02d}.csv", "w") as fp:
-                    csvwriter = csv.writer(fp)
-                    for row in patient_studies[n : n + jmp]:
-                        csvwriter.writerow(row)
-                n += jmp
+    # patient_studies will hold the text for use in NLP labeling
+    if args.no_split:
+        # write all the reports out to a single file
+        sections_writer = ChunkedWriter(
+            output_path, "mimic_cxr_sections", columns=["study", "text"], output_format=args.output_format
+        )
+    else:
+        # write ~22 files with ~10k reports each
+        sections_writer = ChunkedWriter(
+            output_path, "mimic_cxr", columns=["study", "text"], chunk_size=10000, output_format=args.output_format
+        )
+
+    # Patients are sharded across the workers and the results are returned in the original order (imap), so the
+    # output files are identical whatever the number of workers.
+    _init_worker()
+    if args.num_workers > 1:
+        pool = Pool(args.num_workers, initializer=_init_worker)
+        results = pool.imap(_section_patient_worker, patient_paths, chunksize=args.chunksize)
+    else:
+        pool = None
+        results = map(_section_patient_worker, patient_paths)
+
+    try:
+        for patient_results in tqdm(results, total=len(patient_paths)):
+            for patient_study, study_sectioned in patient_results:
+                sections_writer.write(patient_study)
+                if study_sectioned is not None:
+                    sectioned_writer.write(study_sectioned)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        sections_writer.close()
+        sectioned_writer.close()
 
 
 if __name__ == "__main__":
@@ -409,5 +527,8 @@ if __name__ == "__main__":
     )
     parser.add_argument("--output_path", required=True, help="Path to output CSV files.")
     parser.add_argument("--no_split", action="store_true", help="Do not output batched CSV files.")
+    parser.add_argument("--num_workers", type=int, default=1, help="Number of worker processes.")
+    parser.add_argument("--chunksize", type=int, default=16, help="Number of patients sent to a worker at once.")
+    parser.add_argument("--output_format", default="csv", choices=["csv", "parquet"], help="Format of output files.")
     args = parser.parse_args()
     main(args)
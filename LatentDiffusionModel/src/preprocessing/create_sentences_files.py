@@ -1,12 +1,23 @@
-"""Script to create json files with sentences from reports.
+"""Script to create the sentences files from reports.
 
 In order to run this script, it is necessary to run `python -m spacy download en_core_web_sm` first.
+
+By default, the sentences of all studies are saved in a single sentence store in output_dir instead of one JSON file
+per study:
+ - sentences.bin: utf-8 encoded sentences, concatenated.
+ - sentence_offsets.npy: byte offsets of each sentence in sentences.bin (n_sentences + 1).
+ - study_offsets.npy: index of the first sentence of each study in sentence_offsets (n_studies + 1).
+ - studies.json: study names (e.g. "s50414267") in the same order as study_offsets.
+
+The store is read by LoadSentenceStored (custom_transforms.py), which accepts the same report paths as LoadJSONd (e.g.
+output_dir/s50414267.json) and returns the same {"sentences": [...]} dictionary.
 """
 import argparse
 import json
 import re
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import spacy
 from tqdm import tqdm
@@ -24,62 +35,92 @@ def parse_args():
     parser.add_argument("--training_ids", help="Location of file with training ids.")
     parser.add_argument("--validation_ids", help="Location of file with validation ids.")
     parser.add_argument("--test_ids", help="Location of file with test ids.")
+    parser.add_argument(
+        "--output_format", default="store", choices=["store", "json"], help="Single sentence store or JSON files."
+    )
+    parser.add_argument("--batch_size", type=int, default=256, help="Number of texts per spaCy batch.")
+    parser.add_argument("--n_process", type=int, default=1, help="Number of spaCy processes.")
 
     args = parser.parse_args()
     return args
 
 
+def clean_findings(section_text: str) -> str:
+    section_text = re.sub("\n", "", section_text)
+    section_text = re.sub(" +", " ", section_text)
+    return section_text
+
+
+def clean_impression(section_text: str) -> str:
+    section_text = re.sub(r"\n", "", section_text)
+    section_text = re.sub(r"\d+\.", "", section_text)
+    section_text = re.sub(" +", " ", section_text)
+    return section_text
+
+
+def write_sentence_store(output_dir: Path, studies: list, sentences: list) -> None:
+    """Write the list of sentences of each study to the sentence store format."""
+    sentence_offsets = [0]
+    study_offsets = [0]
+    with open(output_dir / "sentences.bin", "wb") as fp:
+        for list_of_sentences in sentences:
+            for sentence in list_of_sentences:
+                encoded = sentence.encode("utf-8")
+                fp.write(encoded)
+                sentence_offsets.append(sentence_offsets[-1] + len(encoded))
+            study_offsets.append(len(sentence_offsets) - 1)
+
+    np.save(output_dir / "sentence_offsets.npy", np.array(sentence_offsets, dtype=np.int64))
+    np.save(output_dir / "study_offsets.npy", np.array(study_offsets, dtype=np.int64))
+    with open(output_dir / "studies.json", "w") as f:
+        json.dump(studies, f)
+
+
 def main(args):
     output_dir = Path(args.output_dir)
     output_dir.mkdir(exist_ok=True)
 
+    # Index the sections by study once instead of filtering the whole dataframe for every study
     section_df = pd.read_csv(args.sectioned_file, sep=",")
-    nlp = spacy.load("en_core_web_sm")
+    section_df = section_df.drop_duplicates(subset="study", keep="last").set_index("study")
+    nlp = spacy.load("en_core_web_sm", disable=["ner", "lemmatizer"])
 
     train_df = pd.read_csv(args.training_ids, sep="\t")
     val_df = pd.read_csv(args.validation_ids, sep="\t")
     test_df = pd.read_csv(args.test_ids, sep="\t")
 
     ids_df = pd.concat([train_df, val_df, test_df], axis=0)
-
-    for index, row in tqdm(ids_df.iterrows(), total=ids_df.shape[0]):
-        selected_reports = section_df[section_df["study"] == f"s{str(row['study_id'])}"]
-        output_filename = output_dir / f"s{row['study_id']}.json"
-
-        if len(selected_reports) == 0:
-            data_dict = {"sentences": [""]}
-
-        elif len(selected_reports) == 1:
-            selected_report = selected_reports.iloc[0]
-            list_of_sentences = []
-            if not isinstance(selected_report["findings"], float):
-                section_text = selected_report["findings"]
-                section_text = re.sub("\n", "", section_text)
-                section_text = re.sub(" +", " ", section_text)
-                doc = nlp(section_text)
-                for sent in doc.sents:
-                    if len(sent.text) > 2:
-                        list_of_sentences.append(sent.text)
-
-            if not isinstance(selected_report["impression"], float):
-                section_text = selected_report["impression"]
-                section_text = re.sub(r"\n", "", section_text)
-                section_text = re.sub(r"\d+\.", "", section_text)
-                section_text = re.sub(" +", " ", section_text)
-                doc = nlp(section_text)
-                for sent in doc.sents:
-                    if len(sent.text) > 2:
-                        list_of_sentences.append(sent.text)
-
-            # save dict as json file
-            if len(list_of_sentences) > 0:
-                data_dict = {"sentences": list_of_sentences}
-
-            else:
-                data_dict = {"sentences": [""]}
-
-        with open(output_filename, "w") as f:
-            json.dump(data_dict, f, indent=4)
+    studies = [f"s{study_id}" for study_id in ids_df["study_id"].drop_duplicates()]
+    selected_reports = section_df.reindex(studies)
+
+    # Collect the texts of all studies, keeping track of the study they belong to
+    texts = []
+    text_study_idx = []
+    for study_idx, (findings, impression) in enumerate(
+        zip(selected_reports["findings"], selected_reports["impression"])
+    ):
+        if not isinstance(findings, float):
+            texts.append(clean_findings(findings))
+            text_study_idx.append(study_idx)
+        if not isinstance(impression, float):
+            texts.append(clean_impression(impression))
+            text_study_idx.append(study_idx)
+
+    sentences = [[] for _ in studies]
+    docs = nlp.pipe(texts, batch_size=args.batch_size, n_process=args.n_process)
+    for study_idx, doc in tqdm(zip(text_study_idx, docs), total=len(texts)):
+        for sent in doc.sents:
+            if len(sent.text) > 2:
+                sentences[study_idx].append(sent.text)
+
+    sentences = [list_of_sentences if len(list_of_sentences) > 0 else [""] for list_of_sentences in sentences]
+
+    if args.output_format == "store":
+        write_sentence_store(output_dir, studies, sentences)
+    else:
+        for study, list_of_sentences in zip(studies, sentences):
+            with open(output_dir / f"{study}.json", "w") as f:
+                json.dump({"sentences": list_of_sentences}, f, indent=4)
 
 
 if __name__ == "__main__":
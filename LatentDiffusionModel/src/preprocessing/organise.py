@@ -1,31 +1,202 @@
 """ Script to organise and downsampling the images from the dataset.
 
 During resizing, the smaller edge of the image will be matched to this number.
+
+The images are processed by a pool of worker processes. Every finished image is appended to a progress manifest
+(manifest.tsv in the output directory), so an interrupted run can be restarted and will skip the images already done.
+JPEGs are decoded in draft mode, i.e. the decoder directly produces a reduced-size image (1/2, 1/4 or 1/8 scale) that is
+still larger than the target size, before the final resize.
+
+The output can be written as individual images mirroring the source tree (default) or, with --output_format arrays,
+packed into the array shards read by the training and testing loaders (LoadArrayShardd, see get_load_transforms): the
+first channel of each resized image is stored uncompressed in raw_dir/arrays/shard_*.bin, and raw_dir/arrays/index.json
+gives the shard, byte offset, shape and dtype of each image file name, as written by create_carm_dataset.py. The index
+entries of each shard are saved next to it (shard_*.json) and merged into index.json at the end of every run, so an
+interrupted run is completed by the next one.
 """
-from pathlib import Path
-from torchvision.transforms import Resize
-from torchvision.datasets.folder import default_loader
+import argparse
+import json
+import os
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+MANIFEST_NAME = "manifest.tsv"
+ARRAYS_DIR = "arrays"
+# byte alignment of the images in the array shards, as in create_carm_dataset.py
+ALIGNMENT = 64
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--source_dir", default="/sourcedata/", help="Path to the MIMIC-CXR-JPG files.")
+    parser.add_argument("--raw_dir", default="/rawdata/", help="Path to save the organised images.")
+    parser.add_argument("--size", type=int, default=512, help="Size of the smaller edge after resizing.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Number of worker processes.")
+    parser.add_argument(
+        "--output_format", default="jpg", choices=["jpg", "arrays"], help="Write single images or array shards."
+    )
+    parser.add_argument("--shard_size", type=int, default=1000, help="Number of images per shard.")
+    parser.add_argument("--quality", type=int, default=95, help="JPEG quality of the saved images.")
+
+    args = parser.parse_args()
+    return args
+
+
+def load_resized(image_file: Path, size: int) -> Image.Image:
+    """Load an image with the smaller edge resized to `size`, using JPEG draft mode to decode at reduced scale."""
+    image = Image.open(image_file)
+    width, height = image.size
+    scale = size / min(width, height)
+    if scale < 1:
+        # draft() picks the largest reduction that keeps the image at least as big as the requested size
+        image.draft("RGB", (int(width * scale), int(height * scale)))
+        width, height = image.size
+        scale = size / min(width, height)
+
+    image = image.convert("RGB")
+    new_size = (round(width * scale), round(height * scale))
+    if new_size != image.size:
+        image = image.resize(new_size, Image.BILINEAR)
+    return image
+
+
+def process_image(image_file: Path, source_dir: Path, raw_dir: Path, size: int, quality: int):
+    image = load_resized(image_file, size)
+
+    new_dir = raw_dir / image_file.relative_to(source_dir).parent
+    new_dir.mkdir(parents=True, exist_ok=True)
+    image.save(new_dir / image_file.name, quality=quality)
+    return [(str(image_file.relative_to(source_dir)), image.height, image.width)]
+
+
+def process_shard(image_files: list, source_dir: Path, raw_dir: Path, size: int, shard_name: str):
+    """Write a list of images into a single array shard, in the layout read by LoadArrayShardd. The shard is written to
+    a temporary file and renamed at the end, so a shard in raw_dir is always complete, and its index entries are saved
+    in a JSON file of the same name."""
+    shard_path = raw_dir / ARRAYS_DIR / shard_name
+    tmp_path = shard_path.with_name(shard_path.name + ".tmp")
+
+    rows = []
+    index = {}
+    offset = 0
+    with open(tmp_path, "wb") as fp:
+        for image_file in image_files:
+            # the first channel in the display orientation, as the loaders keep it
+            data = np.ascontiguousarray(np.asarray(load_resized(image_file, size))[..., 0])
+            padding = -offset % ALIGNMENT
+            fp.write(b"\0" * padding)
+            offset += padding
+            fp.write(data.tobytes())
+            index[image_file.name] = {
+                "shard": shard_name,
+                "offset": offset,
+                "shape": list(data.shape),
+                "dtype": data.dtype.str,
+            }
+            offset += data.nbytes
+
+            rows.append((str(image_file.relative_to(source_dir)), data.shape[0], data.shape[1], shard_name))
+
+    with open(shard_path.with_suffix(".json.tmp"), "w") as fp:
+        json.dump(index, fp)
+    os.replace(shard_path.with_suffix(".json.tmp"), shard_path.with_suffix(".json"))
+    os.replace(tmp_path, shard_path)
+    return rows
+
+
+def write_arrays_index(arrays_dir: Path) -> None:
+    """Merge the index entries of all the shards into index.json, the index read by LoadArrayShardd."""
+    index = {}
+    for shard_index_path in sorted(arrays_dir.glob("shard_*.json")):
+        if shard_index_path.with_suffix(".bin").exists():
+            with open(shard_index_path, "r") as fp:
+                index.update(json.load(fp))
+
+    tmp_path = arrays_dir / "index.json.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(index, fp)
+    os.replace(tmp_path, arrays_dir / "index.json")
+    print(f"{len(index)} images listed in {arrays_dir / 'index.json'}")
+
+
+def read_manifest(manifest_path: Path) -> tuple:
+    """Return the set of images already processed and the names of the shards already written."""
+    done = set()
+    shards = set()
+    if manifest_path.exists():
+        with open(manifest_path, "r") as fp:
+            for line in fp:
+                row = line.rstrip("\n").split("\t")
+                done.add(row[0])
+                if len(row) > 3:
+                    shards.add(row[3])
+    return done, shards
+
+
+def get_first_shard_index(shards_dir: Path, shards: set) -> int:
+    """Index after the largest index of the shards in the manifest or on disk. The shards of an interrupted run finish
+    in any order, so their number is not the next free index."""
+    names = set(shards) | {path.name for path in shards_dir.glob("shard_*")}
+    indices = [name.split(".")[0][len("shard_") :] for name in names]
+    return max((int(i) for i in indices if i.isdigit()), default=-1) + 1
+
+
+def main(args):
+    source_dir = Path(args.source_dir)
+    raw_dir = Path(args.raw_dir)
+    raw_dir.mkdir(parents=True, exist_ok=True)
 
+    manifest_path = raw_dir / MANIFEST_NAME
+    done, shards = read_manifest(manifest_path)
 
-def main():
-    source_dir = Path('/sourcedata/')
-    raw_dir = Path('/rawdata/')
+    image_files = sorted(source_dir.glob("**/*.jpg"))
+    image_files = [f for f in image_files if str(f.relative_to(source_dir)) not in done]
+    print(f"{len(done)} images already processed, {len(image_files)} remaining.")
 
-    resize_fn = Resize(512)
+    with open(manifest_path, "a") as manifest, ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        if args.output_format == "jpg":
+            futures = [
+                executor.submit(process_image, image_file, source_dir, raw_dir, args.size, args.quality)
+                for image_file in image_files
+            ]
+        else:
+            (raw_dir / ARRAYS_DIR).mkdir(exist_ok=True)
+            # new shards are numbered after the ones from previous runs
+            first_shard = get_first_shard_index(raw_dir / ARRAYS_DIR, shards)
+            futures = [
+                executor.submit(
+                    process_shard,
+                    image_files[i : i + args.shard_size],
+                    source_dir,
+                    raw_dir,
+                    args.size,
+                    f"shard_{first_shard + i // args.shard_size:05d}.bin",
+                )
+                for i in range(0, len(image_files), args.shard_size)
+            ]
 
-    for image_file in source_dir.glob('**/*.jpg'):
-        image = default_loader(image_file)
-        new_image = resize_fn(image)
+        with tqdm(total=len(image_files)) as pbar:
+            for future in as_completed(futures):
+                rows = future.result()
+                for row in rows:
+                    manifest.write("\t".join(str(r) for r in row) + "\n")
+                manifest.flush()
+                pbar.update(len(rows))
 
-        new_dir = raw_dir / image_file.relative_to("/sourcedata/").parent
-        new_dir.mkdir(parents=True, exist_ok=True)
-        new_image.save(new_dir / image_file.name)
+    if args.output_format == "arrays":
+        write_arrays_index(raw_dir / ARRAYS_DIR)
 
     # Unzip medical reports into raw_dir
-    with zipfile.ZipFile(source_dir / "mimic-cxr-reports.zip", 'r') as zip_ref:
+    with zipfile.ZipFile(source_dir / "mimic-cxr-reports.zip", "r") as zip_ref:
         zip_ref.extractall(raw_dir)
 
 
-if __name__ == '__main__':
-    main()
\ No newline at end of file
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
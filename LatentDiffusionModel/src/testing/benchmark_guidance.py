@@ -0,0 +1,134 @@
+""" Script to benchmark the classifier-free guidance schedules of sample_images.py.
+
+For each guidance configuration, the same seeds are sampled and we report the throughput (images/s and UNet
+evaluations per image) and the similarity to the images sampled with full CFG (MS-SSIM and mean absolute error).
+
+The configurations are given as:
+ - full: CFG at every step (reference).
+ - interval:LOW:HIGH: CFG only for LOW <= t <= HIGH.
+ - cutoff:T: CFG only for t >= T.
+ - reuse:K: unconditional prediction computed every K steps.
+Options can be combined with "+", e.g. "cutoff:200+reuse:2".
+"""
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+from generative.metrics import MultiScaleSSIMMetric
+from monai.utils import set_determinism
+from sample_images import decode, get_prompt_embeds, get_text_encoder, load_models, sample_latent
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--output_dir", default="outputs/benchmark_guidance/", help="Path to save the results.")
+    parser.add_argument("--stage1_path", default="runs/AE_KL/final_model.pth", help="Path to the .pth/.safetensors model from the stage1.")
+    parser.add_argument("--diffusion_path", default="runs/LDM/best_model.pth", help="Path to the .pth/.safetensors model from the diffusion model.")
+    parser.add_argument("--stage1_config_file_path", default="configs/stage1/aekl_v0.yaml", help="Path to the .yaml for the stage1.")
+    parser.add_argument("--diffusion_config_file_path", default="configs/ldm/ldm_v0.yaml", help="Path to the .yaml for the diffusion model.")
+    parser.add_argument("--n_seeds", type=int, default=16, help="Number of images per configuration.")
+    parser.add_argument("--prompt", default="This is an X-ray image taken by a C-arm, covering 4 vertebrae, namely L1, L2, L3 and L4.", type=str, help="prompt text.")
+    parser.add_argument("--guidance_scale", type=float, default=7.0, help="")
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        default=["full", "cutoff:200", "cutoff:400", "interval:200:800", "reuse:2", "reuse:3", "cutoff:200+reuse:2"],
+        help="Guidance configurations to benchmark.",
+    )
+    parser.add_argument("--x_size", type=int, default=64, help="Latent space x size.")
+    parser.add_argument("--y_size", type=int, default=64, help="Latent space y size.")
+    parser.add_argument("--scale_factor", default=0.3, type=float, help="signal-to-noise ratio. Should be keep with training precess.")
+    parser.add_argument("--num_inference_steps", type=int, default=200, help="time steps for the diffusion model in DDIM.")
+
+    args = parser.parse_args()
+    return args
+
+
+def parse_guidance_config(config: str) -> dict:
+    kwargs = {}
+    for option in config.split("+"):
+        name, *values = option.split(":")
+        if name == "interval":
+            kwargs["guidance_interval"] = (int(values[0]), int(values[1]))
+        elif name == "cutoff":
+            kwargs["guidance_cutoff"] = int(values[0])
+        elif name == "reuse":
+            kwargs["uncond_reuse_steps"] = int(values[0])
+        elif name != "full":
+            raise ValueError(f"Unknown guidance configuration {option}")
+    return kwargs
+
+
+def main(args):
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+
+    device = torch.device("cuda")
+    stage1, diffusion, scheduler, config = load_models(args, device)
+    tokenizer, text_encoder = get_text_encoder()
+    prompt_embeds = get_prompt_embeds(tokenizer, text_encoder, ["", args.prompt], device)
+
+    ms_ssim = MultiScaleSSIMMetric(spatial_dims=2, data_range=1.0)
+
+    # Untimed warm-up sample, so the CUDA context, cuDNN autotuning and allocator start-up are not charged to the
+    # first (reference) configuration
+    noise = torch.randn((1, config["ldm"]["params"]["in_channels"], args.x_size, args.y_size)).to(device)
+    latent, _ = sample_latent(
+        diffusion, scheduler, noise, prompt_embeds, guidance_scale=args.guidance_scale, progress_bar=False
+    )
+    decode(stage1, latent, args.scale_factor)
+
+    references = None
+    results = []
+    for guidance_config in ["full"] + [c for c in args.configs if c != "full"]:
+        kwargs = parse_guidance_config(guidance_config)
+
+        images = []
+        total_evaluations = 0
+        torch.cuda.synchronize()
+        start = time.time()
+        for seed in range(args.n_seeds):
+            set_determinism(seed=seed)
+            noise = torch.randn((1, config["ldm"]["params"]["in_channels"], args.x_size, args.y_size)).to(device)
+            latent, n_evaluations = sample_latent(
+                diffusion,
+                scheduler,
+                noise,
+                prompt_embeds,
+                guidance_scale=args.guidance_scale,
+                progress_bar=False,
+                **kwargs,
+            )
+            images.append(decode(stage1, latent, args.scale_factor))
+            total_evaluations += n_evaluations
+        torch.cuda.synchronize()
+        elapsed = time.time() - start
+
+        images = torch.from_numpy(np.concatenate(images)).float()[:, None] / 255.0
+        if references is None:
+            references = images
+
+        results.append(
+            {
+                "config": guidance_config,
+                "images_per_second": args.n_seeds / elapsed,
+                "unet_evaluations_per_image": total_evaluations / args.n_seeds,
+                "ms_ssim_to_full_cfg": ms_ssim(images.to(device), references.to(device)).mean().item(),
+                "mae_to_full_cfg": (images - references).abs().mean().item(),
+            }
+        )
+        print(results[-1])
+
+    results_df = pd.DataFrame(results)
+    results_df["speedup"] = results_df["images_per_second"] / results_df["images_per_second"].iloc[0]
+    results_df.to_csv(output_dir / "benchmark_guidance.tsv", index=False, sep="\t")
+    print(results_df.to_string(index=False))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
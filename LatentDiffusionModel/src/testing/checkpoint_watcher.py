@@ -0,0 +1,273 @@
+""" Script to evaluate the checkpoints of a LDM run while it is training.
+
+The watcher polls --run_dir for new versions of checkpoint.pth and best_model.pth (a file is taken once it has not
+changed for --settle_seconds). Each new version is evaluated in a separate low-priority process (nice --nice, at most
+--max_concurrent at the same time, on --device, "cpu" by default so the trainer keeps the accelerator): the images of a
+fixed set of --n_samples seeds are generated with the prompt, saved in checkpoint_eval/ of the run directory, and
+compared with a subsample of the test set:
+ - fid, precision, recall, density, coverage: on the DenseNet features of compute_fid.py, the test features being
+   computed once and cached in --feature_cache_dir.
+ - ms_ssim: mean MS-SSIM between --n_msssim_pairs random pairs of samples (diversity, lower is more diverse).
+With a small seed set these values are biased, but comparable between the checkpoints of a run.
+
+The metrics are appended to checkpoint_metrics.csv in the run directory and logged to its TensorBoard (checkpoint_eval/)
+at the epoch of the checkpoint. Only the newest version of each file waits for a free slot, older ones are skipped. The
+evaluated versions are read back from the CSV, so the watcher can be restarted; it stops once final_model.pth exists
+and everything is evaluated (or after one pass with --once).
+
+All the arguments of sample_images.py are accepted (the models are given by the config files and --stage1_path), including
+the tiled sampling of --tile_size.
+"""
+import itertools
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+from monai.utils import set_determinism
+from sample_images import get_parser, get_prompt_embeds, get_text_encoder, load_models, sample_and_decode
+from sample_writer import SampleWriter
+from tensorboardX import SummaryWriter
+
+WATCHED_FILES = ("checkpoint.pth", "best_model.pth")
+CSV_COLUMNS = [
+    "checkpoint",
+    "mtime_ns",
+    "output_dir",
+    "time",
+    "status",
+    "epoch",
+    "step",
+    "fid",
+    "precision",
+    "recall",
+    "density",
+    "coverage",
+    "ms_ssim",
+]
+
+
+def parse_args():
+    parser = get_parser()
+
+    parser.add_argument("--run_dir", default="runs/LDM", help="Location of the run to watch.")
+    parser.add_argument("--dataset_path", default="datasets/XrayGenerationDataset", help="Location of dataset.")
+    parser.add_argument("--n_samples", type=int, default=64, help="Number of samples per checkpoint (seeds start_seed...).")
+    parser.add_argument("--batch_size", type=int, default=8, help="Number of samples generated at once.")
+    parser.add_argument("--upper_limit", type=int, default=1000, help="Number of test images (stratified subsample).")
+    parser.add_argument("--k", type=int, default=5, help="Number of neighbours of the precision/recall and density/coverage.")
+    parser.add_argument("--n_msssim_pairs", type=int, default=100, help="Number of pairs of samples of the MS-SSIM.")
+    parser.add_argument("--feature_cache_dir", default="runs/feature_cache", help="Location of the feature cache (empty: no cache).")
+    parser.add_argument("--device", default="cpu", help="Device of the evaluations.")
+    parser.add_argument("--max_concurrent", type=int, default=1, help="Maximum number of evaluations at the same time.")
+    parser.add_argument("--num_threads", type=int, default=4, help="Number of CPU threads of each evaluation.")
+    parser.add_argument("--num_workers", type=int, default=4, help="Number of loader workers")
+    parser.add_argument("--nice", type=int, default=19, help="Niceness of the evaluation processes.")
+    parser.add_argument("--poll_interval", type=float, default=60.0, help="Seconds between checks of the run directory.")
+    parser.add_argument("--settle_seconds", type=float, default=10.0, help="Seconds a file must be unchanged before it is evaluated.")
+    parser.add_argument("--once", action="store_true", help="Evaluate the current checkpoints and exit.")
+    parser.set_defaults(num_inference_steps=50)
+
+    args = parser.parse_args()
+    return args
+
+
+def strip_module_prefix(state_dict: dict) -> dict:
+    """Remove the "module." prefix of the weights saved from a DataParallel model."""
+    return {k[len("module.") :] if k.startswith("module.") else k: v for k, v in state_dict.items()}
+
+
+def get_best_epoch(run_dir: Path) -> int:
+    """Epoch of the best validation loss in val_loss.csv, i.e. the epoch of best_model.pth (-1 if unknown)."""
+    csv_path = run_dir / "val_loss.csv"
+    if not csv_path.exists():
+        return -1
+    df = pd.read_csv(csv_path)
+    return int(df.loc[df["loss"].idxmin(), "epoch"]) if len(df) > 0 else -1
+
+
+@torch.no_grad()
+def compute_metrics(samples: torch.Tensor, args, device) -> dict:
+    """Metrics of the samples, (N, 1, H, W) images in [0, 1], against the test set."""
+    import torchxrayvision as xrv
+    from generative.metrics import FIDMetric, MultiScaleSSIMMetric
+    from prdc import compute_prdc
+    from util import get_densenet_features, get_test_features
+
+    model = xrv.models.DenseNet(weights="densenet121-res224-all")
+    model = model.to(device)
+    model.eval()
+
+    fake_features = torch.cat(
+        [
+            get_densenet_features(model, samples[i : i + args.batch_size].to(device)).cpu()
+            for i in range(0, len(samples), args.batch_size)
+        ]
+    )
+    real_features = get_test_features(
+        model,
+        dataset_path=args.dataset_path,
+        upper_limit=args.upper_limit,
+        seed=args.seed,
+        device=device,
+        num_workers=args.num_workers,
+        cache_dir=args.feature_cache_dir or None,
+    )
+
+    metrics = {"fid": FIDMetric()(fake_features, real_features).item()}
+    metrics.update(compute_prdc(real_features, fake_features, k=args.k, device=device))
+
+    ms_ssim = MultiScaleSSIMMetric(spatial_dims=2, data_range=1.0)
+    # uniform subsample of all the pairs, the same for every checkpoint (the first pairs would all hold sample 0)
+    pairs = list(itertools.combinations(range(len(samples)), 2))
+    rng = np.random.default_rng(args.seed)
+    pair_ids = rng.choice(len(pairs), size=min(args.n_msssim_pairs, len(pairs)), replace=False)
+    pairs = [pairs[pair_id] for pair_id in np.sort(pair_ids)]
+    metrics["ms_ssim"] = float(
+        np.mean([ms_ssim(samples[i : i + 1].to(device), samples[j : j + 1].to(device)).item() for i, j in pairs])
+    )
+    return metrics
+
+
+def evaluate_checkpoint(checkpoint_path: str, output_dir: str, args) -> None:
+    """Generate the samples of a checkpoint and save them with their metrics.json in output_dir."""
+    os.nice(args.nice)
+    torch.set_num_threads(args.num_threads)
+    device = torch.device(args.device)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    if "diffusion" in checkpoint:
+        epoch, step = checkpoint["epoch"], checkpoint.get("step", 0)
+        state_dict = checkpoint["diffusion"]
+    else:
+        epoch, step = get_best_epoch(Path(args.run_dir)), 0
+        state_dict = checkpoint
+    del checkpoint
+
+    stage1, diffusion, scheduler, config = load_models(args, device, diffusion_state_dict=strip_module_prefix(state_dict))
+    tokenizer, text_encoder = get_text_encoder()
+    prompt_embeds = get_prompt_embeds(tokenizer, text_encoder, ["", args.prompt.replace("_", " ")], device)
+
+    seeds = list(range(args.start_seed, args.start_seed + args.n_samples))
+    noise = []
+    for seed in seeds:
+        set_determinism(seed=seed)
+        noise.append(torch.randn((1, config["ldm"]["params"]["in_channels"], args.x_size, args.y_size)))
+    noise = torch.cat(noise)
+
+    images = []
+    for i in range(0, len(seeds), args.batch_size):
+        images.append(
+            sample_and_decode(
+                stage1,
+                diffusion,
+                scheduler,
+                noise[i : i + args.batch_size].to(device),
+                prompt_embeds,
+                args,
+                desc=f"{Path(checkpoint_path).name} samples {i + 1}-{min(i + args.batch_size, len(seeds))}",
+            )
+        )
+    images = np.concatenate(images)
+    del diffusion, stage1, text_encoder
+
+    with SampleWriter(output_dir, output_format="png") as writer:
+        for seed, image in zip(seeds, images):
+            writer.write(image, f"sample_{seed}", seed=seed, prompt=args.prompt, guidance_scale=args.guidance_scale)
+
+    samples = torch.from_numpy(images[:, None].astype(np.float32) / 255.0)
+    metrics = {"epoch": epoch, "step": step, **compute_metrics(samples, args, device)}
+    tmp_path = output_dir / "metrics.json.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(metrics, f)
+    os.replace(tmp_path, output_dir / "metrics.json")
+
+
+def main(args):
+    run_dir = Path(args.run_dir)
+    eval_dir = run_dir / "checkpoint_eval"
+    eval_dir.mkdir(exist_ok=True, parents=True)
+    csv_path = run_dir / "checkpoint_metrics.csv"
+    writer = SummaryWriter(log_dir=str(eval_dir))
+    os.nice(args.nice)
+
+    # versions (file name, modification time) already evaluated
+    evaluated = set()
+    if csv_path.exists():
+        evaluated = set(pd.read_csv(csv_path)[["checkpoint", "mtime_ns"]].itertuples(index=False, name=None))
+
+    ctx = mp.get_context("spawn")
+    waiting = {}
+    running = {}
+    while True:
+        # Check
+        for name in WATCHED_FILES:
+            path = run_dir / name
+            if not path.exists():
+                continue
+            mtime_ns = path.stat().st_mtime_ns
+            version = (name, mtime_ns)
+            if version in evaluated or any(v == version for v, _ in running.values()):
+                continue
+            if time.time() - mtime_ns / 1e9 < args.settle_seconds:
+                continue
+            # only the newest version of each file waits
+            waiting[name] = version
+
+        # Launch
+        while len(waiting) > 0 and len(running) < args.max_concurrent:
+            name, mtime_ns = waiting.pop(next(iter(waiting)))
+            output_dir = eval_dir / f"{Path(name).stem}_{mtime_ns}"
+            # a hard link keeps this version readable when the trainer replaces the file during the evaluation
+            snapshot_path = output_dir.with_suffix(".pth")
+            try:
+                os.link(run_dir / name, snapshot_path)
+            except OSError:
+                snapshot_path = run_dir / name
+            process = ctx.Process(target=evaluate_checkpoint, args=(str(snapshot_path), str(output_dir), args))
+            process.start()
+            running[process.pid] = ((name, mtime_ns), (process, output_dir, snapshot_path))
+            print(f"Evaluating {name} ({time.ctime(mtime_ns / 1e9)})")
+
+        # Collect
+        for pid, ((name, mtime_ns), (process, output_dir, snapshot_path)) in list(running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del running[pid]
+            evaluated.add((name, mtime_ns))
+            if snapshot_path != run_dir / name:
+                snapshot_path.unlink(missing_ok=True)
+
+            row = {"checkpoint": name, "mtime_ns": mtime_ns, "output_dir": output_dir.name, "time": time.time()}
+            row["status"] = "done" if process.exitcode == 0 else f"failed ({process.exitcode})"
+            if process.exitcode == 0:
+                with open(output_dir / "metrics.json", "r") as f:
+                    metrics = json.load(f)
+                row.update(metrics)
+                for k, v in metrics.items():
+                    if k not in ("epoch", "step"):
+                        writer.add_scalar(f"{Path(name).stem}/{k}", v, metrics["epoch"])
+                writer.flush()
+                print(f"{name} epoch {metrics['epoch']}: " + ", ".join(f"{k} {v:.4f}" for k, v in metrics.items()))
+            else:
+                print(f"Evaluation of {name} failed with exit code {process.exitcode}")
+            pd.DataFrame([row], columns=CSV_COLUMNS).to_csv(csv_path, mode="a", header=not csv_path.exists(), index=False)
+
+        idle = len(waiting) == 0 and len(running) == 0
+        if idle and (args.once or (run_dir / "final_model.pth").exists()):
+            break
+        time.sleep(args.poll_interval if not args.once else 1.0)
+
+    writer.close()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
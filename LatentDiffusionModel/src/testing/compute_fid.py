@@ -2,21 +2,22 @@
 
 In order to measure the quality of the samples, we use the Frechet Inception Distance (FID) metric between 1200 images
 from the MIMIC-CXR dataset and 1000 images from the LDM.
+
+The fidelity and the diversity of the samples are also measured separately with the k-NN precision, recall, density and
+coverage (see prdc.py) on the same DenseNet features. The features are cached in --feature_cache_dir, keyed by the
+test subsample and by the names, sizes and modification times of the sample files, so the test features are only
+computed once and an unchanged sample directory is not read again.
 """
 import argparse
 from pathlib import Path
 
 import torch
-import torch.nn.functional as F
 import torchxrayvision as xrv
 from generative.metrics import FIDMetric
-from monai import transforms
 from monai.config import print_config
-from monai.data import Dataset
 from monai.utils import set_determinism
-from torch.utils.data import DataLoader
-from tqdm import tqdm
-from util import get_test_dataloader
+from prdc import compute_prdc
+from util import get_cached_features, get_features, get_sample_dataloader, get_test_features
 
 
 def parse_args():
@@ -27,11 +28,19 @@ def parse_args():
     parser.add_argument("--dataset_path",default='datasets/iu_xray/', help="Location of dataset.")
     parser.add_argument("--batch_size", type=int, default=16, help="Batch size.")
     parser.add_argument("--num_workers", type=int, default=8, help="Number of loader workers")
+    parser.add_argument("--upper_limit", type=int, default=1000, help="Number of test images (stratified subsample).")
+    parser.add_argument("--k", type=int, default=5, help="Number of neighbours of the precision/recall and density/coverage.")
+    parser.add_argument("--feature_cache_dir", default="runs/feature_cache", help="Location of the feature cache (empty: no cache).")
 
     args = parser.parse_args()
     return args
 
 
+def stat_key(path: str) -> tuple:
+    stat = Path(path).stat()
+    return stat.st_size, stat.st_mtime_ns
+
+
 def main(args):
     set_determinism(seed=args.seed)
     print_config()
@@ -45,70 +54,40 @@ def main(args):
     model.eval()
 
     # Samples
-    samples_datalist = []
-    for sample_path in sorted(list(samples_dir.glob("*.jpg"))):
-        samples_datalist.append(
-            {
-                "image": str(sample_path),
-            }
-        )
-    print(f"{len(samples_datalist)} images found in {str(samples_dir)}")
-
-    sample_transforms = transforms.Compose(
-        [
-            transforms.LoadImaged(keys=["image"]),
-            transforms.EnsureChannelFirstd(keys=["image"]),
-            transforms.Rotate90d(keys=["image"], k=-1, spatial_axes=(0, 1)),  # Fix flipped image read
-            transforms.Flipd(keys=["image"], spatial_axis=1),  # Fix flipped image read
-            transforms.ToTensord(keys=["image"]),
-        ]
-    )
-
-    samples_ds = Dataset(
-        data=samples_datalist,
-        transform=sample_transforms,
-    )
-    samples_loader = DataLoader(
-        samples_ds,
-        batch_size=1,
-        shuffle=False,
-        num_workers=8,
-    )
-
-    samples_features = []
-    for batch in tqdm(samples_loader, desc='Get Features'):
-        img = batch["image"]
-        with torch.no_grad():
-            outputs = model.features(img.to(device))
-            outputs = F.adaptive_avg_pool2d(outputs, 1).squeeze(-1).squeeze(-1)  # Global average pooling
-
-        samples_features.append(outputs.cpu())
-    samples_features = torch.cat(samples_features, dim=0)
+    samples_loader = get_sample_dataloader(samples_dir, batch_size=args.batch_size, num_workers=args.num_workers)
+    sample_files = sorted({path for _, path, _ in samples_loader.dataset.items})
+
+    cache_dir = args.feature_cache_dir or None
+    samples_key = {
+        "model": "densenet121-res224-all",
+        # images in [0, 1] read by SampleDataset, the features cached before were computed on 0-255 jpg files
+        "loader": "SampleDataset",
+        "samples": [(path.name, *stat_key(path)) for path in sample_files],
+    }
+    samples_features = get_cached_features(cache_dir, samples_key, lambda: get_features(model, samples_loader, device))
 
     # Test set
-    test_loader = get_test_dataloader(
-        batch_size=1,
+    test_features = get_test_features(
+        model,
         dataset_path=args.dataset_path,
+        upper_limit=args.upper_limit,
+        seed=args.seed,
+        device=device,
         num_workers=args.num_workers,
-        upper_limit=1000,
+        cache_dir=cache_dir,
     )
 
-    test_features = []
-    for batch in tqdm(test_loader, desc='Get Features'):
-        img = batch["image"]
-        with torch.no_grad():
-            outputs = model.features(img.to(device))
-            outputs = F.adaptive_avg_pool2d(outputs, 1).squeeze(-1).squeeze(-1)  # Global average pooling
-
-        test_features.append(outputs.cpu())
-    test_features = torch.cat(test_features, dim=0)
-
     # Compute FID
     metric = FIDMetric()
     fid = metric(samples_features, test_features)
 
     print(f"FID: {fid:.6f}")
 
+    # Compute precision/recall and density/coverage
+    prdc = compute_prdc(test_features, samples_features, k=args.k, device=device)
+    for name, value in prdc.items():
+        print(f"{name.capitalize()}: {value:.6f}")
+
 
 if __name__ == "__main__":
     args = parse_args()
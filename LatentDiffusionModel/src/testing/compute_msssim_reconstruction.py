@@ -12,9 +12,8 @@ from generative.metrics import MultiScaleSSIMMetric
 from generative.networks.nets import AutoencoderKL
 from monai.config import print_config
 from monai.utils import set_determinism
-from omegaconf import OmegaConf
 from tqdm import tqdm
-from util import get_test_dataloader
+from util import get_test_dataloader, load_config, load_state_dict
 
 
 def parse_args():
@@ -48,10 +47,10 @@ def main(args):
 
     print("Creating model...")
     device = torch.device("cuda")
-    config = OmegaConf.load(args.config_file)
+    config = load_config(args.config_file, args.stage1_path)
     stage1 = AutoencoderKL(**config["stage1"]["params"])
-    stage1.load_state_dict(torch.load(args.stage1_path))
     stage1 = stage1.to(device)
+    stage1.load_state_dict(load_state_dict(args.stage1_path, device))
     stage1.eval()
 
     ms_ssim = MultiScaleSSIMMetric(spatial_dims=2, data_range=1.0)
@@ -11,10 +11,10 @@ import torch
 from generative.metrics import MultiScaleSSIMMetric
 from monai import transforms
 from monai.config import print_config
-from monai.data import CacheDataset
 from monai.utils import set_determinism
 from torch.utils.data import DataLoader
 from tqdm import tqdm
+from util import SharedCacheDataset
 
 
 def parse_args():
@@ -54,9 +54,10 @@ def main(args):
         ]
     )
 
-    eval_ds = CacheDataset(
+    eval_ds = SharedCacheDataset(
         data=datalist,
         transform=eval_transforms,
+        num_workers=args.num_workers,
     )
     eval_loader = DataLoader(
         eval_ds,
@@ -65,9 +66,11 @@ def main(args):
         num_workers=args.num_workers,
     )
 
-    eval_ds_2 = CacheDataset(
+    # same datalist and transform, reuses the cache of eval_ds
+    eval_ds_2 = SharedCacheDataset(
         data=datalist,
         transform=eval_transforms,
+        num_workers=args.num_workers,
     )
     eval_loader_2 = DataLoader(
         eval_ds_2,
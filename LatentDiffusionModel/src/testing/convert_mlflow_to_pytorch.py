@@ -1,12 +1,18 @@
-""" Script to convert the model from mlflow format to a format suitable for release (.pth).
+""" Script to convert the model from mlflow format to a format suitable for release (.safetensors or .pth).
 
-All the following scripts will use the .pth format (easly shared).
+All the following scripts will use the .safetensors/.pth format (easly shared).
+
+The safetensors files embed the configuration of the model (the stage1 or ldm section of the config file) in their
+metadata, so the models can be created without the config files, and they are memory-mapped when loaded (see
+load_state_dict in util.py).
 """
 import argparse
+import json
 from pathlib import Path
 
 import mlflow.pytorch
 import torch
+from omegaconf import OmegaConf
 
 
 def parse_args():
@@ -15,20 +21,50 @@ def parse_args():
     parser.add_argument("--stage1_mlflow_path", help="Path to the MLFlow artifact of the stage1.")
     parser.add_argument("--diffusion_mlflow_path", help="Path to the MLFlow artifact of the diffusion model.")
     parser.add_argument("--output_dir", help="Path to save the .pth file of the diffusion model.")
+    parser.add_argument("--stage1_config_file_path", default="configs/stage1/aekl_v0.yaml", help="Path to the .yaml for the stage1.")
+    parser.add_argument("--diffusion_config_file_path", default="configs/ldm/ldm_v0.yaml", help="Path to the .yaml for the diffusion model.")
+    parser.add_argument("--format", default="safetensors", choices=["safetensors", "pth"], help="Output format.")
+    parser.add_argument("--fp16", action="store_true", help="Save the floating point weights in half precision.")
 
     args = parser.parse_args()
     return args
 
 
+def save_model(model, output_path: Path, config: dict, fp16: bool = False) -> None:
+    state_dict = model.state_dict()
+    if fp16:
+        state_dict = {k: v.half() if v.is_floating_point() else v for k, v in state_dict.items()}
+
+    if output_path.suffix == ".safetensors":
+        from safetensors.torch import save_file
+
+        state_dict = {k: v.contiguous() for k, v in state_dict.items()}
+        save_file(state_dict, str(output_path), metadata={"config": json.dumps(config)})
+    else:
+        torch.save(state_dict, output_path)
+
+
 def main(args):
     output_dir = Path(args.output_dir)
     output_dir.mkdir(exist_ok=True)
 
+    stage1_config = OmegaConf.to_container(OmegaConf.load(args.stage1_config_file_path))
     stage1_model = mlflow.pytorch.load_model(args.stage1_mlflow_path)
-    torch.save(stage1_model.state_dict(), output_dir / "autoencoder.pth")
+    save_model(
+        stage1_model,
+        output_dir / f"autoencoder.{args.format}",
+        config={"stage1": stage1_config["stage1"]},
+        fp16=args.fp16,
+    )
 
+    diffusion_config = OmegaConf.to_container(OmegaConf.load(args.diffusion_config_file_path))
     diffusion_model = mlflow.pytorch.load_model(args.diffusion_mlflow_path)
-    torch.save(diffusion_model.state_dict(), output_dir / "diffusion_model.pth")
+    save_model(
+        diffusion_model,
+        output_dir / f"diffusion_model.{args.format}",
+        config={"ldm": diffusion_config["ldm"]},
+        fp16=args.fp16,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,233 @@
+""" Script to find the nearest training images of generated samples, to check that they are not copies of training
+images.
+
+The training images are embedded once, either with the DenseNet features used by compute_fid.py (--embedding densenet)
+or with the latents of the stage1 (--embedding stage1, z_mu average pooled to 16x16), and the L2-normalized embeddings
+are saved in --index_dir:
+ - features.npy: float32 embeddings, read memory-mapped.
+ - images.tsv: path and report of the training image of each row.
+ - index.faiss: HNSW index of the embeddings (inner product), only if faiss is installed.
+ - index.json: embedding and number of images of the index.
+The index is built only if index_dir does not have one (or with --rebuild), so it is reused by the next runs.
+
+The samples of --sample_dir are then embedded batch by batch and their --k nearest training images are searched with
+faiss, or without it with an exact blocked search over the memory-mapped embeddings. The cosine similarities of the
+neighbours are saved in memorization.tsv in the output directory, and the samples whose nearest neighbour has a
+similarity above --threshold are flagged and listed in flagged.tsv.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from monai.config import print_config
+from monai.utils import set_determinism
+from tqdm import tqdm
+from util import (
+    get_densenet_features,
+    get_iu_datalist_test,
+    get_sample_dataloader,
+    get_test_dataloader,
+    load_config,
+    load_state_dict,
+)
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--seed", type=int, default=2, help="Random seed to use.")
+    parser.add_argument("--index_dir", default="runs/memorization_index", help="Location of the index of the training set.")
+    parser.add_argument("--sample_dir", default=None, help="Location of the samples to check (only build the index if not given).")
+    parser.add_argument("--output_dir", default="outputs/memorization", help="Location to save the results.")
+    parser.add_argument("--dataset_path", default="datasets/XrayGenerationDataset", help="Location of dataset.")
+    parser.add_argument("--split", default="train", help="Split of the dataset indexed.")
+    parser.add_argument("--embedding", default="densenet", choices=["densenet", "stage1"], help="Embedding of the images.")
+    parser.add_argument("--stage1_path", default="runs/AE_KL/final_model.pth", help="Path to the stage1 model (stage1 embedding).")
+    parser.add_argument("--config_file", default="configs/stage1/aekl_v0.yaml", help="Path to the .yaml of the stage1.")
+    parser.add_argument("--k", type=int, default=5, help="Number of nearest neighbours of each sample.")
+    parser.add_argument("--threshold", type=float, default=0.95, help="Cosine similarity above which a sample is flagged.")
+    parser.add_argument("--rebuild", action="store_true", help="Build the index again even if it exists.")
+    parser.add_argument("--use_faiss", type=int, default=1, help="Use faiss if it is installed (0: exact search).")
+    parser.add_argument("--batch_size", type=int, default=16, help="Batch size.")
+    parser.add_argument("--num_workers", type=int, default=8, help="Number of loader workers")
+
+    args = parser.parse_args()
+    return args
+
+
+def get_embedder(args, device):
+    """Return a function mapping a batch of images to L2-normalized embeddings."""
+    if args.embedding == "densenet":
+        import torchxrayvision as xrv
+
+        model = xrv.models.DenseNet(weights="densenet121-res224-all")
+        model = model.to(device)
+        model.eval()
+
+        def embed(images: torch.Tensor) -> torch.Tensor:
+            return F.normalize(get_densenet_features(model, images), dim=1)
+
+    else:
+        from generative.networks.nets import AutoencoderKL
+
+        config = load_config(args.config_file, args.stage1_path)
+        stage1 = AutoencoderKL(**config["stage1"]["params"])
+        stage1 = stage1.to(device)
+        stage1.load_state_dict(load_state_dict(args.stage1_path, device))
+        stage1.eval()
+
+        @torch.no_grad()
+        def embed(images: torch.Tensor) -> torch.Tensor:
+            z_mu, _ = stage1.encode(images)
+            return F.normalize(F.adaptive_avg_pool2d(z_mu, 16).flatten(1), dim=1)
+
+    return embed
+
+
+def search_topk(index_features: np.ndarray, queries: np.ndarray, k: int, block_size: int = 65536) -> tuple:
+    """Exact top-k inner product search over blocks of rows of index_features, so the (memory-mapped) index is never
+    loaded at once. Returns the scores and the row ids of the neighbours, sorted by decreasing score."""
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    best_ids = np.empty((len(queries), 0), dtype=np.int64)
+    for start in range(0, len(index_features), block_size):
+        block = np.asarray(index_features[start : start + block_size], dtype=np.float32)
+        scores = np.concatenate([best_scores, queries @ block.T], axis=1)
+        ids = np.concatenate(
+            [best_ids, np.broadcast_to(np.arange(start, start + len(block)), (len(queries), len(block)))], axis=1
+        )
+        top = np.argpartition(-scores, min(k, scores.shape[1]) - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_ids = np.take_along_axis(ids, top, axis=1)
+
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_ids, order, axis=1)
+
+
+class MemorizationIndex:
+    """Nearest-neighbour index of the L2-normalized embeddings of the training images, saved in index_dir."""
+
+    def __init__(self, index_dir: str | Path, use_faiss: bool = True) -> None:
+        self.index_dir = Path(index_dir)
+        with open(self.index_dir / "index.json", "r") as f:
+            self.info = json.load(f)
+        self.features = np.load(self.index_dir / "features.npy", mmap_mode="r")
+        self.images = pd.read_csv(self.index_dir / "images.tsv", sep="\t")
+
+        self.faiss_index = None
+        if use_faiss and faiss is not None and (self.index_dir / "index.faiss").exists():
+            self.faiss_index = faiss.read_index(str(self.index_dir / "index.faiss"))
+            # breadth of the HNSW search, larger than the default for a better recall of the nearest neighbour
+            self.faiss_index.hnsw.efSearch = 128
+
+    @staticmethod
+    def exists(index_dir: str | Path) -> bool:
+        return (Path(index_dir) / "index.json").exists()
+
+    @staticmethod
+    def build(index_dir: str | Path, datalist, loader, embed, embedding: str, device) -> None:
+        """Embed the images of the loader (over datalist, not shuffled) into features.npy, written batch by batch, and
+        build the faiss index."""
+        index_dir = Path(index_dir)
+        index_dir.mkdir(exist_ok=True, parents=True)
+        for name in ["index.json", "index.faiss"]:
+            (index_dir / name).unlink(missing_ok=True)
+
+        features = None
+        offset = 0
+        for batch in tqdm(loader, desc="Build index"):
+            batch_features = embed(batch["image"].to(device)).cpu().numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(
+                    index_dir / "features.npy", mode="w+", dtype=np.float32, shape=(len(datalist), batch_features.shape[1])
+                )
+            features[offset : offset + len(batch_features)] = batch_features
+            offset += len(batch_features)
+        features.flush()
+
+        if faiss is not None:
+            index = faiss.IndexHNSWFlat(features.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+            index.add(np.ascontiguousarray(features))
+            faiss.write_index(index, str(index_dir / "index.faiss"))
+
+        images_df = pd.DataFrame(
+            {
+                "image": [str(datalist[i]["image"]) for i in range(len(datalist))],
+                "report": [datalist[i]["report"][0] for i in range(len(datalist))],
+            }
+        )
+        images_df.to_csv(index_dir / "images.tsv", sep="\t", index=False)
+        # written last, so an interrupted build is not taken for an index
+        with open(index_dir / "index.json", "w") as f:
+            json.dump({"embedding": embedding, "n_images": len(features), "dim": features.shape[1]}, f)
+
+    def search(self, queries: np.ndarray, k: int) -> tuple:
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if self.faiss_index is not None:
+            return self.faiss_index.search(queries, k)
+        return search_topk(self.features, queries, k)
+
+
+def main(args):
+    set_determinism(seed=args.seed)
+    print_config()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    embed = get_embedder(args, device)
+
+    if args.rebuild or not MemorizationIndex.exists(args.index_dir):
+        print(f"Building the index of the {args.split} set in {args.index_dir}...")
+        datalist = get_iu_datalist_test(args.dataset_path, args.split)
+        loader = get_test_dataloader(
+            batch_size=args.batch_size,
+            dataset_path=args.dataset_path,
+            num_workers=args.num_workers,
+            stream=True,
+            split=args.split,
+        )
+        MemorizationIndex.build(args.index_dir, datalist, loader, embed, args.embedding, device)
+
+    index = MemorizationIndex(args.index_dir, use_faiss=bool(args.use_faiss))
+    if index.info["embedding"] != args.embedding:
+        raise ValueError(f"The index of {args.index_dir} uses the {index.info['embedding']} embedding, not {args.embedding}.")
+    print(f"Index of {index.info['n_images']} images ({'faiss' if index.faiss_index is not None else 'exact search'}).")
+    if args.sample_dir is None:
+        return
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+
+    samples_loader = get_sample_dataloader(args.sample_dir, batch_size=args.batch_size, num_workers=args.num_workers)
+
+    rows = []
+    for batch in tqdm(samples_loader, desc="Query index"):
+        scores, ids = index.search(embed(batch["image"].to(device)).cpu().numpy(), args.k)
+        for name, sample_scores, sample_ids in zip(batch["name"], scores, ids):
+            row = {"sample": name}
+            for j, (score, i) in enumerate(zip(sample_scores, sample_ids)):
+                row[f"neighbour_{j}"] = index.images["image"].iloc[i]
+                row[f"similarity_{j}"] = float(score)
+            row["flagged"] = bool(sample_scores[0] > args.threshold)
+            rows.append(row)
+
+    results_df = pd.DataFrame(rows)
+    results_df.to_csv(output_dir / "memorization.tsv", sep="\t", index=False)
+    flagged_df = results_df[results_df["flagged"]]
+    flagged_df.to_csv(output_dir / "flagged.tsv", sep="\t", index=False)
+    print(f"Nearest neighbour similarity: mean {results_df['similarity_0'].mean():.4f}, max {results_df['similarity_0'].max():.4f}")
+    print(f"{len(flagged_df)} of {len(results_df)} samples above {args.threshold} listed in {output_dir / 'flagged.tsv'}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
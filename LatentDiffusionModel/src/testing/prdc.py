@@ -0,0 +1,59 @@
+""" Improved precision and recall [1] and density and coverage [2] between real and generated feature matrices.
+
+The metrics compare the k-nearest-neighbour balls of the features: precision and density measure how many generated
+samples fall in the balls of the real ones (fidelity), recall and coverage how much of the real distribution is reached
+by the generated samples (diversity). The pairwise distances are computed in blocks of block_size rows, so the full
+N x M distance matrix is never materialized.
+
+[1] Kynkäänniemi et al., "Improved Precision and Recall Metric for Assessing Generative Models", NeurIPS 2019.
+[2] Naeem et al., "Reliable Fidelity and Diversity Metrics for Generative Models", ICML 2020.
+"""
+from __future__ import annotations
+
+import torch
+
+
+def get_knn_radii(features: torch.Tensor, k: int, block_size: int = 1024) -> torch.Tensor:
+    """Distance of each feature vector to its k-th nearest neighbour in the same set."""
+    radii = []
+    for start in range(0, len(features), block_size):
+        distances = torch.cdist(features[start : start + block_size], features)
+        # the nearest neighbour of each vector is itself, at distance 0
+        radii.append(distances.kthvalue(k + 1, dim=1).values)
+    return torch.cat(radii)
+
+
+@torch.no_grad()
+def compute_prdc(
+    real_features: torch.Tensor,
+    fake_features: torch.Tensor,
+    k: int = 5,
+    block_size: int = 1024,
+    device: str | torch.device = "cpu",
+) -> dict:
+    """Precision, recall, density and coverage of the fake features with respect to the real features."""
+    real_features = real_features.to(device, torch.float64)
+    fake_features = fake_features.to(device, torch.float64)
+    real_radii = get_knn_radii(real_features, k, block_size)
+    fake_radii = get_knn_radii(fake_features, k, block_size)
+
+    precision_hits = torch.zeros(len(fake_features), dtype=torch.bool, device=device)
+    density_counts = torch.zeros(len(fake_features), dtype=torch.float64, device=device)
+    recall_hits = torch.zeros(len(real_features), dtype=torch.bool, device=device)
+    coverage_hits = torch.zeros(len(real_features), dtype=torch.bool, device=device)
+    for start in range(0, len(real_features), block_size):
+        stop = start + block_size
+        distances = torch.cdist(real_features[start:stop], fake_features)
+        # fake samples inside the k-NN ball of each real sample of the block
+        inside_real = distances <= real_radii[start:stop, None]
+        precision_hits |= inside_real.any(dim=0)
+        density_counts += inside_real.sum(dim=0)
+        coverage_hits[start:stop] = distances.min(dim=1).values <= real_radii[start:stop]
+        recall_hits[start:stop] = (distances <= fake_radii[None, :]).any(dim=1)
+
+    return {
+        "precision": precision_hits.double().mean().item(),
+        "recall": recall_hits.double().mean().item(),
+        "density": (density_counts.sum() / (k * len(fake_features))).item(),
+        "coverage": coverage_hits.double().mean().item(),
+    }
@@ -1,6 +1,29 @@
 """ Script to generate sample images from the diffusion model.
 
 In the generation of the images, the script is using a DDIM scheduler.
+
+Classifier-free guidance (CFG) doubles the batch of the UNet, so it can be scheduled to save compute:
+ - --guidance_interval LOW HIGH: CFG is only applied for timesteps LOW <= t <= HIGH, outside of it only the conditional
+   prediction is computed.
+ - --guidance_cutoff T: CFG is not applied for t < T (late steps, where it barely changes the result).
+ - --uncond_reuse_steps K: the unconditional prediction is only computed every K guided steps and reused in between.
+
+With --prompts_file, the script samples every prompt of the file from each seed by branching a shared trajectory: the
+first --branch_step steps (high noise, nearly prompt-independent) are run once per seed with --base_prompt ("" for
+unconditional), and the latent is then denoised for all the prompts at once in a single batch. The images are saved as
+sample_{seed}_{prompt index}, with the prompts listed in prompts.tsv.
+
+The images are written asynchronously by a SampleWriter (see sample_writer.py) in the --output_format: jpg, png, png16
+(16-bit PNG), or npz/tar shards of --shard_size images named after their first sample. index.json lists the file, seed,
+prompt and guidance scale of every image with the arguments of the runs: runs over other seed ranges into the same
+--output_dir are merged into it.
+
+With --tile_size, latents larger than the training size (e.g. --x_size 128 --y_size 128 for 1024x1024 images) are
+sampled MultiDiffusion-style: at every step, the UNet denoises overlapping windows of tile_size x tile_size latent
+pixels (every --tile_stride pixels, --tile_batch_size windows per batch) and their noise predictions are fused by a
+weighted average, with weights decreasing towards the borders of the windows to hide the seams. The latent is then
+decoded by tiles in the same way, so the memory of the UNet and of the decoder is bounded by the window size. The
+guidance options above apply to the tiled sampling as well.
 """
 
 import argparse
@@ -12,51 +35,64 @@ from generative.networks.nets import AutoencoderKL, DiffusionModelUNet
 from generative.networks.schedulers import DDIMScheduler
 from monai.config import print_config
 from monai.utils import set_determinism
-from omegaconf import OmegaConf
-from PIL import Image
+from sample_writer import FORMATS, SampleWriter, write_index
 from tqdm import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
+from util import load_config, load_state_dict
 
 
-def parse_args():
+def get_parser():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("--output_dir", default='sampled_images/', help="Path to save sampled images.")
-    parser.add_argument("--stage1_path",default='runs/AE_KL/final_model.pth',  help="Path to the .pth model from the stage1.")
-    parser.add_argument("--diffusion_path",default='runs/LDM/best_model.pth', help="Path to the .pth model from the diffusion model.")
+    parser.add_argument("--stage1_path",default='runs/AE_KL/final_model.pth',  help="Path to the .pth/.safetensors model from the stage1.")
+    parser.add_argument("--diffusion_path",default='runs/LDM/best_model.pth', help="Path to the .pth/.safetensors model from the diffusion model.")
     parser.add_argument("--stage1_config_file_path",default='configs/stage1/aekl_v0.yaml', help="Path to the .yaml for the stage1.")
     parser.add_argument("--diffusion_config_file_path", default='configs/ldm/ldm_v0.yaml', help="Path to the .yaml for the diffusion model.")
     parser.add_argument("--start_seed", default=1, type=int, help="random seed for the generation of the images.")
     parser.add_argument("--stop_seed", default=100, type=int, help="random seed for the generation of the images.")
     parser.add_argument("--prompt", default='This is an X-ray image taken by a C-arm, covering 4 vertebrae, namely L1, L2, L3 and L4.', type=str, help="prompt text.")
     parser.add_argument("--guidance_scale", type=float, default=7.0, help="")
+    parser.add_argument("--guidance_interval", type=int, nargs=2, default=None, help="Timesteps [LOW, HIGH] where CFG is applied.")
+    parser.add_argument("--guidance_cutoff", type=int, default=None, help="Timestep below which CFG is not applied.")
+    parser.add_argument("--uncond_reuse_steps", type=int, default=1, help="Compute the unconditional prediction every K guided steps.")
+    parser.add_argument("--prompts_file", default=None, help="Text file with one prompt per line, sampled from shared trajectories.")
+    parser.add_argument("--branch_step", type=int, default=0, help="Number of steps shared by all the prompts of a seed.")
+    parser.add_argument("--base_prompt", default="", type=str, help="Prompt of the shared steps, empty for unconditional.")
     parser.add_argument("--x_size", type=int, default=64, help="Latent space x size.")
     parser.add_argument("--y_size", type=int, default=64, help="Latent space y size.")
     parser.add_argument("--scale_factor", default=0.3, type=float, help="signal-to-noise ratio. Should be keep with training precess.")
     parser.add_argument("--num_inference_steps", type=int, default=500, help="time steps for the diffusion model in DDIM.")
+    parser.add_argument("--tile_size", type=int, default=None, help="Size of the latent windows of the tiled sampling (default: no tiling).")
+    parser.add_argument("--tile_stride", type=int, default=48, help="Stride of the latent windows of the tiled sampling.")
+    parser.add_argument("--tile_batch_size", type=int, default=4, help="Number of windows denoised at once.")
+    parser.add_argument("--output_format", default="jpg", choices=FORMATS, help="Format of the saved images.")
+    parser.add_argument("--shard_size", type=int, default=1000, help="Number of images per shard (npz and tar formats).")
+    parser.add_argument("--writer_threads", type=int, default=4, help="Number of threads writing the images.")
+    return parser
+
 
+def parse_args():
+    parser = get_parser()
     args = parser.parse_args()
     return args
 
 
-def main(args):
-    print_config()
-
-    output_dir = Path(args.output_dir)
-    output_dir.mkdir(exist_ok=True, parents=True)
-
-    device = torch.device("cuda")
-
-    config = OmegaConf.load(args.stage1_config_file_path)
+def load_models(args, device, diffusion_state_dict=None):
+    """Load the stage1, the diffusion model and its DDIM scheduler. The weights of the diffusion model are read from
+    args.diffusion_path, unless diffusion_state_dict is given."""
+    config = load_config(args.stage1_config_file_path, args.stage1_path)
     stage1 = AutoencoderKL(**config["stage1"]["params"])
-    stage1.load_state_dict(torch.load(args.stage1_path))
     stage1.to(device)
+    stage1.load_state_dict(load_state_dict(args.stage1_path, device))
     stage1.eval()
 
-    config = OmegaConf.load(args.diffusion_config_file_path)
+    config = load_config(args.diffusion_config_file_path, args.diffusion_path)
     diffusion = DiffusionModelUNet(**config["ldm"].get("params", dict()))
-    diffusion.load_state_dict(torch.load(args.diffusion_path))
     diffusion.to(device)
+    if diffusion_state_dict is None:
+        diffusion_state_dict = load_state_dict(args.diffusion_path, device)
+    diffusion.load_state_dict(diffusion_state_dict)
     diffusion.eval()
 
     scheduler = DDIMScheduler(
@@ -70,13 +106,19 @@ def main(args):
     if args.num_inference_steps is not None:
         scheduler.set_timesteps(args.num_inference_steps)
 
+    return stage1, diffusion, scheduler, config
+
+
+def get_text_encoder():
     tokenizer = CLIPTokenizer.from_pretrained("stabilityai/stable-diffusion-2-1-base", subfolder="tokenizer")
     text_encoder = CLIPTextModel.from_pretrained("stabilityai/stable-diffusion-2-1-base", subfolder="text_encoder")
+    return tokenizer, text_encoder
 
-    prompt = ["", args.prompt.replace("_", " ")] # "" for unconditional, text prompt for conditional
 
+@torch.no_grad()
+def get_prompt_embeds(tokenizer, text_encoder, prompts: list, device) -> torch.Tensor:
     text_inputs = tokenizer(
-        prompt,
+        prompts,
         padding="max_length",
         max_length=tokenizer.model_max_length,
         truncation=True,
@@ -85,31 +127,383 @@ def main(args):
     text_input_ids = text_inputs.input_ids
 
     prompt_embeds = text_encoder(text_input_ids.squeeze(1))
-    prompt_embeds = prompt_embeds[0].to(device)
+    return prompt_embeds[0].to(device)
 
-    for i in range(args.start_seed, args.stop_seed):
-        set_determinism(seed=i)
-        noise = torch.randn((1, config["ldm"]["params"]["in_channels"], args.x_size, args.y_size)).to(device)
 
-        with torch.no_grad():
-            progress_bar = tqdm(scheduler.timesteps,desc=f'Sample Image {i-args.start_seed+1}')
-            for t in progress_bar:
-                noise_input = torch.cat([noise] * 2)
+def guidance_active(t: int, guidance_interval=None, guidance_cutoff=None) -> bool:
+    if guidance_interval is not None and not guidance_interval[0] <= t <= guidance_interval[1]:
+        return False
+    if guidance_cutoff is not None and t < guidance_cutoff:
+        return False
+    return True
+
+
+@torch.no_grad()
+def sample_latent(
+    diffusion,
+    scheduler,
+    noise: torch.Tensor,
+    prompt_embeds: torch.Tensor,
+    guidance_scale: float,
+    guidance_interval=None,
+    guidance_cutoff=None,
+    uncond_reuse_steps: int = 1,
+    timesteps=None,
+    progress_bar: bool = True,
+    desc: str = "Sample Image",
+):
+    """Run the DDIM reverse process from `noise`.
+
+    prompt_embeds is the concatenation of the unconditional embeddings and the conditional ones (one per element of
+    the batch, or one for the whole batch). Returns the denoised latent and the number of UNet evaluations, counted in
+    batch elements.
+    """
+    n = noise.shape[0]
+    uncond_embeds, cond_embeds = prompt_embeds.chunk(2)
+    if uncond_embeds.shape[0] != n:
+        uncond_embeds = uncond_embeds.expand(n, -1, -1)
+        cond_embeds = cond_embeds.expand(n, -1, -1)
+
+    timesteps = scheduler.timesteps if timesteps is None else timesteps
+    n_evaluations = 0
+    n_guided_steps = 0
+    noise_pred_uncond = None
+    for t in tqdm(timesteps, desc=desc, disable=not progress_bar):
+        t_batch = torch.full((n,), int(t), device=noise.device, dtype=torch.long)
+        if guidance_scale == 1.0 or not guidance_active(int(t), guidance_interval, guidance_cutoff):
+            # CFG with scale 1 is the conditional prediction
+            noise_pred = diffusion(noise, timesteps=t_batch, context=cond_embeds)
+            n_evaluations += n
+        elif noise_pred_uncond is None or n_guided_steps % uncond_reuse_steps == 0:
+            model_output = diffusion(
+                torch.cat([noise] * 2), timesteps=torch.cat([t_batch] * 2), context=torch.cat([uncond_embeds, cond_embeds])
+            )
+            noise_pred_uncond, noise_pred_text = model_output.chunk(2)
+            noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+            n_evaluations += 2 * n
+            n_guided_steps += 1
+        else:
+            # Reuse the unconditional prediction of a previous step
+            noise_pred_text = diffusion(noise, timesteps=t_batch, context=cond_embeds)
+            noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+            n_evaluations += n
+            n_guided_steps += 1
+
+        noise, _ = scheduler.step(noise_pred, t, noise)
+
+    return noise, n_evaluations
+
+
+@torch.no_grad()
+def sample_branched(
+    diffusion,
+    scheduler,
+    noise: torch.Tensor,
+    uncond_embeds: torch.Tensor,
+    base_embeds: torch.Tensor,
+    branch_embeds: torch.Tensor,
+    branch_step: int,
+    guidance_scale: float,
+    unconditional_base: bool = True,
+    desc: str = "Sample Image",
+    **guidance_kwargs,
+):
+    """Denoise `noise` (batch of 1) for the first branch_step steps with base_embeds, then continue from that latent for
+    each of the prompts of branch_embeds, batched together. Returns one latent per prompt."""
+    timesteps = scheduler.timesteps
+    n_branches = branch_embeds.shape[0]
+
+    latent = noise
+    if branch_step > 0:
+        latent, _ = sample_latent(
+            diffusion,
+            scheduler,
+            noise,
+            torch.cat([uncond_embeds, base_embeds]),
+            # the unconditional base trajectory does not need guidance
+            guidance_scale=1.0 if unconditional_base else guidance_scale,
+            timesteps=timesteps[:branch_step],
+            desc=f"{desc} (shared)",
+            **guidance_kwargs,
+        )
+
+    latent, _ = sample_latent(
+        diffusion,
+        scheduler,
+        latent.repeat(n_branches, 1, 1, 1),
+        torch.cat([uncond_embeds.expand(n_branches, -1, -1), branch_embeds]),
+        guidance_scale=guidance_scale,
+        timesteps=timesteps[branch_step:],
+        desc=f"{desc} ({n_branches} branches)",
+        **guidance_kwargs,
+    )
+    return latent
+
+
+def get_tile_windows(size: int, tile_size: int, tile_stride: int) -> list:
+    """Start positions of the windows covering [0, size), the last one aligned with the end."""
+    if size <= tile_size:
+        return [0]
+    starts = list(range(0, size - tile_size + 1, tile_stride))
+    if starts[-1] != size - tile_size:
+        starts.append(size - tile_size)
+    return starts
+
+
+def get_tile_weights(height: int, width: int, device) -> torch.Tensor:
+    """Gaussian weights of a window (sigma of a quarter of its size), so the fused values fade across the overlaps."""
+    weights = []
+    for size in (height, width):
+        coords = torch.arange(size, dtype=torch.float32, device=device) - (size - 1) / 2
+        weights.append(torch.exp(-(coords**2) / (2 * (size / 4) ** 2)))
+    return weights[0][:, None] * weights[1][None, :]
+
+
+@torch.no_grad()
+def sample_tiled(
+    diffusion,
+    scheduler,
+    noise: torch.Tensor,
+    prompt_embeds: torch.Tensor,
+    guidance_scale: float,
+    tile_size: int,
+    tile_stride: int,
+    tile_batch_size: int = 4,
+    guidance_interval=None,
+    guidance_cutoff=None,
+    uncond_reuse_steps: int = 1,
+    progress_bar: bool = True,
+    desc: str = "Sample Image",
+) -> torch.Tensor:
+    """Run the DDIM reverse process from a `noise` larger than the training size with MultiDiffusion.
+
+    At every step, the noise predictions of the overlapping windows are fused by a weighted average before the
+    scheduler step. As the DDIM step is affine in the noise prediction, this is the same as fusing the denoised windows.
+    prompt_embeds is the concatenation of the unconditional and the conditional embeddings, and the guidance options
+    are the ones of sample_latent. The fusion being linear, the fused unconditional prediction is the one reused with
+    uncond_reuse_steps.
+    """
+    if tile_stride > tile_size:
+        raise ValueError(f"The windows do not cover the latent: tile_stride {tile_stride} > tile_size {tile_size}.")
+    n, _, height, width = noise.shape
+    uncond_embeds, cond_embeds = prompt_embeds.chunk(2)
+    if uncond_embeds.shape[0] != n:
+        uncond_embeds = uncond_embeds.expand(n, -1, -1)
+        cond_embeds = cond_embeds.expand(n, -1, -1)
+
+    tile_height, tile_width = min(tile_size, height), min(tile_size, width)
+    windows = [
+        (y, x)
+        for y in get_tile_windows(height, tile_size, tile_stride)
+        for x in get_tile_windows(width, tile_size, tile_stride)
+    ]
+    weights = get_tile_weights(tile_height, tile_width, noise.device)
+    weight_sum = torch.zeros((height, width), device=noise.device)
+    for y, x in windows:
+        weight_sum[y : y + tile_height, x : x + tile_width] += weights
+
+    n_guided_steps = 0
+    noise_pred_uncond = None
+    for t in tqdm(scheduler.timesteps, desc=f"{desc} ({len(windows)} windows)", disable=not progress_bar):
+        guided = guidance_scale != 1.0 and guidance_active(int(t), guidance_interval, guidance_cutoff)
+        compute_uncond = guided and (noise_pred_uncond is None or n_guided_steps % uncond_reuse_steps == 0)
+        noise_pred_text = torch.zeros_like(noise)
+        if compute_uncond:
+            noise_pred_uncond = torch.zeros_like(noise)
+        for i in range(0, len(windows), tile_batch_size):
+            batch_windows = windows[i : i + tile_batch_size]
+            tiles = torch.cat([noise[:, :, y : y + tile_height, x : x + tile_width] for y, x in batch_windows])
+            m = tiles.shape[0]
+            t_batch = torch.full((m,), int(t), device=noise.device, dtype=torch.long)
+            context = cond_embeds.repeat(len(batch_windows), 1, 1)
+            if compute_uncond:
                 model_output = diffusion(
-                    noise_input, timesteps=torch.Tensor((t,)).to(noise.device).long(), context=prompt_embeds
+                    torch.cat([tiles] * 2),
+                    timesteps=torch.cat([t_batch] * 2),
+                    context=torch.cat([uncond_embeds.repeat(len(batch_windows), 1, 1), context]),
                 )
-                noise_pred_uncond, noise_pred_text = model_output.chunk(2)
-                noise_pred = noise_pred_uncond + args.guidance_scale * (noise_pred_text - noise_pred_uncond)
+                pred_uncond, pred_text = model_output.chunk(2)
+            else:
+                pred_text = diffusion(tiles, timesteps=t_batch, context=context)
+
+            for j, (y, x) in enumerate(batch_windows):
+                window = (slice(None), slice(None), slice(y, y + tile_height), slice(x, x + tile_width))
+                noise_pred_text[window] += pred_text[j * n : (j + 1) * n] * weights
+                if compute_uncond:
+                    noise_pred_uncond[window] += pred_uncond[j * n : (j + 1) * n] * weights
 
-                noise, _ = scheduler.step(noise_pred, t, noise)
+        noise_pred = noise_pred_text / weight_sum
+        if compute_uncond:
+            noise_pred_uncond = noise_pred_uncond / weight_sum
+        if guided:
+            # with uncond_reuse_steps > 1, noise_pred_uncond can be the one of a previous guided step
+            noise_pred = noise_pred_uncond + guidance_scale * (noise_pred - noise_pred_uncond)
+            n_guided_steps += 1
 
-        with torch.no_grad():
-            sample = stage1.decode_stage_2_outputs(noise / args.scale_factor)
+        noise, _ = scheduler.step(noise_pred, t, noise)
 
-        sample = np.clip(sample.cpu().numpy(), 0, 1)
+    return noise
+
+
+def to_images(sample: torch.Tensor, bit_depth: int = 8) -> np.ndarray:
+    """Convert decoded images in [0, 1] to uint8 (uint16 with bit_depth=16) arrays of shape (B, H, W)."""
+    sample = np.clip(sample.cpu().numpy(), 0, 1)
+    if bit_depth == 16:
+        sample = (sample * 65535).astype(np.uint16)
+    else:
         sample = (sample * 255).astype(np.uint8)
-        im = Image.fromarray(sample[0, 0])
-        im.save(output_dir / f"sample_{i}.jpg")
+    return sample[:, 0]
+
+
+@torch.no_grad()
+def decode(stage1, latent: torch.Tensor, scale_factor: float, bit_depth: int = 8) -> np.ndarray:
+    """Decode latents to uint8 (uint16 with bit_depth=16) images of shape (B, H, W)."""
+    sample = stage1.decode_stage_2_outputs(latent / scale_factor)
+    return to_images(sample, bit_depth)
+
+
+@torch.no_grad()
+def decode_tiled(
+    stage1, latent: torch.Tensor, scale_factor: float, tile_size: int, tile_stride: int, bit_depth: int = 8
+) -> np.ndarray:
+    """Decode a latent larger than the training size by overlapping windows, blended with the weights of
+    sample_tiled, so the memory of the decoder is bounded by the window size."""
+    n, _, height, width = latent.shape
+    tile_height, tile_width = min(tile_size, height), min(tile_size, width)
+
+    image = None
+    for y in get_tile_windows(height, tile_size, tile_stride):
+        for x in get_tile_windows(width, tile_size, tile_stride):
+            tile = stage1.decode_stage_2_outputs(latent[:, :, y : y + tile_height, x : x + tile_width] / scale_factor)
+            if image is None:
+                scale = tile.shape[-1] // tile_width
+                image = torch.zeros((n, tile.shape[1], height * scale, width * scale), device=latent.device)
+                weight_sum = torch.zeros((height * scale, width * scale), device=latent.device)
+                weights = get_tile_weights(tile_height * scale, tile_width * scale, latent.device)
+            rows = slice(y * scale, (y + tile_height) * scale)
+            cols = slice(x * scale, (x + tile_width) * scale)
+            image[:, :, rows, cols] += tile.float() * weights
+            weight_sum[rows, cols] += weights
+
+    return to_images(image / weight_sum, bit_depth)
+
+
+@torch.no_grad()
+def sample_and_decode(
+    stage1,
+    diffusion,
+    scheduler,
+    noise: torch.Tensor,
+    prompt_embeds: torch.Tensor,
+    args,
+    bit_depth: int = 8,
+    desc: str = "Sample Image",
+) -> np.ndarray:
+    """Sample and decode the images of `noise` with the guidance options of args, tiled with --tile_size."""
+    guidance_kwargs = dict(
+        guidance_scale=args.guidance_scale,
+        guidance_interval=args.guidance_interval,
+        guidance_cutoff=args.guidance_cutoff,
+        uncond_reuse_steps=args.uncond_reuse_steps,
+        desc=desc,
+    )
+    if args.tile_size is not None:
+        latent = sample_tiled(
+            diffusion,
+            scheduler,
+            noise,
+            prompt_embeds,
+            tile_size=args.tile_size,
+            tile_stride=args.tile_stride,
+            tile_batch_size=args.tile_batch_size,
+            **guidance_kwargs,
+        )
+        return decode_tiled(stage1, latent, args.scale_factor, args.tile_size, args.tile_stride, bit_depth=bit_depth)
+
+    latent, _ = sample_latent(diffusion, scheduler, noise, prompt_embeds, **guidance_kwargs)
+    return decode(stage1, latent, args.scale_factor, bit_depth=bit_depth)
+
+
+def sample_prompts_file(args, stage1, diffusion, scheduler, config, tokenizer, text_encoder, output_dir, writer, device):
+    with open(args.prompts_file, "r") as f:
+        prompts = [line.strip().replace("_", " ") for line in f if line.strip() != ""]
+    with open(output_dir / "prompts.tsv", "w") as f:
+        f.write("index\tprompt\n")
+        for j, prompt in enumerate(prompts):
+            f.write(f"{j}\t{prompt}\n")
+
+    uncond_embeds = get_prompt_embeds(tokenizer, text_encoder, [""], device)
+    base_embeds = get_prompt_embeds(tokenizer, text_encoder, [args.base_prompt], device)
+    branch_embeds = get_prompt_embeds(tokenizer, text_encoder, prompts, device)
+
+    for i in range(args.start_seed, args.stop_seed):
+        set_determinism(seed=i)
+        noise = torch.randn((1, config["ldm"]["params"]["in_channels"], args.x_size, args.y_size)).to(device)
+
+        latents = sample_branched(
+            diffusion,
+            scheduler,
+            noise,
+            uncond_embeds,
+            base_embeds,
+            branch_embeds,
+            branch_step=args.branch_step,
+            guidance_scale=args.guidance_scale,
+            unconditional_base=args.base_prompt == "",
+            guidance_interval=args.guidance_interval,
+            guidance_cutoff=args.guidance_cutoff,
+            uncond_reuse_steps=args.uncond_reuse_steps,
+            desc=f"Sample Image {i-args.start_seed+1}",
+        )
+
+        samples = decode(stage1, latents, args.scale_factor, bit_depth=writer.bit_depth)
+        for j, (prompt, sample) in enumerate(zip(prompts, samples)):
+            writer.write(sample, f"sample_{i}_{j}", seed=i, prompt=prompt, guidance_scale=args.guidance_scale)
+
+
+def main(args):
+    if args.tile_size is not None and args.prompts_file is not None:
+        raise ValueError("--tile_size cannot be used with --prompts_file.")
+    print_config()
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+
+    device = torch.device("cuda")
+
+    stage1, diffusion, scheduler, config = load_models(args, device)
+
+    tokenizer, text_encoder = get_text_encoder()
+    writer = SampleWriter(
+        output_dir, output_format=args.output_format, num_threads=args.writer_threads, shard_size=args.shard_size
+    )
+    if args.prompts_file is not None:
+        sample_prompts_file(
+            args, stage1, diffusion, scheduler, config, tokenizer, text_encoder, output_dir, writer, device
+        )
+        write_index(output_dir / "index.json", writer.close(), metadata=vars(args))
+        return
+
+    prompt = ["", args.prompt.replace("_", " ")] # "" for unconditional, text prompt for conditional
+    prompt_embeds = get_prompt_embeds(tokenizer, text_encoder, prompt, device)
+
+    for i in range(args.start_seed, args.stop_seed):
+        set_determinism(seed=i)
+        noise = torch.randn((1, config["ldm"]["params"]["in_channels"], args.x_size, args.y_size)).to(device)
+
+        sample = sample_and_decode(
+            stage1,
+            diffusion,
+            scheduler,
+            noise,
+            prompt_embeds,
+            args,
+            bit_depth=writer.bit_depth,
+            desc=f"Sample Image {i-args.start_seed+1}",
+        )
+        writer.write(sample[0], f"sample_{i}", seed=i, prompt=prompt[1], guidance_scale=args.guidance_scale)
+
+    write_index(output_dir / "index.json", writer.close(), metadata=vars(args))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,282 @@
+""" Script to generate sample images with several local worker processes.
+
+The seed range [start_seed, stop_seed) is split into work units of --unit_size seeds, stored in a SQLite work queue
+(queue.sqlite in the output directory). Each worker process loads the models once on its device (--devices are
+assigned round-robin) and claims pending units until the queue is empty. A claimed unit is leased: its worker refreshes
+the lease from a heartbeat thread, and a unit whose lease has not been refreshed for --lease_timeout seconds (its worker
+died) can be claimed again. Several launchers, e.g. on several nodes sharing the output directory, can therefore work
+on the same queue. Seeds whose images already exist are skipped, so an interrupted run can be restarted with the same
+command: the units left running by the previous run are claimed again once their lease has expired. The images are
+written by a SampleWriter per worker; with the shard formats (npz, tar), each work unit is written as one shard named
+after its first seed. At the end, a completion manifest (manifest.tsv and
+index.json) lists every generated image with the file holding it, its seed, prompt and guidance scale. The index is
+written while holding the write lock of the queue, so launchers finishing together do not lose each other's records.
+
+All the arguments of sample_images.py are accepted, including the tiled sampling of --tile_size.
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+from monai.utils import set_determinism
+from sample_images import (
+    decode,
+    get_parser,
+    get_prompt_embeds,
+    get_text_encoder,
+    load_models,
+    sample_and_decode,
+    sample_branched,
+)
+from sample_writer import SHARD_FORMATS, SampleWriter, write_index
+
+
+def parse_args():
+    parser = get_parser()
+
+    parser.add_argument("--num_workers", type=int, default=1, help="Number of worker processes.")
+    parser.add_argument("--devices", nargs="+", default=["cuda"], help="Devices assigned round-robin to the workers.")
+    parser.add_argument("--unit_size", type=int, default=10, help="Number of seeds per work unit (and per shard).")
+    parser.add_argument("--lease_timeout", type=float, default=600.0, help="Seconds without heartbeat after which a running unit is claimed again.")
+
+    args = parser.parse_args()
+    return args
+
+
+def connect(queue_path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(queue_path), timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def init_queue(queue_path: Path, start_seed: int, stop_seed: int, unit_size: int) -> None:
+    conn = connect(queue_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS units "
+        "(start INTEGER PRIMARY KEY, stop INTEGER, status TEXT, worker TEXT, updated REAL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS samples "
+        "(name TEXT PRIMARY KEY, file TEXT, seed INTEGER, prompt TEXT, guidance_scale REAL, worker TEXT)"
+    )
+    conn.execute("BEGIN IMMEDIATE")
+    for start in range(start_seed, stop_seed, unit_size):
+        conn.execute(
+            "INSERT OR IGNORE INTO units VALUES (?, ?, 'pending', NULL, ?)",
+            (start, min(start + unit_size, stop_seed), time.time()),
+        )
+    conn.execute("COMMIT")
+    conn.close()
+
+
+def claim_unit(conn: sqlite3.Connection, worker_id: str, lease_timeout: float):
+    """Claim the first pending unit, or a running unit whose lease has expired."""
+    conn.execute("BEGIN IMMEDIATE")
+    row = conn.execute(
+        "SELECT start, stop FROM units WHERE status = 'pending' OR (status = 'running' AND updated < ?) "
+        "ORDER BY start LIMIT 1",
+        (time.time() - lease_timeout,),
+    ).fetchone()
+    if row is not None:
+        conn.execute(
+            "UPDATE units SET status = 'running', worker = ?, updated = ? WHERE start = ?",
+            (worker_id, time.time(), row[0]),
+        )
+    conn.execute("COMMIT")
+    return row
+
+
+class LeaseHeartbeat:
+    """Thread refreshing the lease (updated time) of the unit held by a worker every interval seconds, while the worker
+    is busy sampling."""
+
+    def __init__(self, queue_path: Path, worker_id: str, interval: float) -> None:
+        self.queue_path = queue_path
+        self.worker_id = worker_id
+        self.interval = interval
+        self.unit_start = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        conn = connect(self.queue_path)
+        while not self._stop.wait(self.interval):
+            unit_start = self.unit_start
+            if unit_start is not None:
+                conn.execute(
+                    "UPDATE units SET updated = ? WHERE start = ? AND status = 'running' AND worker = ?",
+                    (time.time(), unit_start, self.worker_id),
+                )
+        conn.close()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def insert_samples(conn: sqlite3.Connection, records: list, worker_id: str) -> None:
+    conn.executemany(
+        "INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?)",
+        [(r["name"], r["file"], r["seed"], r["prompt"], r["guidance_scale"], worker_id) for r in records],
+    )
+
+
+def set_unit_status(conn: sqlite3.Connection, start: int, status: str) -> None:
+    conn.execute("UPDATE units SET status = ?, updated = ? WHERE start = ?", (status, time.time(), start))
+
+
+def worker(worker_index: int, device: str, args) -> None:
+    # unique across the launchers sharing the queue
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{worker_index}"
+    device = torch.device(device)
+    if device.type == "cpu":
+        torch.set_num_threads(max(1, os.cpu_count() // args.num_workers))
+
+    output_dir = Path(args.output_dir)
+    stage1, diffusion, scheduler, config = load_models(args, device)
+    tokenizer, text_encoder = get_text_encoder()
+
+    if args.prompts_file is not None:
+        with open(args.prompts_file, "r") as f:
+            prompts = [line.strip().replace("_", " ") for line in f if line.strip() != ""]
+        uncond_embeds = get_prompt_embeds(tokenizer, text_encoder, [""], device)
+        base_embeds = get_prompt_embeds(tokenizer, text_encoder, [args.base_prompt], device)
+        branch_embeds = get_prompt_embeds(tokenizer, text_encoder, prompts, device)
+    else:
+        prompts = [args.prompt.replace("_", " ")]
+        prompt_embeds = get_prompt_embeds(tokenizer, text_encoder, [""] + prompts, device)
+
+    guidance_kwargs = dict(
+        guidance_interval=args.guidance_interval,
+        guidance_cutoff=args.guidance_cutoff,
+        uncond_reuse_steps=args.uncond_reuse_steps,
+    )
+
+    writer = SampleWriter(output_dir, output_format=args.output_format, num_threads=args.writer_threads, shard_size=None)
+    shards = args.output_format in SHARD_FORMATS
+
+    conn = connect(output_dir / "queue.sqlite")
+    heartbeat = LeaseHeartbeat(output_dir / "queue.sqlite", worker_id, interval=args.lease_timeout / 5)
+    while True:
+        unit = claim_unit(conn, worker_id, args.lease_timeout)
+        if unit is None:
+            break
+        heartbeat.unit_start = unit[0]
+
+        shard_name = f"shard_{unit[0]:08d}"
+        try:
+            for seed in range(*unit):
+                if args.prompts_file is not None:
+                    names = [f"sample_{seed}_{j}" for j in range(len(prompts))]
+                else:
+                    names = [f"sample_{seed}"]
+                if shards:
+                    done = writer.get_path(shard_name).exists()
+                else:
+                    done = all(writer.get_path(name).exists() for name in names)
+                if done:
+                    file_names = [writer.get_path(shard_name if shards else name).name for name in names]
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO samples VALUES (?, ?, ?, ?, ?, ?)",
+                        [
+                            (name, file_name, seed, prompt, args.guidance_scale, worker_id)
+                            for name, file_name, prompt in zip(names, file_names, prompts)
+                        ],
+                    )
+                    continue
+
+                set_determinism(seed=seed)
+                noise = torch.randn((1, config["ldm"]["params"]["in_channels"], args.x_size, args.y_size)).to(device)
+                if args.prompts_file is not None:
+                    latents = sample_branched(
+                        diffusion,
+                        scheduler,
+                        noise,
+                        uncond_embeds,
+                        base_embeds,
+                        branch_embeds,
+                        branch_step=args.branch_step,
+                        guidance_scale=args.guidance_scale,
+                        unconditional_base=args.base_prompt == "",
+                        desc=f"Worker {worker_index} seed {seed}",
+                        **guidance_kwargs,
+                    )
+                    samples = decode(stage1, latents, args.scale_factor, bit_depth=writer.bit_depth)
+                else:
+                    samples = sample_and_decode(
+                        stage1,
+                        diffusion,
+                        scheduler,
+                        noise,
+                        prompt_embeds,
+                        args,
+                        bit_depth=writer.bit_depth,
+                        desc=f"Worker {worker_index} seed {seed}",
+                    )
+                for name, prompt, sample in zip(names, prompts, samples):
+                    writer.write(sample, name, seed=seed, prompt=prompt, guidance_scale=args.guidance_scale)
+
+            # the unit is done once all its images are on disk
+            insert_samples(conn, writer.flush(shard_name=shard_name), worker_id)
+        except BaseException:
+            set_unit_status(conn, unit[0], "pending")
+            raise
+
+        set_unit_status(conn, unit[0], "done")
+        heartbeat.unit_start = None
+
+    heartbeat.stop()
+    writer.close()
+    conn.close()
+
+
+def main(args):
+    if args.tile_size is not None and args.prompts_file is not None:
+        raise ValueError("--tile_size cannot be used with --prompts_file.")
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+    queue_path = output_dir / "queue.sqlite"
+    init_queue(queue_path, args.start_seed, args.stop_seed, args.unit_size)
+
+    ctx = mp.get_context("spawn")
+    processes = []
+    for worker_index in range(args.num_workers):
+        device = args.devices[worker_index % len(args.devices)]
+        process = ctx.Process(target=worker, args=(worker_index, device, args))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+
+    conn = connect(queue_path)
+    # the write lock of the queue serializes the read-merge-write of index.json between the launchers
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        status = dict(conn.execute("SELECT status, COUNT(*) FROM units GROUP BY status").fetchall())
+        samples_df = pd.read_sql_query(
+            "SELECT name, file, seed, prompt, guidance_scale FROM samples WHERE seed >= ? AND seed < ? "
+            "ORDER BY seed, name",
+            conn,
+            params=(args.start_seed, args.stop_seed),
+        )
+        samples_df = samples_df[[(output_dir / file).exists() for file in samples_df["file"]]]
+        samples_df.to_csv(output_dir / "manifest.tsv", index=False, sep="\t")
+        write_index(output_dir / "index.json", samples_df.to_dict("records"), metadata=vars(args))
+    finally:
+        conn.execute("COMMIT")
+        conn.close()
+
+    print(f"Work units: {status}")
+    print(f"{len(samples_df)} images listed in {output_dir / 'manifest.tsv'}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,181 @@
+""" Asynchronous writer of the sampled images.
+
+The images are encoded and written by a thread pool, so the sampling loop does not wait for the encoder or the
+filesystem. Output formats:
+ - jpg, png: one 8-bit image file per sample.
+ - png16: one 16-bit PNG file per sample (the decoder output is quantized to uint16 instead of uint8).
+ - npz, tar: shards of several samples, so large runs create a few large files instead of one file per image. The npz
+   shards hold one uint8 array per sample, the tar shards one PNG and one JSON file (seed, prompt, guidance scale) per
+   sample, in the WebDataset layout.
+Files are written to a temporary file and renamed at the end, so an interrupted run never leaves a truncated file
+behind. write_index saves the index of the samples (file, seed, prompt, guidance scale) with the arguments of the run,
+merged with the index already in the directory, so runs over different seed ranges can share an output directory.
+"""
+from __future__ import annotations
+
+import io
+import json
+import os
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+FORMATS = ("jpg", "png", "png16", "npz", "tar")
+SHARD_FORMATS = ("npz", "tar")
+
+
+def encode_image(image: np.ndarray, image_format: str) -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format="JPEG" if image_format == "jpg" else "PNG")
+    return buffer.getvalue()
+
+
+def write_file(path: Path, data: bytes) -> None:
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as fp:
+        fp.write(data)
+    os.replace(tmp_path, path)
+
+
+def write_shard(path: Path, shard: list, output_format: str) -> None:
+    """Write a list of (name, image, metadata) to a single npz or tar shard."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as fp:
+        if output_format == "tar":
+            with tarfile.open(fileobj=fp, mode="w") as tar:
+                for name, image, metadata in shard:
+                    for member, data in [
+                        (f"{name}.png", encode_image(image, "png")),
+                        (f"{name}.json", json.dumps(metadata).encode("utf-8")),
+                    ]:
+                        info = tarfile.TarInfo(name=member)
+                        info.size = len(data)
+                        tar.addfile(info, io.BytesIO(data))
+        else:
+            np.savez(fp, **{name: image for name, image, _ in shard})
+    os.replace(tmp_path, path)
+
+
+def write_index(path: Path, records: list, metadata: dict | None = None) -> None:
+    """Save the records of the samples and the metadata of the run (e.g. its arguments) as JSON.
+
+    If the index already exists, the records are merged into it (a record replaces the one of the same name) and the
+    metadata is appended to the list of the runs. The read-merge-write is not atomic: concurrent writers of the same
+    index have to hold a lock (see sample_launcher.py).
+    """
+    path = Path(path)
+    runs, samples = [], {}
+    if path.exists():
+        with open(path, "r") as f:
+            index = json.load(f)
+        runs = index["runs"]
+        samples = {record["name"]: record for record in index["samples"]}
+    runs.append(metadata or {})
+    samples.update((record["name"], record) for record in records)
+
+    data = json.dumps({"runs": runs, "samples": list(samples.values())}, indent=1, default=str)
+    write_file(path, data.encode("utf-8"))
+
+
+class SampleWriter:
+    """Write the sampled images asynchronously in one of FORMATS.
+
+    write() only queues the image: image files are encoded by the thread pool, while the samples of the shard formats
+    are gathered until shard_size samples (or flush()) and then written as one shard, named after its first sample so
+    that writers over different samples (e.g. seed ranges) do not overwrite each other's shards. At most max_pending writes are
+    queued, write() waits for the oldest one beyond that. flush() waits for all the queued writes and returns their
+    records, a dict per sample with its name, the file holding it and its metadata.
+    """
+
+    def __init__(
+        self,
+        output_dir: str | Path,
+        output_format: str = "jpg",
+        num_threads: int = 4,
+        shard_size: int | None = 1000,
+        shard_prefix: str = "shard",
+        max_pending: int = 64,
+    ) -> None:
+        if output_format not in FORMATS:
+            raise ValueError(f"Unknown output format {output_format}, expected one of {FORMATS}.")
+        self.output_dir = Path(output_dir)
+        self.output_format = output_format
+        self.shard_size = shard_size
+        self.shard_prefix = shard_prefix
+        self.max_pending = max_pending
+
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self._pending = deque()
+        self._shard = []
+        self._records = []
+        self._n_flushed = 0
+
+    @property
+    def bit_depth(self) -> int:
+        """Bit depth of the images expected by write()."""
+        return 16 if self.output_format == "png16" else 8
+
+    @property
+    def extension(self) -> str:
+        return "png" if self.output_format == "png16" else self.output_format
+
+    def get_path(self, name: str) -> Path:
+        """Path of the file of a sample (image formats) or of a shard (shard formats)."""
+        return self.output_dir / f"{name}.{self.extension}"
+
+    def write(self, image: np.ndarray, name: str, **metadata) -> None:
+        if self.output_format in SHARD_FORMATS:
+            self._shard.append((name, image, metadata))
+            if self.shard_size is not None and len(self._shard) >= self.shard_size:
+                self.write_shard()
+            return
+
+        path = self.get_path(name)
+        self._submit(lambda: write_file(path, encode_image(image, self.output_format)))
+        self._records.append({"name": name, "file": path.name, **metadata})
+
+    def write_shard(self, shard_name: str | None = None) -> None:
+        """Queue the samples gathered so far as one shard, named shard_name or {shard_prefix}_{name of its first
+        sample}."""
+        if len(self._shard) == 0:
+            return
+        if shard_name is None:
+            shard_name = f"{self.shard_prefix}_{self._shard[0][0]}"
+
+        path = self.get_path(shard_name)
+        shard, self._shard = self._shard, []
+        self._submit(lambda: write_shard(path, shard, self.output_format))
+        self._records.extend({"name": name, "file": path.name, **metadata} for name, _, metadata in shard)
+
+    def _submit(self, fn) -> None:
+        self._pending.append(self.executor.submit(fn))
+        # raise the errors of the finished writes early, and bound the memory held by the queue
+        while len(self._pending) > 0 and (self._pending[0].done() or len(self._pending) > self.max_pending):
+            self._pending.popleft().result()
+
+    def flush(self, shard_name: str | None = None) -> list:
+        """Write the pending shard, wait for all the queued writes and return the records written since the last
+        flush."""
+        self.write_shard(shard_name)
+        while len(self._pending) > 0:
+            self._pending.popleft().result()
+
+        records = self._records[self._n_flushed :]
+        self._n_flushed = len(self._records)
+        return records
+
+    def close(self) -> list:
+        """Flush and stop the thread pool. Returns the records of all the samples written."""
+        self.flush()
+        self.executor.shutdown()
+        return list(self._records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,40 +1,217 @@
 """Utility functions for testing."""
 from __future__ import annotations
 
+import hashlib
+import io
+import sys
+import tarfile
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
+import torch
+import torch.nn.functional as F
 from monai import transforms
-from monai.data import CacheDataset
-from torch.utils.data import DataLoader
+from monai.data import Dataset as MonaiDataset
+from omegaconf import OmegaConf
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
 import os,json
 
+# the dataset code shared with the training scripts
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "common"))
+from xray_data import ManifestDatalist, get_load_transforms
+
+
+def load_state_dict(path: str | Path, device: str | torch.device = "cpu", num_threads: int = 8) -> dict:
+    """Load the weights saved by convert_mlflow_to_pytorch.py.
+
+    .safetensors files are memory-mapped and all their tensors are read eagerly, in parallel by a thread pool, onto the
+    device, so processes loading the same file read it from the shared page cache. Other files are loaded with
+    torch.load.
+    """
+    if str(path).endswith(".safetensors"):
+        from safetensors import safe_open
+
+        with safe_open(str(path), framework="pt", device=str(device)) as f:
+            keys = list(f.keys())
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                tensors = list(executor.map(f.get_tensor, keys))
+        return dict(zip(keys, tensors))
+
+    return torch.load(str(path), map_location=device)
+
+
+def load_config(config_file_path: str | Path, weights_path: str | Path):
+    """Return the config embedded in a .safetensors file, or the config file if there is none."""
+    if str(weights_path).endswith(".safetensors"):
+        from safetensors import safe_open
+
+        with safe_open(str(weights_path), framework="pt") as f:
+            metadata = f.metadata()
+        if metadata is not None and "config" in metadata:
+            return OmegaConf.create(json.loads(metadata["config"]))
+
+    return OmegaConf.load(config_file_path)
+
+
+class SharedCacheDataset(Dataset):
+    """Dataset whose transformed images are cached in one contiguous shared-memory tensor.
+
+    The images (`keys`) of all the items are copied into a single float32 buffer in shared memory, with an index of
+    their offsets and shapes, and __getitem__ returns views of it. The DataLoader workers therefore read the same pages
+    (zero-copy) instead of each touching its own copy of the cached items. The other fields of the items (reports,
+    paths) are kept as they are.
+
+    The buffers are kept in a registry, so a dataset created over the same datalist with the same cache_key (by default
+    the same transform object) reuses the buffer of the first one instead of loading the images again.
+    """
+
+    _registry = {}
+
+    def __init__(
+        self,
+        data: Sequence,
+        transform,
+        keys: Sequence[str] = ("image",),
+        num_workers: int = 8,
+        cache_key: str | None = None,
+    ) -> None:
+        self.keys = list(keys)
+        registry_key = (cache_key if cache_key is not None else id(transform), self.get_datalist_digest(data))
+
+        entry = SharedCacheDataset._registry.get(registry_key)
+        if entry is None or (cache_key is None and entry["transform"] is not transform):
+            entry = self.build(data, transform, num_workers)
+            entry["transform"] = transform
+            SharedCacheDataset._registry[registry_key] = entry
+        self.buffer, self.index, self.items = entry["buffer"], entry["index"], entry["items"]
+
+    @staticmethod
+    def get_datalist_digest(data: Sequence) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        for item in data:
+            digest.update(repr(sorted((k, str(v)) for k, v in item.items())).encode())
+        return digest.hexdigest()
+
+    def build(self, data: Sequence, transform, num_workers: int) -> dict:
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+            items = list(tqdm(executor.map(transform, data), total=len(data), desc="Loading dataset"))
+
+        shapes = [[tuple(item[key].shape) for key in self.keys] for item in items]
+        sizes = [[int(np.prod(shape)) for shape in item_shapes] for item_shapes in shapes]
+        buffer = torch.empty(sum(sum(item_sizes) for item_sizes in sizes), dtype=torch.float32).share_memory_()
+
+        index = []
+        offset = 0
+        for i, item in enumerate(items):
+            item_index = {}
+            for key, shape, size in zip(self.keys, shapes[i], sizes[i]):
+                buffer[offset : offset + size] = torch.as_tensor(item.pop(key)).reshape(-1)
+                item_index[key] = (offset, shape)
+                offset += size
+            index.append(item_index)
+
+        return {"buffer": buffer, "index": index, "items": items}
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __getitem__(self, index):
+        d = dict(self.items[index])
+        for key, (offset, shape) in self.index[index].items():
+            d[key] = self.buffer[offset : offset + int(np.prod(shape))].view(shape)
+        return d
+
+
+def subsample_datalist(data: Sequence, upper_limit: int | None, seed: int = 0, key: str = "report") -> Sequence:
+    """Deterministic subsample of upper_limit items of a datalist, stratified by `key`.
+
+    Only the `key` field of the items is read, so no image is loaded. Each stratum (e.g. each report) keeps its share
+    of the datalist, the remaining slots going to the strata with the largest remainders, and the items of a stratum
+    are drawn with a generator seeded by `seed`. The selected items are returned in the order of the datalist.
+    """
+    if upper_limit is None or upper_limit >= len(data):
+        return data
+
+    strata = [str(data[i][key]) for i in range(len(data))]
+    labels, inverse, counts = np.unique(strata, return_inverse=True, return_counts=True)
+
+    quotas = counts * upper_limit / len(data)
+    n_per_stratum = np.floor(quotas).astype(int)
+    n_left = upper_limit - n_per_stratum.sum()
+    # ties are broken by the stratum label, so the selection does not depend on the order of the datalist
+    n_per_stratum[np.argsort(-(quotas - n_per_stratum), kind="stable")[:n_left]] += 1
+
+    rng = np.random.default_rng(seed)
+    selected = []
+    for stratum, n in enumerate(n_per_stratum):
+        if n > 0:
+            selected.append(rng.choice(np.flatnonzero(inverse == stratum), size=n, replace=False))
+    selected = np.sort(np.concatenate(selected))
+
+    print(f"Subsampled {len(selected)} of {len(data)} items ({len(labels)} strata).")
+    return [data[i] for i in selected]
+
+
+# version of the test transforms, part of the key of the cached test features: to be increased when they change
+TEST_TRANSFORMS_VERSION = 1
+
+
+def get_datalist_fingerprint(data: Sequence, dataset_path: str) -> str:
+    """Digest of the content of the images of a datalist: the file hash of each image (manifest datalists) or the size
+    and modification time of its file, and the modification time of the index of the array shards, if any."""
+    digest = hashlib.blake2b(digest_size=16)
+    for item in data:
+        if "hash" in item:
+            token = item["hash"]
+        else:
+            stat = os.stat(item["image"])
+            token = f"{stat.st_size}:{stat.st_mtime_ns}"
+        digest.update(f"{os.path.basename(item['image'])}:{token}\n".encode())
+
+    index_path = os.path.join(dataset_path, "arrays", "index.json")
+    if os.path.exists(index_path):
+        digest.update(f"arrays:{os.stat(index_path).st_mtime_ns}".encode())
+    return digest.hexdigest()
+
 
 def get_test_dataloader(
     batch_size: int,
     dataset_path: str,
     num_workers: int = 8,
     upper_limit: int | None = None,
+    seed: int = 0,
+    stream: bool = False,
+    split: str = "test",
 ):
+    """Data loader of the test set (or of another split of the manifest).
+
+    With upper_limit, a stratified subsample of the test set (see subsample_datalist) is selected before any image is
+    loaded. By default the images are cached in shared memory (see SharedCacheDataset), which pays off when the loader
+    is iterated several times; with stream=True they are loaded lazily by the workers, for loaders iterated only once.
+    """
     test_transforms = transforms.Compose(
         [
-            transforms.LoadImaged(keys=["image"]),
-            transforms.EnsureChannelFirstd(keys=["image"]),
-            transforms.Lambdad(
-                keys=["image"],
-                func=lambda x: x[0, :, :][
-                    None,
-                ],
-            ),
+            *get_load_transforms(dataset_path),
             transforms.Resized(keys=["image"], spatial_size=(512, 512)),
-            transforms.Rotate90d(keys=["image"], k=-1, spatial_axes=(0, 1)),  # Fix flipped image read
-            transforms.Flipd(keys=["image"], spatial_axis=1),  # Fix flipped image read
             transforms.ScaleIntensityRanged(keys=["image"], a_min=0.0, a_max=255.0, b_min=0.0, b_max=1.0, clip=True),
             #transforms.CenterSpatialCropd(keys=["image"], roi_size=(512, 512)),
             transforms.ToTensord(keys=["image"]),
         ]
     )
 
-    test_dicts = get_iu_datalist_test(dataset_path)
-    test_ds = CacheDataset(data=test_dicts, transform=test_transforms)
+    test_dicts = subsample_datalist(get_iu_datalist_test(dataset_path, split), upper_limit=upper_limit, seed=seed)
+    if stream:
+        test_ds = MonaiDataset(data=test_dicts, transform=test_transforms)
+    else:
+        # the loaders of the same test set share the same cache
+        test_ds = SharedCacheDataset(
+            data=test_dicts, transform=test_transforms, num_workers=num_workers, cache_key=f"{split}:{dataset_path}"
+        )
     test_loader = DataLoader(
         test_ds,
         batch_size=batch_size,
@@ -42,16 +219,135 @@ def get_test_dataloader(
         num_workers=num_workers,
         drop_last=False,
         pin_memory=False,
-        persistent_workers=True,
+        persistent_workers=not stream and num_workers > 0,
     )
 
     return test_loader
 
-def get_iu_datalist_test(dataset_path:str):
+
+class SampleDataset(Dataset):
+    """Samples of a directory written by SampleWriter (see sample_writer.py), in any of its formats: jpg and png files
+    (8 or 16 bits), npz and tar shards. The images are returned as (1, H, W) float32 tensors scaled to [0, 1] by the
+    maximum of their integer type, like the test set, with the name of the sample.
+
+    The members of the shards are listed once when the dataset is created (the tar headers give the offset of each PNG),
+    so an item only reads its own image.
+    """
+
+    def __init__(self, sample_dir: str | Path) -> None:
+        self.items = []
+        for path in sorted(Path(sample_dir).iterdir()):
+            if path.suffix in (".jpg", ".png"):
+                self.items.append((path.stem, path, None))
+            elif path.suffix == ".npz":
+                with np.load(path) as f:
+                    self.items.extend((name, path, name) for name in f.files)
+            elif path.suffix == ".tar":
+                with tarfile.open(path) as tar:
+                    for member in tar.getmembers():
+                        if member.name.endswith(".png"):
+                            self.items.append((member.name[: -len(".png")], path, (member.offset_data, member.size)))
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __getitem__(self, index):
+        name, path, member = self.items[index]
+        if path.suffix == ".npz":
+            with np.load(path) as f:
+                image = f[member]
+        elif path.suffix == ".tar":
+            offset, size = member
+            with open(path, "rb") as fp:
+                fp.seek(offset)
+                image = np.asarray(Image.open(io.BytesIO(fp.read(size))))
+        else:
+            image = np.asarray(Image.open(path))
+        image = image.astype(np.float32) / np.iinfo(image.dtype).max
+        return {"image": torch.from_numpy(image[None]), "name": name}
+
+
+def get_sample_dataloader(sample_dir: str | Path, batch_size: int, num_workers: int = 8):
+    """Data loader of the samples of a directory (see SampleDataset), scaled to [0, 1] like the test set."""
+    samples_ds = SampleDataset(sample_dir)
+    print(f"{len(samples_ds)} images found in {str(sample_dir)}")
+    return DataLoader(samples_ds, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+
+@torch.no_grad()
+def get_densenet_features(model, images: torch.Tensor) -> torch.Tensor:
+    """Features of the torchxrayvision DenseNet used by the FID, globally average pooled."""
+    outputs = model.features(images)
+    return F.adaptive_avg_pool2d(outputs, 1).squeeze(-1).squeeze(-1)
+
+
+def get_features(model, loader, device, desc: str = "Get Features") -> torch.Tensor:
+    """DenseNet features of all the images of a loader, on the CPU."""
+    features = []
+    for batch in tqdm(loader, desc=desc):
+        features.append(get_densenet_features(model, batch["image"].to(device)).cpu())
+    return torch.cat(features, dim=0)
+
+
+def get_cached_features(cache_dir: str | Path | None, key: dict, compute_fn) -> torch.Tensor:
+    """Features returned by compute_fn, cached in cache_dir under a digest of `key`, which should identify the images
+    and the feature extractor. Without cache_dir, the features are always computed."""
+    if cache_dir is None:
+        return compute_fn()
+
+    digest = hashlib.blake2b(json.dumps(key, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+    cache_path = Path(cache_dir) / f"features_{digest}.pt"
+    if cache_path.exists():
+        print(f"Loading cached features from {cache_path}")
+        return torch.load(cache_path)
+
+    features = compute_fn()
+    cache_path.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    torch.save(features, tmp_path)
+    os.replace(tmp_path, cache_path)
+    return features
+
+
+def get_test_features(
+    model,
+    dataset_path: str,
+    upper_limit: int | None,
+    seed: int,
+    device,
+    num_workers: int = 8,
+    cache_dir: str | Path | None = None,
+) -> torch.Tensor:
+    """DenseNet features of a subsample of the test set (see get_test_dataloader), cached in cache_dir. The cache key
+    includes a fingerprint of the selected images and the version of the test transforms, so the features are computed
+    again when the dataset is regenerated in place."""
+    test_loader = get_test_dataloader(
+        batch_size=1,
+        dataset_path=dataset_path,
+        num_workers=num_workers,
+        upper_limit=upper_limit,
+        seed=seed,
+        stream=True,
+    )
+    test_key = {
+        "model": "densenet121-res224-all",
+        "dataset_path": str(Path(dataset_path).resolve()),
+        "upper_limit": upper_limit,
+        "seed": seed,
+        "images": get_datalist_fingerprint(test_loader.dataset.data, dataset_path),
+        "transforms": TEST_TRANSFORMS_VERSION,
+    }
+    return get_cached_features(cache_dir, test_key, lambda: get_features(model, test_loader, device))
+
+
+def get_iu_datalist_test(dataset_path:str, split: str = "test"):
+    if os.path.exists(os.path.join(dataset_path, "manifest.parquet")):
+        return ManifestDatalist(dataset_path, split)
+
     with open(os.path.join(dataset_path, 'annotation.json'), "r") as f:
         data = json.load(f)
     test_data = []
-    for t in data['test']:
+    for t in data[split]:
         test_data.append({
             'image': os.path.join(dataset_path, 'images', t['image_path'][0]),
             'report': [t['report']]
@@ -64,18 +360,9 @@ def get_datalist(
     upper_limit: int | None = None,
 ):
     """Get data dicts for data loaders."""
-    df = pd.read_csv(ids_path, sep="\t")
+    df = pd.read_csv(ids_path, sep="\t", usecols=["image"], dtype=str, nrows=upper_limit)
 
-    if upper_limit is not None:
-        df = df[:upper_limit]
-
-    data_dicts = []
-    for index, row in df.iterrows():
-        data_dicts.append(
-            {
-                "image": f"{row['image']}",
-            }
-        )
+    data_dicts = df.to_dict("records")
 
     print(f"Found {len(data_dicts)} subjects.")
     return data_dicts
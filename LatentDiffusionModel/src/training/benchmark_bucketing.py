@@ -0,0 +1,149 @@
+""" Script to compare the training throughput with aspect-ratio bucketing against the fixed 512x512 resize.
+
+For each mode, a few AEKL training steps (generator forward and backward, L1 loss) are timed with the train loader of
+get_dataloader, after some warm-up steps. One full epoch of the loader is iterated before, untimed, so the
+PersistentDataset cache of the mode is filled and the timed steps read it, as the training does after its first epoch.
+We also report the aspect-ratio distortion of the resize, i.e. the mean absolute log ratio between the aspect ratio of
+the images and the one of their training size, computed on the manifest. The results are saved in
+benchmark_bucketing.tsv.
+"""
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from generative.networks.nets import AutoencoderKL
+from monai.utils import set_determinism
+from omegaconf import OmegaConf
+from torch.cuda.amp import GradScaler, autocast
+from tqdm import tqdm
+from util import assign_buckets, get_buckets, get_dataloader
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--seed", type=int, default=2, help="Random seed to use.")
+    parser.add_argument("--output_dir", default="outputs/benchmark_bucketing/", help="Path to save the results.")
+    parser.add_argument("--dataset_path", default="datasets/XrayGenerationDataset", help="Location of dataset.")
+    parser.add_argument("--config_file", default="configs/stage1/aekl_v0.yaml", help="Location of aekl configuration file.")
+    parser.add_argument("--cache_dir", default="runs/cached_data_aekl", help="Location of the PersistentDataset cache.")
+    parser.add_argument("--batch_size", type=int, default=8, help="Training batch size.")
+    parser.add_argument("--bucket_max_pixels", type=int, default=512 * 512, help="Number of pixels of the buckets.")
+    parser.add_argument("--n_warmup_steps", type=int, default=5, help="Number of steps before the timing.")
+    parser.add_argument("--n_steps", type=int, default=50, help="Number of timed steps.")
+    parser.add_argument("--num_workers", type=int, default=8, help="Number of loader workers")
+
+    args = parser.parse_args()
+    return args
+
+
+def get_distortion(dataset_path: str, bucket_max_pixels: int) -> dict:
+    df = pd.read_parquet(Path(dataset_path) / "manifest.parquet", columns=["height", "width", "split"])
+    df = df[df["split"] == "train"]
+    log_ratios = np.log(df["height"].to_numpy() / df["width"].to_numpy())
+
+    buckets = get_buckets(max_pixels=bucket_max_pixels)
+    bucket_ids = assign_buckets(df["height"].to_numpy(), df["width"].to_numpy(), buckets)
+    bucket_log_ratios = np.log([h / w for h, w in buckets])[bucket_ids]
+    print("Images per bucket:")
+    for bucket_id, count in zip(*np.unique(bucket_ids, return_counts=True)):
+        print(f"  {buckets[bucket_id][0]}x{buckets[bucket_id][1]}: {count}")
+
+    return {
+        "fixed": float(np.abs(log_ratios).mean()),
+        "bucketing": float(np.abs(log_ratios - bucket_log_ratios).mean()),
+    }
+
+
+def fill_cache(loader) -> None:
+    """Iterate one epoch of the loader, so its PersistentDataset cache is filled before the timing."""
+    for _ in tqdm(loader, desc="Fill cache"):
+        pass
+
+
+def benchmark(model, optimizer, loader, device, n_warmup_steps: int, n_steps: int) -> dict:
+    scaler = GradScaler()
+    model.train()
+
+    n_images = 0
+    n_pixels = 0
+    loader_iter = iter(loader)
+    for step in range(n_warmup_steps + n_steps):
+        if step == n_warmup_steps:
+            torch.cuda.synchronize()
+            start = time.time()
+        try:
+            x = next(loader_iter)
+        except StopIteration:
+            loader_iter = iter(loader)
+            x = next(loader_iter)
+        images = x["image"].to(device)
+
+        optimizer.zero_grad(set_to_none=True)
+        with autocast(enabled=True):
+            reconstruction, z_mu, z_sigma = model(x=images)
+            loss = F.l1_loss(reconstruction.float(), images.float())
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+        if step >= n_warmup_steps:
+            n_images += images.shape[0]
+            n_pixels += images[0, 0].numel() * images.shape[0]
+    torch.cuda.synchronize()
+    elapsed = time.time() - start
+
+    return {
+        "images_per_second": n_images / elapsed,
+        "megapixels_per_second": n_pixels / elapsed / 1e6,
+        "peak_memory_gb": torch.cuda.max_memory_allocated(device) / 1024**3,
+    }
+
+
+def main(args):
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+    device = torch.device("cuda")
+    config = OmegaConf.load(args.config_file)
+
+    distortion = get_distortion(args.dataset_path, args.bucket_max_pixels)
+
+    results = []
+    for mode in ["fixed", "bucketing"]:
+        set_determinism(seed=args.seed)
+        train_loader, _ = get_dataloader(
+            cache_dir=args.cache_dir,
+            batch_size=args.batch_size,
+            dataset_path=args.dataset_path,
+            num_workers=args.num_workers,
+            model_type="autoencoder",
+            seed=args.seed,
+            bucketing=mode == "bucketing",
+            bucket_max_pixels=args.bucket_max_pixels,
+        )
+        fill_cache(train_loader)
+        model = AutoencoderKL(**config["stage1"]["params"]).to(device)
+        optimizer = torch.optim.Adam(model.parameters(), lr=config["stage1"]["base_lr"])
+        torch.cuda.reset_peak_memory_stats(device)
+
+        result = {"mode": mode, **benchmark(model, optimizer, train_loader, device, args.n_warmup_steps, args.n_steps)}
+        result["aspect_ratio_distortion"] = distortion[mode]
+        results.append(result)
+        print(result)
+
+        del model, optimizer, train_loader
+        torch.cuda.empty_cache()
+
+    results_df = pd.DataFrame(results)
+    results_df["speedup"] = results_df["images_per_second"] / results_df["images_per_second"].iloc[0]
+    results_df.to_csv(output_dir / "benchmark_bucketing.tsv", index=False, sep="\t")
+    print(results_df.to_string(index=False))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
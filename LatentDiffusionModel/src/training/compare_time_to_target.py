@@ -0,0 +1,45 @@
+""" Script to compare the training time needed by several runs to reach a validation loss.
+
+The runs are read from the val_loss.csv of their run directory (written by train_aekl.py and train_ldm.py), e.g. to
+compare an AEKL trained with a resolution schedule against the fixed-resolution baseline. The time of a run is counted
+from its first validation, so runs that were resumed include the time they were stopped.
+"""
+import argparse
+from pathlib import Path
+
+import pandas as pd
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--run_dirs", nargs="+", required=True, help="Run directories, the first one is the baseline.")
+    parser.add_argument("--target_loss", type=float, required=True, help="Validation loss to reach (L1 for the AEKL).")
+
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    results = []
+    for run_dir in args.run_dirs:
+        df = pd.read_csv(Path(run_dir) / "val_loss.csv")
+        df["hours"] = (df["time"] - df["time"].iloc[0]) / 3600
+        reached = df[df["loss"] <= args.target_loss]
+        results.append(
+            {
+                "run": run_dir,
+                "best_loss": df["loss"].min(),
+                "epoch_to_target": reached["epoch"].iloc[0] if len(reached) > 0 else float("nan"),
+                "hours_to_target": reached["hours"].iloc[0] if len(reached) > 0 else float("nan"),
+            }
+        )
+
+    results_df = pd.DataFrame(results)
+    results_df["speedup"] = results_df["hours_to_target"].iloc[0] / results_df["hours_to_target"]
+    print(results_df.to_string(index=False))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -1,10 +1,12 @@
 """Custom transforms to load non-imaging data."""
 import json
-from typing import Optional
+from pathlib import Path
+from typing import Optional, Sequence
 
 import numpy as np
 from monai.config import KeysCollection, PathLike
 from monai.data.image_reader import ImageReader
+from monai.transforms import Resize
 from monai.transforms.transform import MapTransform, Randomizable, Transform
 from transformers import CLIPTokenizer
 
@@ -38,6 +40,140 @@ class LoadJSONd(MapTransform):
         return d
 
 
+class LoadSentenceStore(Transform):
+    """Transformation to load the sentences of a study from the sentence store created by create_sentences_files.py.
+
+    It accepts the same report paths as LoadJSON (e.g. report_sentences/s50414267.json): the store is read from the
+    parent directory and the study name is the file stem. If the JSON file exists, it is loaded instead. The store
+    files are memory-mapped once per directory and shared by all the calls.
+    """
+
+    def __init__(self) -> None:
+        self._stores = {}
+
+    def _get_store(self, store_dir: Path):
+        if store_dir not in self._stores:
+            with open(store_dir / "studies.json") as f:
+                studies = json.load(f)
+            self._stores[store_dir] = (
+                {study: i for i, study in enumerate(studies)},
+                np.load(store_dir / "study_offsets.npy", mmap_mode="r"),
+                np.load(store_dir / "sentence_offsets.npy", mmap_mode="r"),
+                np.memmap(store_dir / "sentences.bin", dtype=np.uint8, mode="r"),
+            )
+        return self._stores[store_dir]
+
+    def __call__(self, filename: PathLike):
+        filename = Path(filename)
+        if filename.exists():
+            with open(str(filename)) as json_file:
+                return json.load(json_file)
+
+        study_index, study_offsets, sentence_offsets, text = self._get_store(filename.parent)
+        study_idx = study_index.get(filename.stem)
+        if study_idx is None:
+            return {"sentences": [""]}
+
+        list_of_sentences = []
+        for i in range(study_offsets[study_idx], study_offsets[study_idx + 1]):
+            list_of_sentences.append(bytes(text[sentence_offsets[i] : sentence_offsets[i + 1]]).decode("utf-8"))
+        return {"sentences": list_of_sentences}
+
+
+class LoadSentenceStored(MapTransform):
+    def __init__(
+        self,
+        keys: KeysCollection,
+        allow_missing_keys: bool = False,
+        *args,
+        **kwargs,
+    ) -> None:
+        super().__init__(keys, allow_missing_keys)
+        self._loader = LoadSentenceStore(*args, **kwargs)
+
+    def __call__(self, data):
+        d = dict(data)
+        for key in self.key_iterator(d):
+            data = self._loader(d[key])
+            d[key] = data
+
+        return d
+
+
+class ResizeToBucketd(MapTransform):
+    """Resize the images to the (height, width) of the resolution bucket stored in the data dict (see get_buckets in
+    util.py)."""
+
+    def __init__(
+        self,
+        keys: KeysCollection,
+        bucket_key: str = "bucket",
+        mode: str = "area",
+        allow_missing_keys: bool = False,
+    ) -> None:
+        super().__init__(keys, allow_missing_keys)
+        self.bucket_key = bucket_key
+        self.mode = mode
+
+    def __call__(self, data):
+        d = dict(data)
+        resize = Resize(spatial_size=tuple(int(s) for s in d[self.bucket_key]), mode=self.mode)
+        for key in self.key_iterator(d):
+            d[key] = resize(d[key])
+
+        return d
+
+
+class BuildPyramidd(MapTransform):
+    """Add downsampled copies `{key}_{size}` of the square images, cached by PersistentDataset with the rest of the
+    preprocessing (see SelectResolutiond)."""
+
+    def __init__(
+        self,
+        keys: KeysCollection,
+        sizes: Sequence[int],
+        mode: str = "area",
+        allow_missing_keys: bool = False,
+    ) -> None:
+        super().__init__(keys, allow_missing_keys)
+        self.sizes = sizes
+        self.mode = mode
+
+    def __call__(self, data):
+        d = dict(data)
+        for key in self.key_iterator(d):
+            for size in self.sizes:
+                # the full size level is the image itself
+                if size != d[key].shape[-1]:
+                    d[f"{key}_{size}"] = Resize(spatial_size=(size, size), mode=self.mode)(d[key])
+
+        return d
+
+
+class SelectResolutiond:
+    """Replace the images by their pyramid level (see BuildPyramidd) of the current training resolution.
+
+    The resolution is read from a shared multiprocessing Value, so the training loop can change it while the loader
+    workers are running. This is not a MONAI Transform on purpose: PersistentDataset stops caching at the first
+    transform that is not one, so only the pyramid is cached and the level is selected at every epoch.
+    """
+
+    def __init__(self, keys: KeysCollection, resolution, sizes: Sequence[int]) -> None:
+        self.keys = [keys] if isinstance(keys, str) else list(keys)
+        self.resolution = resolution
+        self.sizes = sizes
+
+    def __call__(self, data):
+        d = dict(data)
+        resolution = self.resolution.value
+        for key in self.keys:
+            d[key] = d.get(f"{key}_{resolution}", d[key])
+            for size in self.sizes:
+                d.pop(f"{key}_{size}", None)
+
+        return d
+
+
 class RandomSelectExcerptd(Randomizable, MapTransform):
     """
     Transform to randomly select a number of sentences from a list of sentences and concatenate them into a single
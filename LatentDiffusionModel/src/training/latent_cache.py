@@ -0,0 +1,200 @@
+""" Cache of the stage1 latents of the training images, so the LDM training does not run the encoder at each step.
+
+The diffusion training only needs cheap augmentations, horizontal flips and small translations, and both are applied
+to the cached latents instead of the images:
+ - flips: the encoder is not equivariant to flips, so the latents of the flipped image are encoded once and stored next
+   to the ones of the image. A flip selects the stored variant, which is exactly the latent of the flipped image.
+ - translations: a translation by a multiple of the downsampling factor of the stage1 (8 pixels for 512x512 images and
+   64x64 latents) is an integer shift of the latent grid, applied to the cached latents with the borders repeated. It
+   matches the latents of the translated image away from the borders, up to the receptive field of the encoder.
+The small rotations and scalings of the image transforms have no latent counterpart and are not applied.
+
+The cache directory holds:
+ - z_mu.npy, z_sigma.npy: float16 (N, 2, C, H, W) arrays, variant 0 the image and variant 1 the flipped image, read
+   memory-mapped by the loader workers.
+ - index.json: key of the training images and of the stage1, and shape of the latents. It is written last, and the
+   cache is built again when the key does not match (new images or another stage1).
+z is sampled from z_mu and z_sigma at each step, as AutoencoderKL.sampling does, so the latents keep the noise of the
+encoder.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import torch
+from monai import transforms
+from monai.data import Dataset
+from monai.data.utils import worker_init_fn
+from monai.transforms.transform import Randomizable, Transform
+from torch.cuda.amp import autocast
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from util import ResumableRandomSampler, get_load_transforms, get_report_transforms
+
+VARIANTS = ("image", "hflip")
+
+
+def get_cache_key(datalist, stage1_uri: str) -> str:
+    """Key of the latents of the images of datalist encoded by the stage1 of stage1_uri."""
+    if hasattr(datalist, "cache_key"):
+        images_key = datalist.cache_key()
+    else:
+        digest = hashlib.blake2b(digest_size=16)
+        for item in datalist:
+            digest.update(f"{item['image']}\n".encode())
+        images_key = digest.hexdigest()
+    return hashlib.blake2b(f"{images_key}:{stage1_uri}".encode(), digest_size=16).hexdigest()
+
+
+def is_cache_valid(cache_dir: str | Path, key: str) -> bool:
+    index_path = Path(cache_dir) / "index.json"
+    if not index_path.exists():
+        return False
+    with open(index_path, "r") as f:
+        return json.load(f)["key"] == key
+
+
+def get_encode_loader(datalist, dataset_path: str, batch_size: int, num_workers: int = 8) -> DataLoader:
+    """Loader of the training images without the random transforms, in the order of datalist."""
+    encode_transforms = transforms.Compose(
+        [
+            *get_load_transforms(dataset_path),
+            transforms.Resized(keys=["image"], spatial_size=(512, 512)),
+            transforms.ScaleIntensityRanged(keys=["image"], a_min=0.0, a_max=255.0, b_min=0.0, b_max=1.0, clip=True),
+            transforms.ToTensord(keys=["image"]),
+        ]
+    )
+    return DataLoader(
+        Dataset(data=[{"image": item["image"]} for item in datalist], transform=encode_transforms),
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        pin_memory=False,
+    )
+
+
+@torch.no_grad()
+def build_latent_cache(
+    cache_dir: str | Path,
+    datalist,
+    dataset_path: str,
+    stage1: torch.nn.Module,
+    device: torch.device,
+    key: str,
+    batch_size: int = 16,
+    num_workers: int = 8,
+) -> None:
+    """Encode the images of datalist and their horizontal flips with the stage1 (AutoencoderKL) into cache_dir."""
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(exist_ok=True, parents=True)
+    (cache_dir / "index.json").unlink(missing_ok=True)
+
+    stage1.eval()
+    z_mu_cache, z_sigma_cache = None, None
+    offset = 0
+    for batch in tqdm(get_encode_loader(datalist, dataset_path, batch_size, num_workers), desc="Encode latents"):
+        images = batch["image"].to(device)
+        # (B, 2, ...): the image and its flip, flipped on the width as RandFlipd(spatial_axis=1) of the autoencoder
+        with autocast(enabled=True):
+            z_mu, z_sigma = stage1.encode(torch.cat([images, images.flip(-1)]))
+        z_mu = torch.stack(z_mu.float().split(len(images)), dim=1).cpu().numpy()
+        z_sigma = torch.stack(z_sigma.float().split(len(images)), dim=1).cpu().numpy()
+        if z_mu_cache is None:
+            shape = (len(datalist), *z_mu.shape[1:])
+            z_mu_cache = np.lib.format.open_memmap(cache_dir / "z_mu.npy", mode="w+", dtype=np.float16, shape=shape)
+            z_sigma_cache = np.lib.format.open_memmap(cache_dir / "z_sigma.npy", mode="w+", dtype=np.float16, shape=shape)
+        z_mu_cache[offset : offset + len(images)] = z_mu
+        z_sigma_cache[offset : offset + len(images)] = z_sigma
+        offset += len(images)
+    z_mu_cache.flush()
+    z_sigma_cache.flush()
+
+    # written last, so an interrupted build is not taken for a cache
+    with open(cache_dir / "index.json", "w") as f:
+        json.dump({"key": key, "n_images": offset, "variants": VARIANTS, "shape": list(z_mu_cache.shape[2:])}, f)
+
+
+def shift_latent(z: np.ndarray, dy: int, dx: int) -> np.ndarray:
+    """Shift the (C, H, W) latent by dy rows and dx columns, repeating the borders."""
+    if dy == 0 and dx == 0:
+        return z
+    height, width = z.shape[-2:]
+    py, px = abs(dy), abs(dx)
+    padded = np.pad(z, ((0, 0), (py, py), (px, px)), mode="edge")
+    return padded[:, py - dy : py - dy + height, px - dx : px - dx + width]
+
+
+class LoadCachedLatentd(Randomizable, Transform):
+    """Load the z_mu and z_sigma of the item "index" of the latent cache, flipped with probability flip_prob and shifted
+    by up to max_shift latent pixels on each axis with probability shift_prob."""
+
+    def __init__(self, cache_dir: str | Path, flip_prob: float = 0.5, max_shift: int = 1, shift_prob: float = 0.1) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.flip_prob = flip_prob
+        self.max_shift = max_shift
+        self.shift_prob = shift_prob
+        self._z_mu = None
+        self._z_sigma = None
+        self._variant = 0
+        self._shift = (0, 0)
+
+    def randomize(self, data=None) -> None:
+        self._variant = int(self.R.rand() < self.flip_prob)
+        self._shift = (0, 0)
+        if self.max_shift > 0 and self.R.rand() < self.shift_prob:
+            self._shift = tuple(self.R.randint(-self.max_shift, self.max_shift + 1, size=2))
+
+    def __call__(self, data):
+        # memory-mapped on the first call, i.e. once per loader worker
+        if self._z_mu is None:
+            self._z_mu = np.load(self.cache_dir / "z_mu.npy", mmap_mode="r")
+            self._z_sigma = np.load(self.cache_dir / "z_sigma.npy", mmap_mode="r")
+
+        self.randomize()
+        d = dict(data)
+        for key, cache in [("z_mu", self._z_mu), ("z_sigma", self._z_sigma)]:
+            z = shift_latent(cache[d["index"], self._variant], *self._shift)
+            d[key] = torch.from_numpy(np.ascontiguousarray(z))
+        return d
+
+
+def get_latent_dataloader(
+    cache_dir: str | Path,
+    datalist,
+    batch_size: int,
+    num_workers: int = 8,
+    seed: int = 0,
+    flip_prob: float = 0.5,
+    max_shift: int = 1,
+) -> DataLoader:
+    """Training loader of the latent cache of datalist. The batches hold float16 z_mu and z_sigma instead of images."""
+    with open(Path(cache_dir) / "index.json", "r") as f:
+        n_images = json.load(f)["n_images"]
+    if n_images != len(datalist):
+        raise ValueError(f"The latent cache of {cache_dir} has {n_images} images, the training set {len(datalist)}.")
+
+    latent_transforms = transforms.Compose(
+        [
+            # same probability as the RandAffined of the image transforms
+            LoadCachedLatentd(cache_dir, flip_prob=flip_prob, max_shift=max_shift, shift_prob=0.10),
+            *get_report_transforms(drop_prob=0.10),
+        ]
+    )
+    train_ds = Dataset(
+        data=[{"index": i, "report": datalist[i]["report"]} for i in range(len(datalist))],
+        transform=latent_transforms,
+    )
+    return DataLoader(
+        train_ds,
+        batch_size=batch_size,
+        sampler=ResumableRandomSampler(train_ds, seed=seed),
+        num_workers=num_workers,
+        drop_last=False,
+        pin_memory=False,
+        persistent_workers=num_workers > 0,
+        # seeds the random transforms differently in each worker
+        worker_init_fn=worker_init_fn,
+    )
@@ -0,0 +1,276 @@
+""" Script to run a hyper-parameter sweep of the diffusion model as local train_ldm.py processes.
+
+The search space is given as a list of overrides KEY=VALUES:
+ - KEY=V1,V2,...: list of values.
+ - KEY=range:LOW:HIGH or KEY=logrange:LOW:HIGH: continuous range (only with --n_random_trials).
+Keys of the configuration file (e.g. ldm.base_lr, ldm.params.num_channels) are applied as OmegaConf dotlist
+overrides to a copy of the configuration saved in the trial directory, the other keys (e.g. scale_factor) are passed
+as arguments of train_ldm.py. List values are separated by "|", e.g. "ldm.params.num_channels=[128,256,384]|[256,512,768]".
+
+Without --n_random_trials all the combinations (grid) are trained, otherwise n_random_trials combinations are drawn.
+At most --max_concurrent trials run at the same time, each one on the next free entry of --devices (used as
+CUDA_VISIBLE_DEVICES). All the trials share the same PersistentDataset cache, filled once by this script before the
+trials start, so the trials only read it. With --latent_cache in the train_ldm.py arguments, the latent cache is also
+built once here, with the --stage1_uri of the trials.
+
+Trials are pruned with the median stopping rule: after --prune_min_epoch epochs, a trial whose best validation loss
+(read from the val_loss.csv of its run directory) is worse than the median of the best losses of the other trials at
+the same epoch is stopped. The status of the trials is kept in trials.csv in the sweep directory; running the same
+command again skips the finished trials and resumes the others from their checkpoints.
+
+Unknown arguments are passed to all the trials, e.g. --stage1_uri, --n_epochs and --eval_freq.
+"""
+import argparse
+import itertools
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--sweep_name", default="LDM_sweep", help="Name of the sweep directory in runs/.")
+    parser.add_argument("--config_file", default="configs/ldm/ldm_v0.yaml", help="Location of the base ldm configuration file.")
+    parser.add_argument("--dataset_path", default="datasets/XrayGenerationDataset", help="Location of training set.")
+    parser.add_argument("--cache_dir", default="runs/cached_data_diffusion", help="PersistentDataset cache shared by the trials.")
+    parser.add_argument("--overrides", nargs="+", required=True, help="Search space, e.g. ldm.base_lr=1e-5,2.5e-5 scale_factor=0.3,0.5.")
+    parser.add_argument("--n_random_trials", type=int, default=0, help="Number of random trials (0: grid search).")
+    parser.add_argument("--seed", type=int, default=2, help="Random seed of the random search.")
+    parser.add_argument("--max_concurrent", type=int, default=1, help="Maximum number of trials running at the same time.")
+    parser.add_argument("--devices", nargs="+", default=None, help="CUDA_VISIBLE_DEVICES of the trial slots, e.g. 0 1 2,3.")
+    parser.add_argument("--prune_min_epoch", type=int, default=20, help="First epoch where trials can be pruned.")
+    parser.add_argument("--prune_min_trials", type=int, default=3, help="Number of trials reporting an epoch needed to prune at it.")
+    parser.add_argument("--poll_interval", type=float, default=30.0, help="Seconds between checks of the trials.")
+    parser.add_argument("--num_workers", type=int, default=8, help="Number of loader workers used to fill the cache.")
+
+    args, train_args = parser.parse_known_args()
+    return args, train_args
+
+
+def parse_overrides(overrides: list) -> dict:
+    space = {}
+    for override in overrides:
+        key, values = override.split("=", 1)
+        if values.startswith(("range:", "logrange:")):
+            kind, low, high = values.split(":")
+            space[key] = (kind, float(low), float(high))
+        elif "[" in values:
+            # list values, e.g. channels, are separated by "|"
+            space[key] = values.split("|")
+        else:
+            space[key] = values.split(",")
+    return space
+
+
+def get_trials(space: dict, n_random_trials: int, seed: int) -> list:
+    keys = list(space.keys())
+    if n_random_trials == 0:
+        if any(isinstance(values, tuple) for values in space.values()):
+            raise ValueError("Ranges can only be used with --n_random_trials.")
+        return [dict(zip(keys, values)) for values in itertools.product(*space.values())]
+
+    rng = np.random.default_rng(seed)
+    trials = []
+    for _ in range(n_random_trials):
+        trial = {}
+        for key, values in space.items():
+            if isinstance(values, tuple):
+                kind, low, high = values
+                if kind == "logrange":
+                    trial[key] = f"{np.exp(rng.uniform(np.log(low), np.log(high))):.3g}"
+                else:
+                    trial[key] = f"{rng.uniform(low, high):.3g}"
+            else:
+                trial[key] = values[rng.integers(len(values))]
+        trials.append(trial)
+    return trials
+
+
+def warm_cache(args, train_args: list) -> None:
+    """Fill the shared PersistentDataset cache (and the latent cache of --latent_cache) and download the text encoder
+    once, before the trials start."""
+    from train_ldm import get_parser as get_train_parser
+    from transformers import CLIPTextModel
+    from util import get_dataloader
+
+    CLIPTextModel.from_pretrained("stabilityai/stable-diffusion-2-1-base", subfolder="text_encoder")
+
+    train_loader, val_loader = get_dataloader(
+        cache_dir=args.cache_dir,
+        batch_size=16,
+        dataset_path=args.dataset_path,
+        num_workers=args.num_workers,
+        model_type="diffusion",
+    )
+    for loader in [train_loader, val_loader]:
+        for _ in loader:
+            pass
+
+    train_options, _ = get_train_parser().parse_known_args(train_args)
+    if train_options.latent_cache is not None:
+        import mlflow.pytorch
+        import torch
+        from latent_cache import build_latent_cache, get_cache_key, is_cache_valid
+        from util import get_iu_datalist
+
+        # same datalist and key as train_ldm.py, so the trials find a valid cache and only read it
+        train_dicts, _ = get_iu_datalist(args.dataset_path)
+        cache_key = get_cache_key(train_dicts, train_options.stage1_uri)
+        if not is_cache_valid(train_options.latent_cache, cache_key):
+            device = torch.device("cuda")
+            stage1 = mlflow.pytorch.load_model(train_options.stage1_uri).to(device)
+            build_latent_cache(
+                cache_dir=train_options.latent_cache,
+                datalist=train_dicts,
+                dataset_path=args.dataset_path,
+                stage1=stage1,
+                device=device,
+                key=cache_key,
+                batch_size=train_options.batch_size,
+                num_workers=args.num_workers,
+            )
+            del stage1
+            torch.cuda.empty_cache()
+
+
+def get_trial_command(trial: dict, trial_dir: Path, run_dir: str, base_config, args, train_args: list) -> list:
+    config_keys = [key for key in trial if key.split(".")[0] in base_config]
+    config = OmegaConf.merge(base_config, OmegaConf.from_dotlist([f"{key}={trial[key]}" for key in config_keys]))
+    OmegaConf.save(config, trial_dir / "config.yaml")
+
+    command = [
+        sys.executable,
+        str(Path(__file__).parent / "train_ldm.py"),
+        "--run_dir",
+        run_dir,
+        "--config_file",
+        str(trial_dir / "config.yaml"),
+        "--dataset_path",
+        args.dataset_path,
+        "--cache_dir",
+        args.cache_dir,
+    ]
+    for key, value in trial.items():
+        if key not in config_keys:
+            command += [f"--{key}", str(value)]
+    return command + train_args
+
+
+def read_val_loss(trial_dir: Path) -> pd.Series:
+    """Best validation loss so far, indexed by epoch."""
+    csv_path = trial_dir / "val_loss.csv"
+    if not csv_path.exists():
+        return pd.Series(dtype=float)
+    df = pd.read_csv(csv_path).drop_duplicates("epoch", keep="last").set_index("epoch").sort_index()
+    return df["loss"].cummin()
+
+
+def should_prune(trial_id: int, curves: dict, min_epoch: int, min_trials: int) -> bool:
+    curve = curves[trial_id]
+    if len(curve) == 0 or curve.index[-1] < min_epoch:
+        return False
+    epoch = curve.index[-1]
+    others = [c.loc[epoch] for i, c in curves.items() if i != trial_id and epoch in c.index]
+    if len(others) + 1 < min_trials:
+        return False
+    return curve.loc[epoch] > np.median(others)
+
+
+def main(args, train_args):
+    sweep_dir = Path("runs") / args.sweep_name
+    sweep_dir.mkdir(exist_ok=True, parents=True)
+
+    base_config = OmegaConf.load(args.config_file)
+    space = parse_overrides(args.overrides)
+
+    trials_path = sweep_dir / "trials.csv"
+    if trials_path.exists():
+        # resume the sweep with the trials drawn by the first run
+        trials_df = pd.read_csv(trials_path, index_col="trial", dtype={key: str for key in space})
+    else:
+        trials_df = pd.DataFrame(get_trials(space, args.n_random_trials, args.seed))
+        trials_df.index.name = "trial"
+        trials_df["status"] = "pending"
+        trials_df["best_loss"] = np.nan
+        trials_df["last_epoch"] = np.nan
+        trials_df.to_csv(trials_path)
+    trials = {i: {key: trials_df.loc[i, key] for key in space} for i in trials_df.index}
+    print(trials_df)
+
+    latent_cache = any(arg.split("=")[0] == "--latent_cache" for arg in train_args)
+    if latent_cache and any(key in ("latent_cache", "stage1_uri") for key in space):
+        raise ValueError("latent_cache and stage1_uri can not be swept with --latent_cache, the trials share one cache.")
+
+    print("Filling the shared cache...")
+    warm_cache(args, train_args)
+
+    env = os.environ.copy()
+    # the text encoder is already downloaded
+    env["HF_HUB_OFFLINE"] = "1"
+
+    pending = [i for i in trials_df.index if trials_df.loc[i, "status"] not in ("completed", "pruned")]
+    free_devices = list(args.devices) if args.devices is not None else [None] * args.max_concurrent
+    running = {}
+    curves = {i: read_val_loss(sweep_dir / f"trial_{i:03d}") for i in trials_df.index}
+    while len(pending) > 0 or len(running) > 0:
+        # Launch
+        while len(pending) > 0 and len(running) < args.max_concurrent and len(free_devices) > 0:
+            trial_id = pending.pop(0)
+            trial_dir = sweep_dir / f"trial_{trial_id:03d}"
+            trial_dir.mkdir(exist_ok=True)
+            command = get_trial_command(
+                trial=trials[trial_id],
+                trial_dir=trial_dir,
+                run_dir=f"{args.sweep_name}/trial_{trial_id:03d}",
+                base_config=base_config,
+                args=args,
+                train_args=train_args,
+            )
+            device = free_devices.pop(0)
+            trial_env = dict(env)
+            if device is not None:
+                trial_env["CUDA_VISIBLE_DEVICES"] = device
+            with open(trial_dir / "log.txt", "a") as log_file:
+                process = subprocess.Popen(command, env=trial_env, stdout=log_file, stderr=subprocess.STDOUT)
+            running[trial_id] = (process, device)
+            trials_df.loc[trial_id, "status"] = "running"
+            print(f"Trial {trial_id} started: {trials[trial_id]}")
+
+        time.sleep(args.poll_interval)
+
+        # Check
+        for trial_id, (process, device) in list(running.items()):
+            curves[trial_id] = read_val_loss(sweep_dir / f"trial_{trial_id:03d}")
+            if process.poll() is not None:
+                status = "completed" if process.returncode == 0 else "failed"
+            elif should_prune(trial_id, curves, args.prune_min_epoch, args.prune_min_trials):
+                process.terminate()
+                process.wait()
+                status = "pruned"
+            else:
+                continue
+
+            del running[trial_id]
+            free_devices.append(device)
+            trials_df.loc[trial_id, "status"] = status
+            print(f"Trial {trial_id} {status}")
+
+        for trial_id, curve in curves.items():
+            if len(curve) > 0:
+                trials_df.loc[trial_id, "best_loss"] = curve.iloc[-1]
+                trials_df.loc[trial_id, "last_epoch"] = curve.index[-1]
+        trials_df.to_csv(trials_path)
+
+    print(trials_df.sort_values("best_loss"))
+
+
+if __name__ == "__main__":
+    args, train_args = parse_args()
+    main(args, train_args)
@@ -0,0 +1,171 @@
+""" Memory and throughput telemetry of the training loops.
+
+A background thread samples, every `interval` seconds:
+ - rss: resident memory of the process and its DataLoader workers (psutil if installed, otherwise /proc, main process
+   only).
+ - peak_allocated: peak memory of the allocator, torch.cuda.max_memory_allocated on GPU and the peak RSS
+   (getrusage) on CPU.
+ - queue_depth: number of batches ready in the queue of the watched DataLoader (persistent workers only).
+ - steps_per_second, samples_per_second: throughput of the training steps reported with step().
+The samples are logged to TensorBoard under telemetry/, and end_epoch() logs and prints the summary of the training
+steps since start_epoch().
+"""
+import os
+import resource
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+import torch
+from tensorboardX import SummaryWriter
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+GB = 1024**3
+
+
+def get_rss() -> float:
+    """Resident memory in bytes of the process and, with psutil, of its children (DataLoader workers)."""
+    if psutil is not None:
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return rss
+
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # ru_maxrss is the peak and not the current value, but is available on every platform
+        return get_peak_rss()
+
+
+def get_peak_rss() -> float:
+    """Peak resident memory in bytes of the process (ru_maxrss is in kilobytes on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_peak_allocated(device: torch.device) -> float:
+    if device.type == "cuda" and torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated(device)
+    return get_peak_rss()
+
+
+def get_queue_depth(loader) -> Optional[int]:
+    """Number of batches ready in the queue of a DataLoader with persistent workers, None if not available."""
+    iterator = getattr(loader, "_iterator", None)
+    data_queue = getattr(iterator, "_data_queue", None)
+    if data_queue is None:
+        return None
+    try:
+        return data_queue.qsize()
+    except NotImplementedError:
+        # qsize is not implemented on macOS
+        return None
+
+
+class Telemetry:
+    def __init__(self, writer: SummaryWriter, device: torch.device, interval: float = 10.0) -> None:
+        self.writer = writer
+        self.device = torch.device(device)
+        self.interval = interval
+        self.loader = None
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.total_steps = 0
+        self.total_samples = 0
+        self._epoch_samples = []
+        self._epoch_start = time.time()
+        self._epoch_steps = 0
+        self._epoch_n_samples = 0
+
+    def watch(self, loader) -> None:
+        self.loader = loader
+
+    def start(self) -> None:
+        if self.device.type == "cuda" and torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self._epoch_start = time.time()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def step(self, n_samples: int) -> None:
+        """Report a training step of n_samples samples."""
+        with self._lock:
+            self.total_steps += 1
+            self.total_samples += n_samples
+            self._epoch_steps += 1
+            self._epoch_n_samples += n_samples
+
+    def sample(self, last_time: float, last_steps: int, last_samples: int) -> dict:
+        now = time.time()
+        with self._lock:
+            total_steps, total_samples = self.total_steps, self.total_samples
+        elapsed = max(now - last_time, 1e-6)
+
+        values = {
+            "rss_gb": get_rss() / GB,
+            "peak_allocated_gb": get_peak_allocated(self.device) / GB,
+            "steps_per_second": (total_steps - last_steps) / elapsed,
+            "samples_per_second": (total_samples - last_samples) / elapsed,
+        }
+        queue_depth = get_queue_depth(self.loader)
+        if queue_depth is not None:
+            values["queue_depth"] = queue_depth
+        return values
+
+    def _run(self) -> None:
+        last_time, last_steps, last_samples = time.time(), 0, 0
+        while not self._stop.wait(self.interval):
+            values = self.sample(last_time, last_steps, last_samples)
+            last_time, last_steps, last_samples = time.time(), self.total_steps, self.total_samples
+
+            for k, v in values.items():
+                self.writer.add_scalar(f"telemetry/{k}", v, self.total_steps)
+            with self._lock:
+                self._epoch_samples.append(values)
+
+    def start_epoch(self) -> None:
+        with self._lock:
+            self._epoch_samples = []
+            self._epoch_steps, self._epoch_n_samples = 0, 0
+        self._epoch_start = time.time()
+
+    def end_epoch(self, epoch: int) -> dict:
+        """Log and print the summary of the epoch, and reset the epoch statistics."""
+        with self._lock:
+            samples, self._epoch_samples = self._epoch_samples, []
+            steps, n_samples = self._epoch_steps, self._epoch_n_samples
+        elapsed = time.time() - self._epoch_start
+
+        summary = {
+            "steps_per_second": steps / elapsed,
+            "samples_per_second": n_samples / elapsed,
+            "peak_rss_gb": max([s["rss_gb"] for s in samples] + [get_rss() / GB]),
+            "peak_allocated_gb": get_peak_allocated(self.device) / GB,
+        }
+        queue_depths = [s["queue_depth"] for s in samples if "queue_depth" in s]
+        if len(queue_depths) > 0:
+            summary["mean_queue_depth"] = float(np.mean(queue_depths))
+            summary["min_queue_depth"] = float(np.min(queue_depths))
+
+        for k, v in summary.items():
+            self.writer.add_scalar(f"telemetry/epoch_{k}", v, epoch)
+        print(f"Telemetry epoch {epoch + 1}: " + ", ".join(f"{k} {v:.2f}" for k, v in summary.items()))
+        return summary
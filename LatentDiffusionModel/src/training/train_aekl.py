@@ -1,5 +1,6 @@
 """ Training script for the autoencoder with KL regulization. """
 import argparse
+import multiprocessing as mp
 import warnings
 from pathlib import Path
 
@@ -11,9 +12,10 @@ from generative.networks.nets.patchgan_discriminator import PatchDiscriminator
 from monai.config import print_config
 from monai.utils import set_determinism
 from omegaconf import OmegaConf
+from telemetry import Telemetry
 from tensorboardX import SummaryWriter
 from training_functions import train_aekl
-from util import get_dataloader, log_mlflow, generate_folder_from_current_time
+from util import get_dataloader, get_resolution_schedule, log_mlflow, generate_folder_from_current_time
 
 warnings.filterwarnings("ignore")
 
@@ -28,8 +30,16 @@ def parse_args():
     parser.add_argument("--batch_size", type=int, default=8, help="Training batch size.")
     parser.add_argument("--n_epochs", type=int, default=30, help="Number of epochs to train.")
     parser.add_argument("--adv_start", type=int, default=25, help="Epoch when the adversarial training starts.")
+    parser.add_argument("--disc_update_interval", type=int, default=1, help="Number of generator steps between discriminator updates.")
+    parser.add_argument("--eval_adv", action="store_true", help="Compute the adversarial losses in the evaluations.")
     parser.add_argument("--eval_freq", type=int, default=10, help="Number of epochs to between evaluations.")
     parser.add_argument("--num_workers", type=int, default=8, help="Number of loader workers")
+    parser.add_argument("--ckpt_every_n_steps", type=int, default=0, help="Number of training steps between checkpoints (0: only at the evaluations).")
+    parser.add_argument("--bucketing", action="store_true", help="Batch the images by aspect-ratio buckets instead of resizing them to 512x512.")
+    parser.add_argument("--bucket_max_pixels", type=int, default=512 * 512, help="Number of pixels of the buckets.")
+    parser.add_argument("--resolution_schedule", default=None, help="Training resolution by epoch, e.g. 0:128,10:256,20:512 (default: 512).")
+    parser.add_argument("--target_l1", type=float, default=None, help="Validation L1 loss whose time to reach is reported.")
+    parser.add_argument("--telemetry_interval", type=float, default=10.0, help="Seconds between telemetry samples (0: disabled).")
     parser.add_argument("--experiment",default='Carm', help="Mlflow experiment name.")
 
     args = parser.parse_args()
@@ -59,7 +69,15 @@ def main(args):
     writer_val = SummaryWriter(log_dir=str(run_dir / "val"))
 
     print("Getting data...")
-    cache_dir = output_dir / "cached_data_aekl"
+    resolution_schedule, resolution, pyramid_sizes = None, None, None
+    if args.resolution_schedule is not None:
+        resolution_schedule = get_resolution_schedule(args.resolution_schedule)
+        pyramid_sizes = sorted({size for _, size in resolution_schedule})
+        # shared with the loader workers
+        resolution = mp.Value("i", resolution_schedule[0][1])
+
+    # the multi-resolution pyramids are cached separately
+    cache_dir = output_dir / ("cached_data_aekl" if resolution is None else "cached_data_aekl_pyramid")
     cache_dir.mkdir(exist_ok=True)
 
     train_loader, val_loader = get_dataloader(
@@ -67,6 +85,11 @@ def main(args):
         batch_size=args.batch_size,
         dataset_path=args.dataset_path,
         num_workers=args.num_workers,
+        seed=args.seed,
+        bucketing=args.bucketing,
+        bucket_max_pixels=args.bucket_max_pixels,
+        resolution=resolution,
+        pyramid_sizes=pyramid_sizes,
         model_type="autoencoder",
     )
 
@@ -94,6 +117,10 @@ def main(args):
     # Get Checkpoint
     best_loss = float("inf")
     start_epoch = 0
+    start_step = 0
+    rng_state = None
+    scaler_g_state = None
+    scaler_d_state = None
     if resume:
         print(f"Using checkpoint!")
         checkpoint = torch.load(str(run_dir / "checkpoint.pth"))
@@ -103,9 +130,20 @@ def main(args):
         optimizer_d.load_state_dict(checkpoint["optimizer_d"])
         start_epoch = checkpoint["epoch"]
         best_loss = checkpoint["best_loss"]
+        # Checkpoints saved before the step-level checkpoints only have the fields above
+        start_step = checkpoint.get("step", 0)
+        rng_state = checkpoint.get("rng_state")
+        scaler_g_state = checkpoint.get("scaler_g")
+        scaler_d_state = checkpoint.get("scaler_d")
     else:
         print(f"No checkpoint found.")
 
+    telemetry = None
+    if args.telemetry_interval > 0:
+        telemetry = Telemetry(writer=writer_train, device=device, interval=args.telemetry_interval)
+        telemetry.watch(train_loader)
+        telemetry.start()
+
     # Train model
     print(f"Starting Training")
     val_loss = train_aekl(
@@ -128,7 +166,20 @@ def main(args):
         adv_weight=config["stage1"]["adv_weight"],
         perceptual_weight=config["stage1"]["perceptual_weight"],
         adv_start=args.adv_start,
+        start_step=start_step,
+        rng_state=rng_state,
+        scaler_g_state=scaler_g_state,
+        scaler_d_state=scaler_d_state,
+        ckpt_every_n_steps=args.ckpt_every_n_steps,
+        telemetry=telemetry,
+        resolution_schedule=resolution_schedule,
+        resolution=resolution,
+        target_l1=args.target_l1,
+        disc_update_interval=args.disc_update_interval,
+        eval_adv=args.eval_adv,
     )
+    if telemetry is not None:
+        telemetry.stop()
 
     log_mlflow(
         model=model,
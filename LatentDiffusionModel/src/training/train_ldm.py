@@ -9,33 +9,55 @@ import torch.nn as nn
 import torch.optim as optim
 from generative.networks.nets import DiffusionModelUNet
 from generative.networks.schedulers import DDPMScheduler
+from latent_cache import build_latent_cache, get_cache_key, get_latent_dataloader, is_cache_valid
 from monai.config import print_config
 from monai.utils import set_determinism
 from omegaconf import OmegaConf
+from telemetry import Telemetry
 from tensorboardX import SummaryWriter
 from training_functions import train_ldm
 from transformers import CLIPTextModel
-from util import get_dataloader, log_mlflow
+from util import PreviewSampler, TimestepImportanceSampler, get_dataloader, get_iu_datalist, log_mlflow
 
 warnings.filterwarnings("ignore")
 
 
-def parse_args():
+def get_parser():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("--seed", type=int, default=2, help="Random seed to use.")
     parser.add_argument("--run_dir", default="LDM", help="Location of model to resume.")
     parser.add_argument("--dataset_path",default='datasets/XrayGenerationDataset', help="Location of training set.")
     parser.add_argument("--config_file",default='configs/ldm/ldm_v0.yaml', help="Location of ldm configuration file.")
+    parser.add_argument("--cache_dir", default=None, help="Location of the PersistentDataset cache (default: runs/cached_data_diffusion).")
     parser.add_argument("--stage1_uri",default='mlruns/149355113917878320/d2ec6c4c9fc044c5851f0a59aee7026c/artifacts/final_model', help="Path readable by load_model.")
     parser.add_argument("--scale_factor", type=float, default=0.3, help="signal-to-noise ratio.")
     parser.add_argument("--batch_size", type=int, default=16, help="Training batch size.")
     parser.add_argument("--n_epochs", type=int, default=500, help="Number of epochs to train.")
     parser.add_argument("--eval_freq", type=int, default=10, help="Number of epochs to between evaluations.")
     parser.add_argument("--num_workers", type=int, default=8, help="Number of loader workers")
+    parser.add_argument("--ckpt_every_n_steps", type=int, default=0, help="Number of training steps between checkpoints (0: only at the evaluations).")
+    parser.add_argument("--bucketing", action="store_true", help="Batch the images by aspect-ratio buckets instead of resizing them to 512x512.")
+    parser.add_argument("--bucket_max_pixels", type=int, default=512 * 512, help="Number of pixels of the buckets.")
+    parser.add_argument("--latent_cache", default=None, help="Location of the cache of the training latents (default: encode the images at each step).")
+    parser.add_argument("--latent_flip_prob", type=float, default=0.5, help="Probability of the horizontal flips of the cached latents.")
+    parser.add_argument("--latent_max_shift", type=int, default=1, help="Maximum shift of the cached latents, in latent pixels.")
+    parser.add_argument("--snr_gamma", type=float, default=None, help="Gamma of the min-SNR loss weighting (default: no weighting, 5 is typical).")
+    parser.add_argument("--timestep_sampling", default="uniform", choices=["uniform", "importance"], help="Sampling of the training timesteps.")
+    parser.add_argument("--timestep_bins", type=int, default=20, help="Number of timestep bins of the importance sampling.")
+    parser.add_argument("--telemetry_interval", type=float, default=10.0, help="Seconds between telemetry samples (0: disabled).")
     parser.add_argument("--extended_report", type=int, default=1, help="Define if use extended reports (only valid MIMIC-CXR dataset.)")
     parser.add_argument("--experiment", default='AE_KL', help="Mlflow experiment name.")
+    parser.add_argument("--preview_steps", type=int, default=25, help="DDIM steps of the previews sampled during the evaluation.")
+    parser.add_argument("--preview_seeds", type=int, nargs="+", default=[0, 1, 2, 3], help="Seeds of the previews.")
+    parser.add_argument("--preview_prompts", nargs="+", default=["", "This is an X-ray image taken by a C-arm, covering 4 vertebrae, namely L1, L2, L3 and L4."], help="Prompts of the previews.")
+    parser.add_argument("--preview_guidance_scale", type=float, default=7.0, help="Guidance scale of the previews.")
+    parser.add_argument("--preview_device", default="cpu", help="Device of the preview sampler, which runs in a background thread.")
+    return parser
+
 
+def parse_args():
+    parser = get_parser()
     args = parser.parse_args()
     return args
 
@@ -76,14 +98,19 @@ def main(args):
     writer_val = SummaryWriter(log_dir=str(run_dir / "val"))
 
     print("Getting data...")
-    cache_dir = output_dir / "cached_data_diffusion"
-    cache_dir.mkdir(exist_ok=True)
+    if args.latent_cache is not None and args.bucketing:
+        raise ValueError("The latent cache can not be used with bucketing.")
+    cache_dir = output_dir / "cached_data_diffusion" if args.cache_dir is None else Path(args.cache_dir)
+    cache_dir.mkdir(exist_ok=True, parents=True)
 
     train_loader, val_loader = get_dataloader(
         cache_dir=cache_dir,
         batch_size=args.batch_size,
         dataset_path=args.dataset_path,
         num_workers=args.num_workers,
+        seed=args.seed,
+        bucketing=args.bucketing,
+        bucket_max_pixels=args.bucket_max_pixels,
         model_type="diffusion"
     )
 
@@ -101,6 +128,20 @@ def main(args):
 
     text_encoder = CLIPTextModel.from_pretrained("stabilityai/stable-diffusion-2-1-base", subfolder="text_encoder")
 
+    # Copies of the models for the previews, made before the models are moved to the GPU
+    preview_sampler = PreviewSampler(
+        model=diffusion,
+        stage1=stage1.model,
+        text_encoder=text_encoder,
+        scheduler_config=config["ldm"].get("scheduler", dict()),
+        prompts=args.preview_prompts,
+        seeds=args.preview_seeds,
+        num_inference_steps=args.preview_steps,
+        guidance_scale=args.preview_guidance_scale,
+        scale_factor=args.scale_factor,
+        device=args.preview_device,
+    )
+
     print(f"Let's use {torch.cuda.device_count()} GPUs!")
     device = torch.device("cuda")
     if torch.cuda.device_count() > 1:
@@ -112,11 +153,43 @@ def main(args):
     diffusion = diffusion.to(device)
     text_encoder = text_encoder.to(device)
 
+    if args.latent_cache is not None:
+        # the training batches are read from the latent cache, the validation still encodes the images
+        train_dicts, _ = get_iu_datalist(args.dataset_path)
+        cache_key = get_cache_key(train_dicts, args.stage1_uri)
+        if not is_cache_valid(args.latent_cache, cache_key):
+            print(f"Encoding the training latents to {args.latent_cache}...")
+            build_latent_cache(
+                cache_dir=args.latent_cache,
+                datalist=train_dicts,
+                dataset_path=args.dataset_path,
+                stage1=stage1.module.model if hasattr(stage1, "module") else stage1.model,
+                device=device,
+                key=cache_key,
+                batch_size=args.batch_size,
+                num_workers=args.num_workers,
+            )
+        train_loader = get_latent_dataloader(
+            cache_dir=args.latent_cache,
+            datalist=train_dicts,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            seed=args.seed,
+            flip_prob=args.latent_flip_prob,
+            max_shift=args.latent_max_shift,
+        )
+
     optimizer = optim.AdamW(diffusion.parameters(), lr=config["ldm"]["base_lr"])
     lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, args.n_epochs, eta_min=1e-7, last_epoch=-1, verbose=False)
+    timestep_sampler = None
+    if args.timestep_sampling == "importance":
+        timestep_sampler = TimestepImportanceSampler(scheduler.num_train_timesteps, n_bins=args.timestep_bins)
     # Get Checkpoint
     best_loss = float("inf")
     start_epoch = 0
+    start_step = 0
+    rng_state = None
+    scaler_state = None
     if resume:
         print(f"Using checkpoint!")
         checkpoint = torch.load(str(run_dir / "checkpoint.pth"))
@@ -125,9 +198,23 @@ def main(args):
         optimizer.load_state_dict(checkpoint["optimizer"])
         start_epoch = checkpoint["epoch"]
         best_loss = checkpoint["best_loss"]
+        # Checkpoints saved before the step-level checkpoints only have the fields above
+        start_step = checkpoint.get("step", 0)
+        rng_state = checkpoint.get("rng_state")
+        scaler_state = checkpoint.get("scaler")
+        if "lr_scheduler" in checkpoint:
+            lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+        if timestep_sampler is not None and "timestep_sampler" in checkpoint:
+            timestep_sampler.load_state_dict(checkpoint["timestep_sampler"])
     else:
         print(f"No checkpoint found.")
 
+    telemetry = None
+    if args.telemetry_interval > 0:
+        telemetry = Telemetry(writer=writer_train, device=device, interval=args.telemetry_interval)
+        telemetry.watch(train_loader)
+        telemetry.start()
+
     # Train model
     print(f"Starting Training")
     val_loss = train_ldm(
@@ -148,7 +235,17 @@ def main(args):
         device=device,
         run_dir=run_dir,
         scale_factor=args.scale_factor,
+        preview_sampler=preview_sampler,
+        start_step=start_step,
+        rng_state=rng_state,
+        scaler_state=scaler_state,
+        ckpt_every_n_steps=args.ckpt_every_n_steps,
+        telemetry=telemetry,
+        snr_gamma=args.snr_gamma,
+        timestep_sampler=timestep_sampler,
     )
+    if telemetry is not None:
+        telemetry.stop()
 
     log_mlflow(
         model=diffusion,
@@ -1,16 +1,35 @@
 """ Training functions for the different models. """
+import time
 from collections import OrderedDict
 from pathlib import Path
+from typing import Callable, Optional
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from generative.losses.adversarial_loss import PatchAdversarialLoss
-from pynvml.smi import nvidia_smi
+from telemetry import Telemetry
 from tensorboardX import SummaryWriter
 from torch.cuda.amp import GradScaler, autocast
 from tqdm import tqdm
-from util import log_ldm_sample_unconditioned, log_reconstructions
+from util import (
+    PreviewSampler,
+    TimestepImportanceSampler,
+    get_min_snr_weights,
+    get_rng_state,
+    log_ldm_sample_unconditioned,
+    log_reconstructions,
+    log_val_loss,
+    save_checkpoint,
+    get_resolution,
+    set_loader_epoch,
+    set_rng_state,
+)
+
+try:
+    from pynvml.smi import nvidia_smi
+except ImportError:
+    nvidia_smi = None
 
 
 def get_lr(optimizer):
@@ -19,7 +38,13 @@ def get_lr(optimizer):
 
 
 def print_gpu_memory_report():
-    if torch.cuda.is_available():
+    if torch.cuda.is_available() and nvidia_smi is None:
+        print("Memory report")
+        for i in range(torch.cuda.device_count()):
+            used = torch.cuda.memory_reserved(i)
+            total = torch.cuda.get_device_properties(i).total_memory
+            print(f"gpu:{i} mem(%) {int(used * 100.0 / total)} (reserved by torch)")
+    elif torch.cuda.is_available():
         nvsmi = nvidia_smi.getInstance()
         data = nvsmi.DeviceQuery("memory.used, memory.total, utilization.gpu")["gpu"]
         print("Memory report")
@@ -51,12 +76,41 @@ def train_aekl(
     perceptual_weight: float,
     kl_weight: float,
     adv_start: int,
+    start_step: int = 0,
+    rng_state: Optional[dict] = None,
+    scaler_g_state: Optional[dict] = None,
+    scaler_d_state: Optional[dict] = None,
+    ckpt_every_n_steps: int = 0,
+    telemetry: Optional[Telemetry] = None,
+    resolution_schedule: Optional[list] = None,
+    resolution=None,
+    target_l1: Optional[float] = None,
+    disc_update_interval: int = 1,
+    eval_adv: bool = False,
 ) -> float:
     scaler_g = GradScaler()
     scaler_d = GradScaler()
+    if scaler_g_state is not None:
+        scaler_g.load_state_dict(scaler_g_state)
+    if scaler_d_state is not None:
+        scaler_d.load_state_dict(scaler_d_state)
 
     raw_model = model.module if hasattr(model, "module") else model
 
+    def get_checkpoint(epoch: int, step: int) -> dict:
+        return {
+            "epoch": epoch,
+            "step": step,
+            "state_dict": model.state_dict(),
+            "discriminator": discriminator.state_dict(),
+            "optimizer_g": optimizer_g.state_dict(),
+            "optimizer_d": optimizer_d.state_dict(),
+            "scaler_g": scaler_g.state_dict(),
+            "scaler_d": scaler_d.state_dict(),
+            "best_loss": best_loss,
+            "rng_state": get_rng_state(),
+        }
+
     val_loss = eval_aekl(
         model=model,
         discriminator=discriminator,
@@ -66,12 +120,25 @@ def train_aekl(
         step=start_epoch,
         writer=writer_val,
         kl_weight=kl_weight,
-        adv_weight=adv_weight if start_epoch >= adv_start else 0.0,
+        adv_weight=adv_weight if start_epoch >= adv_start and eval_adv else 0.0,
         perceptual_weight=perceptual_weight,
     )
     print(f"epoch {start_epoch} val loss: {val_loss:.4f}")
+    log_val_loss(run_dir, start_epoch, val_loss)
+    start_time = time.time()
+    target_reached = False
 
     for epoch in range(start_epoch, n_epochs):
+        epoch_resolution, epoch_kl_weight = None, kl_weight
+        if resolution_schedule is not None:
+            epoch_resolution = get_resolution(resolution_schedule, epoch)
+            resolution.value = epoch_resolution
+            # The KL loss is summed over the latent pixels, the other losses are averaged: scale it to keep the
+            # weighting of the final resolution
+            epoch_kl_weight = kl_weight * (resolution_schedule[-1][1] / epoch_resolution) ** 2
+
+        # Skip the batches already seen if the run was resumed in the middle of the epoch
+        set_loader_epoch(train_loader, epoch, start_step)
         train_epoch_aekl(
             model=model,
             discriminator=discriminator,
@@ -82,12 +149,22 @@ def train_aekl(
             device=device,
             epoch=epoch,
             writer=writer_train,
-            kl_weight=kl_weight,
+            kl_weight=epoch_kl_weight,
             adv_weight=adv_weight if epoch >= adv_start else 0.0,
             perceptual_weight=perceptual_weight,
             scaler_g=scaler_g,
             scaler_d=scaler_d,
+            resolution=epoch_resolution,
+            start_step=start_step,
+            rng_state=rng_state,
+            ckpt_every_n_steps=ckpt_every_n_steps,
+            checkpoint_fn=lambda step: save_checkpoint(get_checkpoint(epoch, step), run_dir / "checkpoint.pth"),
+            telemetry=telemetry,
+            disc_update_interval=disc_update_interval,
         )
+        start_step, rng_state = 0, None
+        if telemetry is not None:
+            telemetry.end_epoch(epoch)
 
         if (epoch + 1) % eval_freq == 0:
             val_loss = eval_aekl(
@@ -99,26 +176,27 @@ def train_aekl(
                 step=epoch,
                 writer=writer_val,
                 kl_weight=kl_weight,
-                adv_weight=adv_weight if epoch >= adv_start else 0.0,
+                adv_weight=adv_weight if epoch >= adv_start and eval_adv else 0.0,
                 perceptual_weight=perceptual_weight,
             )
             print(f"epoch {epoch + 1} val loss: {val_loss:.4f}")
+            log_val_loss(run_dir, epoch + 1, val_loss)
             print_gpu_memory_report()
 
+            if target_l1 is not None and not target_reached and val_loss <= target_l1:
+                target_reached = True
+                elapsed = time.time() - start_time
+                print(f"Target L1 {target_l1} reached at epoch {epoch + 1} after {elapsed / 3600:.2f} h")
+                writer_val.add_scalar("time_to_target_l1", elapsed, epoch + 1)
+
             # Save checkpoint
-            checkpoint = {
-                "epoch": epoch + 1,
-                "state_dict": model.state_dict(),
-                "discriminator": discriminator.state_dict(),
-                "optimizer_g": optimizer_g.state_dict(),
-                "optimizer_d": optimizer_d.state_dict(),
-                "best_loss": best_loss,
-            }
-            torch.save(checkpoint, str(run_dir / "checkpoint.pth"))
+            save_checkpoint(get_checkpoint(epoch + 1, 0), run_dir / "checkpoint.pth")
 
             if val_loss <= best_loss:
                 print(f"New best val loss {val_loss}")
                 best_loss = val_loss
+        elif ckpt_every_n_steps > 0:
+            save_checkpoint(get_checkpoint(epoch + 1, 0), run_dir / "checkpoint.pth")
 
     print(f"Training finished!")
     print(f"Saving final model...")
@@ -142,15 +220,45 @@ def train_epoch_aekl(
     perceptual_weight: float,
     scaler_g: GradScaler,
     scaler_d: GradScaler,
+    start_step: int = 0,
+    rng_state: Optional[dict] = None,
+    ckpt_every_n_steps: int = 0,
+    checkpoint_fn: Optional[Callable[[int], None]] = None,
+    telemetry: Optional[Telemetry] = None,
+    resolution: Optional[int] = None,
+    disc_update_interval: int = 1,
 ) -> None:
     model.train()
     discriminator.train()
+    discriminator_params = list(discriminator.parameters())
+    discriminator_loss = torch.tensor([0.0]).to(device)
 
     adv_loss = PatchAdversarialLoss(criterion="least_squares", no_activation_leastsq=True)
 
-    pbar = tqdm(enumerate(loader), total=len(loader), desc=f'Training Epoch {epoch + 1}')
+    if telemetry is not None:
+        telemetry.start_epoch()
+
+    n_steps = start_step + len(loader)
+    pbar = tqdm(
+        enumerate(loader, start=start_step),
+        initial=start_step,
+        total=n_steps,
+        desc=f'Training Epoch {epoch + 1}',
+    )
+    # Restored after the loader iterator is created, which draws from the torch RNG
+    if rng_state is not None:
+        set_rng_state(rng_state)
+    if len(loader) == 0:
+        # resumed from a checkpoint taken after the last batch of the epoch, nothing to train or log
+        return
     for step, x in pbar:
         images = x["image"].to(device)
+        if resolution is not None and images.shape[-1] != resolution:
+            # batches prefetched before the resolution changed
+            images = F.interpolate(images, size=(resolution, resolution), mode="area")
+
+        # The discriminator is only updated every disc_update_interval steps
+        update_d = adv_weight > 0 and step % disc_update_interval == 0
 
         # GENERATOR
         optimizer_g.zero_grad(set_to_none=True)
@@ -184,18 +292,17 @@ def train_epoch_aekl(
                 g_loss=g_loss,
             )
 
-        scaler_g.scale(losses["loss"]).backward()
-        scaler_g.unscale_(optimizer_g)
-        torch.nn.utils.clip_grad_norm_(model.parameters(), 1)
-        scaler_g.step(optimizer_g)
-        scaler_g.update()
+        # the graph of the fake logits is kept for the discriminator loss
+        scaler_g.scale(losses["loss"]).backward(retain_graph=update_d)
 
         # DISCRIMINATOR
-        if adv_weight > 0:
+        if update_d:
+            # The fake logits of the generator pass are reused: the discriminator is not updated yet, so they are the
+            # logits of the detached reconstruction, and backpropagating to the discriminator parameters only leaves
+            # the generator out. Only the real images need a new discriminator pass.
             optimizer_d.zero_grad(set_to_none=True)
 
             with autocast(enabled=True):
-                logits_fake = discriminator(reconstruction.contiguous().detach())[-1]
                 loss_d_fake = adv_loss(logits_fake, target_is_real=False, for_discriminator=True)
                 logits_real = discriminator(images.contiguous().detach())[-1]
                 loss_d_real = adv_loss(logits_real, target_is_real=True, for_discriminator=True)
@@ -204,14 +311,20 @@ def train_epoch_aekl(
                 d_loss = adv_weight * discriminator_loss
                 d_loss = d_loss.mean()
 
-            scaler_d.scale(d_loss).backward()
+            scaler_d.scale(d_loss).backward(inputs=discriminator_params)
+
+        scaler_g.unscale_(optimizer_g)
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 1)
+        scaler_g.step(optimizer_g)
+        scaler_g.update()
+
+        if update_d:
             scaler_d.unscale_(optimizer_d)
-            torch.nn.utils.clip_grad_norm_(discriminator.parameters(), 1)
+            torch.nn.utils.clip_grad_norm_(discriminator_params, 1)
             scaler_d.step(optimizer_d)
             scaler_d.update()
-        else:
-            discriminator_loss = torch.tensor([0.0]).to(device)
 
+        # last discriminator loss, when it was not updated at this step
         losses["d_loss"] = discriminator_loss
 
         pbar.set_postfix(
@@ -225,6 +338,14 @@ def train_epoch_aekl(
                 "lr_d": f"{get_lr(optimizer_d):.4f}",
             },
         )
+
+        if telemetry is not None:
+            telemetry.step(images.shape[0])
+
+        # the checkpoint of the last step is saved by the caller after the end of the epoch, as (epoch + 1, 0)
+        is_ckpt_step = ckpt_every_n_steps > 0 and (step + 1) % ckpt_every_n_steps == 0
+        if checkpoint_fn is not None and is_ckpt_step and step + 1 < n_steps:
+            checkpoint_fn(step + 1)
     writer.add_scalar("lr_g", get_lr(optimizer_g), epoch)
     writer.add_scalar("lr_d", get_lr(optimizer_d), epoch)
     for k, v in losses.items():
@@ -244,6 +365,8 @@ def eval_aekl(
     adv_weight: float,
     perceptual_weight: float,
 ) -> float:
+    """Validation losses of the AEKL. The returned L1 loss selects the checkpoints, so the adversarial losses are only
+    computed with adv_weight > 0 (train_aekl passes 0 unless eval_adv is set)."""
     model.eval()
     discriminator.eval()
 
@@ -269,7 +392,7 @@ def eval_aekl(
 
             # DISCRIMINATOR
             if adv_weight > 0:
-                logits_fake = discriminator(reconstruction.contiguous().detach())[-1]
+                # without gradients, the fake logits of the generator loss are the ones of the discriminator loss
                 loss_d_fake = adv_loss(logits_fake, target_is_real=False, for_discriminator=True)
                 logits_real = discriminator(images.contiguous().detach())[-1]
                 loss_d_real = adv_loss(logits_real, target_is_real=True, for_discriminator=True)
@@ -346,10 +469,35 @@ def train_ldm(
     device: torch.device,
     run_dir: Path,
     scale_factor: float = 1.0,
+    preview_sampler: Optional[PreviewSampler] = None,
+    start_step: int = 0,
+    rng_state: Optional[dict] = None,
+    scaler_state: Optional[dict] = None,
+    ckpt_every_n_steps: int = 0,
+    telemetry: Optional[Telemetry] = None,
+    snr_gamma: Optional[float] = None,
+    timestep_sampler: Optional[TimestepImportanceSampler] = None,
 ) -> float:
     scaler = GradScaler()
+    if scaler_state is not None:
+        scaler.load_state_dict(scaler_state)
     raw_model = model.module if hasattr(model, "module") else model
 
+    def get_checkpoint(epoch: int, step: int) -> dict:
+        checkpoint = {
+            "epoch": epoch,
+            "step": step,
+            "diffusion": model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "lr_scheduler": lr_scheduler.state_dict(),
+            "scaler": scaler.state_dict(),
+            "best_loss": best_loss,
+            "rng_state": get_rng_state(),
+        }
+        if timestep_sampler is not None:
+            checkpoint["timestep_sampler"] = timestep_sampler.state_dict()
+        return checkpoint
+
     val_loss = eval_ldm(
         model=model,
         stage1=stage1,
@@ -363,8 +511,11 @@ def train_ldm(
         scale_factor=scale_factor,
     )
     print(f"epoch {start_epoch} val loss: {val_loss:.4f}")
+    log_val_loss(run_dir, start_epoch, val_loss)
 
     for epoch in range(start_epoch, n_epochs):
+        # Skip the batches already seen if the run was resumed in the middle of the epoch
+        set_loader_epoch(train_loader, epoch, start_step)
         train_epoch_ldm(
             model=model,
             stage1=stage1,
@@ -377,7 +528,17 @@ def train_ldm(
             writer=writer_train,
             scaler=scaler,
             scale_factor=scale_factor,
+            start_step=start_step,
+            rng_state=rng_state,
+            ckpt_every_n_steps=ckpt_every_n_steps,
+            checkpoint_fn=lambda step: save_checkpoint(get_checkpoint(epoch, step), run_dir / "checkpoint.pth"),
+            telemetry=telemetry,
+            snr_gamma=snr_gamma,
+            timestep_sampler=timestep_sampler,
         )
+        start_step, rng_state = 0, None
+        if telemetry is not None:
+            telemetry.end_epoch(epoch)
         lr_scheduler.step()
         if (epoch + 1) % eval_freq == 0:
             val_loss = eval_ldm(
@@ -391,29 +552,31 @@ def train_ldm(
                 writer=writer_val,
                 sample=True if (epoch + 1) % (eval_freq * 2) == 0 else False,
                 scale_factor=scale_factor,
+                preview_sampler=preview_sampler,
             )
 
             print(f"epoch {epoch + 1} val loss: {val_loss:.4f}")
+            log_val_loss(run_dir, epoch + 1, val_loss)
             print_gpu_memory_report()
 
             # Save checkpoint
-            checkpoint = {
-                "epoch": epoch + 1,
-                "diffusion": model.state_dict(),
-                "optimizer": optimizer.state_dict(),
-                "best_loss": best_loss,
-            }
-            torch.save(checkpoint, str(run_dir / "checkpoint.pth"))
+            save_checkpoint(get_checkpoint(epoch + 1, 0), run_dir / "checkpoint.pth")
 
             if val_loss <= best_loss:
                 print(f"New best val loss {val_loss}")
                 best_loss = val_loss
-                torch.save(raw_model.state_dict(), str(run_dir / "best_model.pth"))
+                # atomic, as best_model.pth can be read by testing/checkpoint_watcher.py during the training
+                save_checkpoint(raw_model.state_dict(), run_dir / "best_model.pth")
+        elif ckpt_every_n_steps > 0:
+            save_checkpoint(get_checkpoint(epoch + 1, 0), run_dir / "checkpoint.pth")
 
     print(f"Training finished!")
     print(f"Saving final model...")
     torch.save(raw_model.state_dict(), str(run_dir / "final_model.pth"))
 
+    if preview_sampler is not None:
+        preview_sampler.join()
+
     return val_loss
 
 
@@ -429,19 +592,45 @@ def train_epoch_ldm(
     writer: SummaryWriter,
     scaler: GradScaler,
     scale_factor: float = 1.0,
+    start_step: int = 0,
+    rng_state: Optional[dict] = None,
+    ckpt_every_n_steps: int = 0,
+    checkpoint_fn: Optional[Callable[[int], None]] = None,
+    telemetry: Optional[Telemetry] = None,
+    snr_gamma: Optional[float] = None,
+    timestep_sampler: Optional[TimestepImportanceSampler] = None,
 ) -> None:
     model.train()
 
-    pbar = tqdm(enumerate(loader), total=len(loader))
+    if telemetry is not None:
+        telemetry.start_epoch()
+
+    n_steps = start_step + len(loader)
+    pbar = tqdm(enumerate(loader, start=start_step), initial=start_step, total=n_steps)
+    # Restored after the loader iterator is created, which draws from the torch RNG
+    if rng_state is not None:
+        set_rng_state(rng_state)
+    if len(loader) == 0:
+        # resumed from a checkpoint taken after the last batch of the epoch, nothing to train or log
+        return
     for step, x in pbar:
-        images = x["image"].to(device)
         reports = x["report"].to(device)
-        timesteps = torch.randint(0, scheduler.num_train_timesteps, (images.shape[0],), device=device).long()
+        batch_size = reports.shape[0]
+        if timestep_sampler is not None:
+            timesteps, importance_weights = timestep_sampler.sample(batch_size, device)
+        else:
+            timesteps = torch.randint(0, scheduler.num_train_timesteps, (batch_size,), device=device).long()
 
         optimizer.zero_grad(set_to_none=True)
         with autocast(enabled=True):
             with torch.no_grad():
-                e = stage1(images) * scale_factor
+                if "z_mu" in x:
+                    # batches of the latent cache (see latent_cache.py), sampled as AutoencoderKL.sampling
+                    z_mu = x["z_mu"].to(device).float()
+                    z_sigma = x["z_sigma"].to(device).float()
+                    e = (z_mu + z_sigma * torch.randn_like(z_sigma)) * scale_factor
+                else:
+                    e = stage1(x["image"].to(device)) * scale_factor
 
             prompt_embeds = text_encoder(reports.squeeze(1))
             prompt_embeds = prompt_embeds[0]
@@ -455,9 +644,19 @@ def train_epoch_ldm(
                 target = scheduler.get_velocity(e, noise, timesteps)
             elif scheduler.prediction_type == "epsilon":
                 target = noise
-            loss = F.mse_loss(noise_pred.float(), target.float())
+            # per-sample MSE, weighted by the min-SNR weights and by the importance weights of the timesteps
+            mse = F.mse_loss(noise_pred.float(), target.float(), reduction="none").mean(dim=(1, 2, 3))
+            sample_losses = mse
+            if snr_gamma is not None:
+                sample_losses = sample_losses * get_min_snr_weights(scheduler, timesteps, snr_gamma)
+            if timestep_sampler is not None:
+                loss = (sample_losses * importance_weights).mean()
+            else:
+                loss = sample_losses.mean()
 
-        losses = OrderedDict(loss=loss)
+        losses = OrderedDict(loss=loss, mse=mse.mean())
+        if timestep_sampler is not None:
+            timestep_sampler.update(timesteps, sample_losses)
 
         scaler.scale(losses["loss"]).backward()
         scaler.step(optimizer)
@@ -470,6 +669,14 @@ def train_epoch_ldm(
 
         pbar.set_postfix({"epoch": epoch, "loss": f"{losses['loss'].item():.5f}", "lr": f"{get_lr(optimizer):.6f}"})
 
+        if telemetry is not None:
+            telemetry.step(batch_size)
+
+        # the checkpoint of the last step is saved by the caller after the end of the epoch, as (epoch + 1, 0)
+        is_ckpt_step = ckpt_every_n_steps > 0 and (step + 1) % ckpt_every_n_steps == 0
+        if checkpoint_fn is not None and is_ckpt_step and step + 1 < n_steps:
+            checkpoint_fn(step + 1)
+
 
 @torch.no_grad()
 def eval_ldm(
@@ -483,6 +690,7 @@ def eval_ldm(
     writer: SummaryWriter,
     sample: bool = False,
     scale_factor: float = 1.0,
+    preview_sampler: Optional[PreviewSampler] = None,
 ) -> float:
     model.eval()
     raw_stage1 = stage1.module if hasattr(stage1, "module") else stage1
@@ -524,7 +732,9 @@ def eval_ldm(
     for k, v in total_losses.items():
         writer.add_scalar(f"{k}", v, step)
 
-    if sample:
+    if sample and preview_sampler is not None:
+        preview_sampler.submit(model=raw_model, writer=writer, step=step, spatial_shape=tuple(e.shape[1:]))
+    elif sample:
         log_ldm_sample_unconditioned(
             model=raw_model,
             stage1=raw_stage1,
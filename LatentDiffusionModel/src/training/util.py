@@ -1,6 +1,11 @@
 """Utility functions for training."""
+import copy
+import random
+import sys
+import threading
+import time
 from pathlib import Path
-from typing import Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 import matplotlib.pyplot as plt
 import mlflow.pytorch
@@ -8,20 +13,39 @@ import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
-from custom_transforms import ApplyTokenizerd, LoadJSONd, RandomSelectExcerptd
+from custom_transforms import (
+    ApplyTokenizer,
+    ApplyTokenizerd,
+    BuildPyramidd,
+    LoadJSONd,
+    RandomSelectExcerptd,
+    ResizeToBucketd,
+    SelectResolutiond,
+)
+from generative.networks.schedulers import DDIMScheduler
+from matplotlib.figure import Figure
 from mlflow import start_run
 from monai import transforms
 from monai.data import PersistentDataset
 from omegaconf import OmegaConf
 from omegaconf.dictconfig import DictConfig
 from tensorboardX import SummaryWriter
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler
 from tqdm import tqdm
 import json,os
 from datetime import datetime 
 
+# the dataset code shared with the testing scripts
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "common"))
+from xray_data import ManifestDatalist, assign_buckets, get_buckets, get_load_transforms
+
+
+def get_iu_datalist(dataset_path:str, buckets: Optional[List[Tuple[int, int]]] = None):
+    if os.path.exists(os.path.join(dataset_path, "manifest.parquet")):
+        return ManifestDatalist(dataset_path, "train", buckets), ManifestDatalist(dataset_path, "val", buckets)
+    if buckets is not None:
+        raise ValueError("Bucketing needs the image sizes of manifest.parquet, run preprocessing/create_manifest.py.")
 
-def get_iu_datalist(dataset_path:str):
     with open(os.path.join(dataset_path, 'annotation.json'), "r") as f:
         data = json.load(f)
     train_data = []
@@ -48,45 +72,278 @@ def get_datalist(
     extended_report: bool = False,
 ):
     """Get data dicts for data loaders."""
-    df = pd.read_csv(ids_path, sep="\t")
-
-    data_dicts = []
-    for index, row in df.iterrows():
-        report_path = row["report"]
-        if extended_report:
-            report_path = report_path.replace("report_sentences", "report_sentences_extended")
-        data_dicts.append(
-            {
-                "image": f"{row['image']}",
-                "report": report_path,
-            }
-        )
+    df = pd.read_csv(ids_path, sep="\t", usecols=["image", "report"], dtype=str)
+    if extended_report:
+        df["report"] = df["report"].str.replace("report_sentences", "report_sentences_extended", regex=False)
+
+    data_dicts = df.to_dict("records")
 
     print(f"Found {len(data_dicts)} subjects.")
     return data_dicts
 
 
+def get_report_transforms(drop_prob: float = 0.0) -> list:
+    """Transforms tokenizing the report, which is replaced by the empty prompt with probability drop_prob (to train the
+    unconditional model of the classifier-free guidance)."""
+    report_transforms = [
+        #LoadJSONd(keys=["report"]),
+        #RandomSelectExcerptd(keys=["report"], sentence_key="sentences", max_n_sentences=5),
+        ApplyTokenizerd(keys=["report"]),
+    ]
+    if drop_prob > 0:
+        report_transforms.append(
+            transforms.RandLambdad(
+                keys=["report"],
+                prob=drop_prob,
+                func=lambda x: torch.cat(
+                    (49406 * torch.ones(1, 1), 49407 * torch.ones(1, x.shape[1] - 1)), 1
+                ).long(),
+            ),  # 49406: BOS token 49407: PAD token
+        )
+    return report_transforms
+
+
+class ResumableRandomSampler(Sampler):
+    """Random sampler that can resume in the middle of an epoch.
+
+    The order of an epoch only depends on the seed and the epoch number, so it can be recreated after a restart, and
+    set_epoch can skip the samples already seen in the epoch.
+    """
+
+    def __init__(self, data_source, seed: int = 0) -> None:
+        self.num_samples = len(data_source)
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch: int, start_index: int = 0) -> None:
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(self.num_samples, generator=generator).tolist()
+        return iter(indices[self.start_index :])
+
+    def __len__(self) -> int:
+        # start_index is past the end when resuming from a checkpoint taken after the last (partial) batch
+        return max(0, self.num_samples - self.start_index)
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler whose batches only contain images of the same resolution bucket.
+
+    The images of each bucket are shuffled and split into batches, and the order of the batches is shuffled. As for
+    ResumableRandomSampler, the order of an epoch only depends on the seed and the epoch number, and set_epoch can skip
+    the batches already seen in the epoch.
+    """
+
+    def __init__(
+        self, bucket_ids: np.ndarray, batch_size: int, shuffle: bool = True, seed: int = 0, drop_last: bool = False
+    ) -> None:
+        self.bucket_ids = np.asarray(bucket_ids)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch: int, start_batch: int = 0) -> None:
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def get_batches(self) -> list:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        batches = []
+        for bucket_id in np.unique(self.bucket_ids):
+            indices = np.flatnonzero(self.bucket_ids == bucket_id)
+            if self.shuffle:
+                indices = indices[torch.randperm(len(indices), generator=generator).numpy()]
+            for i in range(0, len(indices), self.batch_size):
+                batch = indices[i : i + self.batch_size].tolist()
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return batches
+
+    def __iter__(self):
+        return iter(self.get_batches()[self.start_batch :])
+
+    def __len__(self) -> int:
+        counts = np.unique(self.bucket_ids, return_counts=True)[1]
+        if self.drop_last:
+            n_batches = int(np.sum(counts // self.batch_size))
+        else:
+            n_batches = int(np.sum(-(-counts // self.batch_size)))
+        return max(0, n_batches - self.start_batch)
+
+
+def set_loader_epoch(loader: DataLoader, epoch: int, start_step: int = 0) -> None:
+    """Set the epoch of the resumable (batch) sampler of the loader, skipping its first start_step batches."""
+    if hasattr(loader.batch_sampler, "set_epoch"):
+        loader.batch_sampler.set_epoch(epoch, start_batch=start_step)
+    else:
+        loader.sampler.set_epoch(epoch, start_index=start_step * loader.batch_size)
+
+
+def get_resolution_schedule(schedule: str) -> List[Tuple[int, int]]:
+    """Parse a resolution schedule "EPOCH:SIZE,..." (e.g. "0:128,10:256,20:512") to a sorted list of (epoch, size)."""
+    stages = sorted(tuple(int(v) for v in stage.split(":")) for stage in schedule.split(","))
+    if stages[0][0] != 0:
+        raise ValueError(f"The resolution schedule {schedule} has to start at epoch 0.")
+    return stages
+
+
+def get_resolution(schedule: List[Tuple[int, int]], epoch: int) -> int:
+    return [size for start_epoch, size in schedule if start_epoch <= epoch][-1]
+
+
+def get_snr(scheduler, timesteps: torch.Tensor) -> torch.Tensor:
+    """Signal-to-noise ratio alpha_bar / (1 - alpha_bar) of the timesteps."""
+    alphas_cumprod = scheduler.alphas_cumprod.to(timesteps.device)[timesteps]
+    return alphas_cumprod / (1.0 - alphas_cumprod)
+
+
+def get_min_snr_weights(scheduler, timesteps: torch.Tensor, gamma: float) -> torch.Tensor:
+    """Min-SNR-gamma loss weights (Hang et al., 2023), min(SNR, gamma) / SNR expressed for the prediction type of the
+    scheduler: the MSE of the noise is weighted by min(SNR, gamma) / SNR, the MSE of the velocity by
+    min(SNR, gamma) / (SNR + 1)."""
+    snr = get_snr(scheduler, timesteps)
+    if scheduler.prediction_type == "v_prediction":
+        return torch.clamp(snr, max=gamma) / (snr + 1.0)
+    return torch.clamp(snr, max=gamma) / snr
+
+
+class TimestepImportanceSampler:
+    """Loss-aware sampler of the training timesteps.
+
+    The timesteps are grouped in n_bins bins, and the last history_size training losses of each bin are kept. Once
+    every bin has a full history, a bin is drawn with a probability proportional to the root mean square of its losses
+    (mixed with uniform_prob of uniform sampling, so no bin is starved), and the timestep uniformly in the bin; before,
+    the timesteps are drawn uniformly. The returned weights 1 / (n_bins * p(bin)) make the weighted loss an unbiased
+    estimate of the loss under uniform sampling.
+    """
+
+    def __init__(
+        self, num_train_timesteps: int, n_bins: int = 20, history_size: int = 10, uniform_prob: float = 0.05
+    ) -> None:
+        self.num_train_timesteps = num_train_timesteps
+        self.n_bins = n_bins
+        self.history_size = history_size
+        self.uniform_prob = uniform_prob
+        self.bin_edges = np.linspace(0, num_train_timesteps, n_bins + 1).astype(int)
+        self.history = np.zeros((n_bins, history_size))
+        self.counts = np.zeros(n_bins, dtype=int)
+
+    def get_probs(self) -> np.ndarray:
+        if np.any(self.counts < self.history_size):
+            return np.full(self.n_bins, 1.0 / self.n_bins)
+        probs = np.sqrt(np.mean(self.history**2, axis=1))
+        probs = probs / probs.sum()
+        return (1.0 - self.uniform_prob) * probs + self.uniform_prob / self.n_bins
+
+    def sample(self, batch_size: int, device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the timesteps of a batch and their importance weights."""
+        probs = self.get_probs()
+        bins = np.random.choice(self.n_bins, size=batch_size, p=probs)
+        timesteps = np.random.randint(self.bin_edges[bins], self.bin_edges[bins + 1])
+        weights = 1.0 / (self.n_bins * probs[bins])
+        return (
+            torch.from_numpy(timesteps).long().to(device),
+            torch.from_numpy(weights).float().to(device),
+        )
+
+    def update(self, timesteps: torch.Tensor, losses: torch.Tensor) -> None:
+        """Add the per-sample losses of the timesteps of a batch to the history of their bins. These are the losses of
+        the objective before the importance weights, i.e. with the min-SNR weights when they are used, so the sampling
+        follows the loss that is actually minimized."""
+        bins = np.searchsorted(self.bin_edges, timesteps.cpu().numpy(), side="right") - 1
+        for b, loss in zip(bins, losses.detach().float().cpu().numpy()):
+            self.history[b] = np.roll(self.history[b], -1)
+            self.history[b, -1] = loss
+            self.counts[b] = min(self.counts[b] + 1, self.history_size)
+
+    def state_dict(self) -> dict:
+        return {"history": self.history.copy(), "counts": self.counts.copy()}
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        self.history = np.asarray(state_dict["history"])
+        self.counts = np.asarray(state_dict["counts"])
+
+
+def get_rng_state() -> dict:
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: dict) -> None:
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def save_checkpoint(checkpoint: dict, path: Path) -> None:
+    """Save through a temporary file, so a job preempted while saving does not corrupt the previous checkpoint."""
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    torch.save(checkpoint, str(tmp_path))
+    os.replace(tmp_path, path)
+
+
 def get_dataloader(
     cache_dir: Union[str, Path],
     batch_size: int,
     dataset_path: str,
     num_workers: int = 8,
-    model_type: str = "autoencoder"
+    model_type: str = "autoencoder",
+    seed: int = 0,
+    bucketing: bool = False,
+    bucket_max_pixels: int = 512 * 512,
+    resolution=None,
+    pyramid_sizes: Optional[List[int]] = None,
 ):
+    """Get the training and validation loaders.
+
+    If `resolution` (a shared multiprocessing Value) is given, the autoencoder training images are stored in the cache
+    with their pyramid of pyramid_sizes, and are loaded at the size given by resolution.value (see
+    get_resolution_schedule). The validation images are always at 512x512.
+    """
+    if bucketing and resolution is not None:
+        raise ValueError("Bucketing and the resolution schedule can not be used together.")
+
     # Define transformations
+    load_transforms = get_load_transforms(dataset_path)
+    if bucketing:
+        # resize to the bucket of each image, the random transforms keep its size
+        resize = ResizeToBucketd(keys=["image"])
+        spatial_size = None
+    else:
+        resize = transforms.Resized(keys=["image"], spatial_size=(512, 512))
+        spatial_size = [512, 512]
+
+    pyramid_transforms = []
+    if resolution is not None:
+        pyramid_transforms = [
+            BuildPyramidd(keys=["image"], sizes=pyramid_sizes),
+            SelectResolutiond(keys=["image"], resolution=resolution, sizes=pyramid_sizes),
+        ]
     val_transforms = transforms.Compose(
         [
-            transforms.LoadImaged(keys=["image"]),
-            transforms.EnsureChannelFirstd(keys=["image"]),
-            transforms.Lambdad(
-                keys=["image"],
-                func=lambda x: x[0, :, :][
-                    None,
-                ],
-            ),
-            transforms.Resized(keys=["image"], spatial_size=(512, 512)),
-            transforms.Rotate90d(keys=["image"], k=-1, spatial_axes=(0, 1)),  # Fix flipped image read
-            transforms.Flipd(keys=["image"], spatial_axis=1),  # Fix flipped image read
+            *load_transforms,
+            resize,
             transforms.ScaleIntensityRanged(keys=["image"], a_min=0.0, a_max=255.0, b_min=0.0, b_max=1.0, clip=True),
             #transforms.CenterSpatialCropd(keys=["image"], roi_size=(512, 512)),
             transforms.RandAffined(
@@ -94,7 +351,7 @@ def get_dataloader(
                     rotate_range=(0, 0),
                     translate_range=(-0, 0),
                     scale_range=(0, 0),
-                    spatial_size=[512, 512],
+                    spatial_size=spatial_size,
                     prob=1,
                 ),
             transforms.ToTensord(keys=["image"]),
@@ -106,27 +363,19 @@ def get_dataloader(
     if model_type == "autoencoder":
         train_transforms = transforms.Compose(
             [
-                transforms.LoadImaged(keys=["image"]),
-                transforms.EnsureChannelFirstd(keys=["image"]),
-                transforms.Lambdad(
-                    keys=["image"],
-                    func=lambda x: x[0, :, :][
-                        None,
-                    ],
-                ),
-                transforms.Resized(keys=["image"], spatial_size=(512, 512)),
-                transforms.Rotate90d(keys=["image"], k=-1, spatial_axes=(0, 1)),  # Fix flipped image read
-                transforms.Flipd(keys=["image"], spatial_axis=1),  # Fix flipped image read
+                *load_transforms,
+                resize,
                 transforms.ScaleIntensityRanged(
                     keys=["image"], a_min=0.0, a_max=255.0, b_min=0.0, b_max=1.0, clip=True
                 ),
+                *pyramid_transforms,
                 #transforms.CenterSpatialCropd(keys=["image"], roi_size=(512, 512)),
                 transforms.RandAffined(
                     keys=["image"],
                     rotate_range=(-np.pi / 36, np.pi / 36),
                     translate_range=(-2, 2),
                     scale_range=(-0.01, 0.01),
-                    spatial_size=[512, 512],
+                    spatial_size=spatial_size if resolution is None else None,
                     prob=0.5,
                 ),
                 transforms.RandFlipd(keys=["image"], spatial_axis=1, prob=0.5),
@@ -139,49 +388,50 @@ def get_dataloader(
     if model_type == "diffusion":
         train_transforms = transforms.Compose(
             [
-                transforms.LoadImaged(keys=["image"]),
-                transforms.EnsureChannelFirstd(keys=["image"]),
-                transforms.Lambdad(
-                    keys=["image"],
-                    func=lambda x: x[0, :, :][
-                        None,
-                    ],
-                ),
-                transforms.Resized(keys=["image"], spatial_size=(512, 512)),
-                transforms.Rotate90d(keys=["image"], k=-1, spatial_axes=(0, 1)),  # Fix flipped image read
-                transforms.Flipd(keys=["image"], spatial_axis=1),  # Fix flipped image read
+                *load_transforms,
+                resize,
                 transforms.ScaleIntensityRanged(
                     keys=["image"], a_min=0.0, a_max=255.0, b_min=0.0, b_max=1.0, clip=True
                 ),
-                transforms.CenterSpatialCropd(keys=["image"], roi_size=(512, 512)),
+                *([] if bucketing else [transforms.CenterSpatialCropd(keys=["image"], roi_size=(512, 512))]),
                 transforms.RandAffined(
                     keys=["image"],
                     rotate_range=(-np.pi / 36, np.pi / 36),
                     translate_range=(-2, 2),
                     scale_range=(-0.01, 0.01),
-                    spatial_size=[512, 512],
+                    spatial_size=spatial_size,
                     prob=0.10,
                 ),
                 transforms.ToTensord(keys=["image"]),
-                #LoadJSONd(keys=["report"]),
-                #RandomSelectExcerptd(keys=["report"], sentence_key="sentences", max_n_sentences=5),
-                ApplyTokenizerd(keys=["report"]),
-                transforms.RandLambdad(
-                    keys=["report"],
-                    prob=0.10,
-                    func=lambda x: torch.cat(
-                        (49406 * torch.ones(1, 1), 49407 * torch.ones(1, x.shape[1] - 1)), 1
-                    ).long(),
-                ),  # 49406: BOS token 49407: PAD token
+                *get_report_transforms(drop_prob=0.10),
             ]
         )
 
-    train_dicts,val_dicts = get_iu_datalist(dataset_path)
+    buckets = get_buckets(max_pixels=bucket_max_pixels) if bucketing else None
+    train_dicts,val_dicts = get_iu_datalist(dataset_path, buckets)
     train_ds = PersistentDataset(data=train_dicts, transform=train_transforms, cache_dir=str(cache_dir))
+    val_ds = PersistentDataset(data=val_dicts, transform=val_transforms, cache_dir=str(cache_dir))
+    if bucketing:
+        train_loader = DataLoader(
+            train_ds,
+            batch_sampler=BucketBatchSampler(train_dicts.bucket_ids, batch_size, shuffle=True, seed=seed),
+            num_workers=num_workers,
+            pin_memory=False,
+            persistent_workers=True,
+        )
+        val_loader = DataLoader(
+            val_ds,
+            batch_sampler=BucketBatchSampler(val_dicts.bucket_ids, batch_size, shuffle=False),
+            num_workers=num_workers,
+            pin_memory=False,
+            persistent_workers=True,
+        )
+        return train_loader, val_loader
+
     train_loader = DataLoader(
         train_ds,
         batch_size=batch_size,
-        shuffle=True,
+        sampler=ResumableRandomSampler(train_ds, seed=seed),
         num_workers=num_workers,
         drop_last=False,
         pin_memory=False,
@@ -189,7 +439,6 @@ def get_dataloader(
     )
 
     # val_dicts = get_datalist(ids_path=validation_ids, extended_report=extended_report)
-    val_ds = PersistentDataset(data=val_dicts, transform=val_transforms, cache_dir=str(cache_dir))
     val_loader = DataLoader(
         val_ds,
         batch_size=batch_size,
@@ -242,6 +491,16 @@ def log_mlflow(
         mlflow.pytorch.log_model(raw_model, "final_model")
 
 
+def log_val_loss(run_dir: Path, epoch: int, loss: float) -> None:
+    """Append the validation loss to run_dir/val_loss.csv (read by sweep_ldm.py to prune trials)."""
+    csv_path = Path(run_dir) / "val_loss.csv"
+    new_file = not csv_path.exists()
+    with open(csv_path, "a") as f:
+        if new_file:
+            f.write("epoch,loss,time\n")
+        f.write(f"{epoch},{loss},{time.time()}\n")
+
+
 def get_figure(
     img: torch.Tensor,
     recons: torch.Tensor,
@@ -305,7 +564,115 @@ def log_ldm_sample_unconditioned(
     plt.imshow(img_0, cmap="gray")
     plt.axis("off")
     writer.add_figure("SAMPLE", fig, step)
-  
+
+
+class PreviewSampler:
+    """Few-step preview of the diffusion model during training.
+
+    The previews are sampled with a DDIM scheduler of num_inference_steps steps from fixed seeds and prompts, so they
+    are comparable between epochs. The sampling runs in a background thread on a copy of the models (on the CPU by
+    default): submit() only copies the current weights of the diffusion model, and training continues while the
+    preview is generated. If the previous preview is still running, the new one is skipped.
+
+    The copies are made when the sampler is created, so it should be created before the models are moved to the GPU.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        stage1: nn.Module,
+        text_encoder,
+        scheduler_config: dict,
+        prompts: list,
+        seeds: list,
+        num_inference_steps: int = 25,
+        guidance_scale: float = 7.0,
+        scale_factor: float = 1.0,
+        device: str = "cpu",
+    ) -> None:
+        self.device = torch.device(device)
+        self.seeds = list(seeds)
+        self.prompts = list(prompts)
+        self.guidance_scale = guidance_scale
+        self.scale_factor = scale_factor
+
+        self.model = copy.deepcopy(model).to(self.device).eval()
+        self.stage1 = copy.deepcopy(stage1).to(self.device).eval()
+        for parameter in list(self.model.parameters()) + list(self.stage1.parameters()):
+            parameter.requires_grad = False
+
+        self.scheduler = DDIMScheduler(**scheduler_config, clip_sample=False)
+        self.scheduler.set_timesteps(num_inference_steps)
+
+        # The prompts are fixed, the text encoder is only needed once
+        tokenizer = ApplyTokenizer()
+        with torch.no_grad():
+            tokens = torch.cat([tokenizer(prompt) for prompt in [""] + self.prompts])
+            self.prompt_embeds = text_encoder(tokens)[0].to(self.device)
+
+        self._thread = None
+
+    def submit(self, model: nn.Module, writer: SummaryWriter, step: int, spatial_shape: Tuple) -> bool:
+        """Start the preview of the current weights of `model`. Returns False if the previous one is still running."""
+        if self._thread is not None and self._thread.is_alive():
+            print(f"Preview of step {step} skipped, the previous one is still running.")
+            return False
+
+        raw_model = model.module if hasattr(model, "module") else model
+        self.model.load_state_dict(raw_model.state_dict())
+
+        self._thread = threading.Thread(target=self._run, args=(writer, step, spatial_shape), daemon=True)
+        self._thread.start()
+        return True
+
+    def join(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, writer: SummaryWriter, step: int, spatial_shape: Tuple) -> None:
+        try:
+            images = self.sample(spatial_shape)
+        except Exception as e:
+            print(f"Preview of step {step} failed: {e}")
+            return
+
+        # One row per prompt and one column per seed
+        rows = [np.concatenate(list(row), axis=1) for row in images]
+        grid = np.concatenate(rows, axis=0)
+
+        # Figure instead of pyplot, which is not thread-safe
+        fig = Figure(dpi=300)
+        ax = fig.add_subplot()
+        ax.imshow(grid, cmap="gray")
+        ax.axis("off")
+        fig.savefig(os.path.join(writer.logdir, f"SAMPLE_{step}.png"), bbox_inches="tight")
+        writer.add_figure("SAMPLE", fig, step)
+
+    @torch.no_grad()
+    def sample(self, spatial_shape: Tuple) -> np.ndarray:
+        """Sample one image per prompt and seed. Returns an array (n_prompts, n_seeds, H, W) in [0, 1]."""
+        n_prompts, n_seeds = len(self.prompts), len(self.seeds)
+        noise = torch.cat(
+            [torch.randn((1,) + tuple(spatial_shape), generator=torch.Generator().manual_seed(seed)) for seed in self.seeds]
+        )
+        latent = noise.repeat(n_prompts, 1, 1, 1).to(self.device)
+
+        uncond_embeds = self.prompt_embeds[:1].expand(n_prompts * n_seeds, -1, -1)
+        cond_embeds = self.prompt_embeds[1:].repeat_interleave(n_seeds, dim=0)
+        context = torch.cat([uncond_embeds, cond_embeds])
+
+        for t in self.scheduler.timesteps:
+            timesteps = torch.full((2 * latent.shape[0],), int(t), device=self.device, dtype=torch.long)
+            model_output = self.model(x=torch.cat([latent] * 2), timesteps=timesteps, context=context)
+            noise_pred_uncond, noise_pred_text = model_output.chunk(2)
+            noise_pred = noise_pred_uncond + self.guidance_scale * (noise_pred_text - noise_pred_uncond)
+            latent, _ = self.scheduler.step(noise_pred, t, latent)
+
+        x_hat = self.stage1.decode(latent / self.scale_factor)
+        images = np.clip(x_hat[:, 0].float().cpu().numpy(), a_min=0, a_max=1)
+        return images.reshape((n_prompts, n_seeds) + images.shape[1:])
+
+
 def generate_folder_from_current_time(prefix:str=''):  
     current_time = datetime.now()   
     formatted_time = current_time.strftime('%Y-%m-%d_%H-%M-%S')  